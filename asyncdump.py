@@ -0,0 +1,269 @@
+import dumpv2
+import metrics
+
+import asyncio
+import concurrent.futures
+import datetime
+import logging
+import time
+
+import websockets
+
+"""writer which runs Writer in the shared executor, one batch at a time
+
+items wait in the queue of MultithreadedWriter, which is not started,
+so they are kept under its memory_limit and spilled to disk over it as well
+"""
+class ExecutorWriter:
+    def __init__(self, pipeline: dumpv2.MultithreadedWriter, executor: concurrent.futures.Executor):
+        self.pipeline = pipeline
+        self.writer = pipeline.writer
+        self.executor = executor
+        # future of the running batch
+        self.job = None
+        self.ended = False
+        self.exception = None
+
+    def start(self):
+        # nothing to start, batches are run in the executor
+        pass
+
+    def put(self, item: tuple):
+        if self.exception != None: raise Exception("Error occurred on writer thread") from self.exception
+        if self.ended:
+            return
+        self.pipeline.put(item)
+        if self.job is None:
+            self.submit()
+
+    def submit(self):
+        # items piled up while the previous batch was running are written at once,
+        # spilled ones are read back after the memory queue is empty
+        items = self.pipeline.take()
+        if len(items) > 0:
+            self.job = asyncio.get_running_loop().run_in_executor(self.executor, self.writer.write_batch, items)
+        elif self.pipeline.spilling:
+            self.job = asyncio.get_running_loop().run_in_executor(self.executor, self.write_spilled)
+        else:
+            return
+        self.job.add_done_callback(self.done)
+
+    # this runs in the executor
+    def write_spilled(self):
+        return self.writer.write_batch(self.pipeline.unspill())
+
+    def done(self, job):
+        self.job = None
+        if job.exception() is not None:
+            self.exception = job.exception()
+            self.writer.shutdown()
+            self.pipeline.close_spill()
+        elif job.result():
+            self.ended = True
+            self.pipeline.close_spill()
+        elif len(self.pipeline.queue) > 0 or self.pipeline.spilling:
+            self.submit()
+
+    """wait until every item is written"""
+    async def join(self):
+        while self.job is not None:
+            await asyncio.wait([self.job])
+
+    def open(self, time: int):
+        self.put((dumpv2.OPEN, None, time))
+
+    def msg(self, msg: str, time: int):
+        self.put((dumpv2.MSG, msg, time))
+
+    def send(self, msg: str, time: int):
+        self.put((dumpv2.SEND, msg, time))
+
+    def err(self, msg: str, time: int):
+        self.put((dumpv2.ERR, msg, time))
+
+    def end(self, time: int):
+        # files are left as they are if the writer failed, the error is already told by put
+        if self.exception is not None:
+            return
+        self.put((dumpv2.END, None, time))
+
+"""dump WebSocket stream in the event loop, made from WebSocketDumper returned by gen()"""
+class AsyncWebSocketDumper:
+    def __init__(self, dumper: dumpv2.WebSocketDumper, executor: concurrent.futures.Executor):
+        self.url = dumper.url
+        # called when connected
+        self.subscribe = dumper.subscribe
+        self.on_connect = dumper.on_connect
+
+        # use the writer of the dumper without starting its thread
+        self.writer = ExecutorWriter(dumper.writer, executor)
+        # WebSocket connection
+        self.ws = None
+        # messages to send in order
+        self.outgoing = asyncio.Queue()
+
+        self.logger = logging.getLogger('websocket')
+
+        group = metrics.REGISTRY.group(dumper.prefix)
+        self.received = group.counter('received')
+        self.received_bytes = group.counter('received_bytes')
+
+    # called from subscribe, same as WebSocketDumper.send
+    def send(self, message: str):
+        self.outgoing.put_nowait(message)
+        timestamp = time.time_ns()
+        try:
+            self.writer.send(message, timestamp)
+        except Exception:
+            self.logger.exception('error on send')
+            self.outgoing.put_nowait(None)
+
+    async def sender(self):
+        while True:
+            message = await self.outgoing.get()
+            if message is None:
+                await self.ws.close()
+                return
+            await self.ws.send(message)
+
+    # frames after the failed one would never be sent, reconnect
+    def sender_done(self, task: asyncio.Task):
+        if task.cancelled() or task.exception() is None:
+            return
+        self.logger.error('failed to send to [%s]: %s', self.url, task.exception())
+        asyncio.ensure_future(self.ws.close())
+
+    async def do(self):
+        self.logger.info('Connecting to [%s]...' % self.url)
+
+        self.writer.start()
+        sender = None
+        try:
+            async with websockets.connect(self.url, max_size=None) as ws:
+                self.ws = ws
+                self.logger.info('WebSocket opened for [%s]' % self.url)
+                if self.on_connect is not None:
+                    self.on_connect()
+                sender = asyncio.create_task(self.sender())
+                sender.add_done_callback(self.sender_done)
+
+                if self.subscribe != None:
+                    try:
+                        # Do subscribing process
+                        self.subscribe(self)
+                    except Exception:
+                        self.logger.exception('Encountered an error on subscribe')
+                        return
+
+                async for message in ws:
+                    timestamp = time.time_ns()
+                    self.received.add()
+                    self.received_bytes.add(len(message))
+                    try:
+                        self.writer.msg(message, timestamp)
+                    except Exception:
+                        self.logger.exception("writer msg returned error")
+                        return
+        except asyncio.CancelledError:
+            self.logger.warn('Got kill command, ending stream')
+            raise
+        except Exception as error:
+            timestamp = time.time_ns()
+            self.logger.error('Got WebSocket error [%s]:' % self.url)
+            self.logger.error(error)
+            self.writer.err(str(error), timestamp)
+        finally:
+            if sender is not None:
+                sender.cancel()
+            self.logger.warn('WebSocket closed for [%s]' % self.url)
+            self.writer.end(time.time_ns())
+            await self.writer.join()
+
+class AsyncReconnecter:
+    DEFAULT_RECONNECTION_TIME = dumpv2.Reconnecter.DEFAULT_RECONNECTION_TIME
+    MAX_RECONNECTION_TIME = dumpv2.Reconnecter.MAX_RECONNECTION_TIME
+
+    def __init__(self, gen_dump, executor: concurrent.futures.Executor):
+        self.gen_dump = gen_dump
+        self.executor = executor
+        # monotonic time of the last disconnection, same as Reconnecter
+        self.disconnected = None
+        self.metrics = None
+
+        self.logger = logging.getLogger('reconnector')
+
+    connected = dumpv2.Reconnecter.connected
+
+    async def do(self):
+        loop = asyncio.get_running_loop()
+        # seconds to wait
+        time_wait = self.DEFAULT_RECONNECTION_TIME
+        # last connection time
+        time_connect = None
+
+        while True:
+            time_connect = datetime.datetime.utcnow()
+
+            try:
+                # gen_dump could block on retrieving metadata
+                dumper = await loop.run_in_executor(None, self.gen_dump)
+                if self.metrics is None:
+                    self.metrics = metrics.REGISTRY.group(dumper.prefix)
+                dumper.on_connect = self.connected
+                await AsyncWebSocketDumper(dumper, self.executor).do()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.logger.exception('uncatched error in dumper')
+            if self.metrics is not None and self.disconnected is None:
+                self.disconnected = time.monotonic()
+
+            # wait seconds not to dead loop
+            # wait if disconnected in less than 5 minites from connection
+            if ((datetime.datetime.utcnow() - time_connect) / datetime.timedelta(minutes=1) <= 5):
+                # wait
+                self.logger.warn('Waiting %d seconds...' % time_wait)
+                await asyncio.sleep(time_wait)
+
+                # set wait time as twice as the time before
+                time_wait = min(time_wait*2, self.MAX_RECONNECTION_TIME)
+            else:
+                # reset wait time and do not wait
+                time_wait = self.DEFAULT_RECONNECTION_TIME
+
+"""run reconnecting dumpers of every gen in one event loop"""
+async def run(gens: list, workers: int = 4):
+    # writing and compression of every dumper are done in this executor
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='writer') as executor:
+        await asyncio.gather(*[AsyncReconnecter(gen, executor).do() for gen in gens])
+
+def main():
+    import argparse
+    import common
+    import bitmex
+    import bitfinex
+    import bitflyer
+
+    exchanges = {
+        'bitmex': bitmex.gen,
+        'bitfinex': bitfinex.gen,
+        'bitflyer': bitflyer.gen,
+    }
+
+    parser = argparse.ArgumentParser(description='dump every exchange in one process')
+    parser.add_argument('exchanges', nargs='*', choices=list(exchanges), help='exchanges to dump, every exchange if omitted')
+    parser.add_argument('--workers', type=int, default=4, help='number of threads writing files')
+    common.add_metrics_arguments(parser)
+    common.add_profiling_arguments(parser)
+    args = parser.parse_args()
+    common.start_metrics(args)
+    common.start_profiling(args, 'asyncdump')
+
+    gens = [exchanges[exchange] for exchange in (args.exchanges or exchanges)]
+    try:
+        asyncio.run(run(gens, args.workers))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
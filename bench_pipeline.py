@@ -0,0 +1,234 @@
+import dumpv2
+import bench_state
+import reader
+import standin
+import synthetic
+
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# end-to-end benchmark of the dumper pipeline
+# on_message -> MultithreadedWriter -> state.msg -> gzip, driven by synthetic messages
+# served from standin.ReplayStandIn in another process, so CPU time of this process is the dumper only
+#
+# python bench_pipeline.py --save                 write results as the baseline
+# python bench_pipeline.py                        compare with the baseline, exits with 1 on regression
+# python bench_pipeline.py --rate 0 20000         as fast as possible, then 20000 messages/s
+#
+# reports messages/s sustained from the first received message to the last written one,
+# latency from on_message to Writer flushing the message to the file, depth of the writer queue sampled
+# while running, CPU time per message and bytes of the files written
+
+DEFAULT_BASELINE = 'bench_pipeline.json'
+
+# metrics compared with the baseline, True if higher is better
+METRICS = {
+    'msg_per_sec': True,
+    'latency_p50_us': False,
+    'latency_p99_us': False,
+    'cpu_us_per_msg': False,
+    'bytes': False,
+}
+
+# returns records of a connection replaying synthetic messages of exchange
+# channels are the ones the state class names, messages are interval nanoseconds apart
+def synthetic_records(exchange: str, count: int, interval: int):
+    state = bench_state.STATES[exchange]()
+    timestamp = time.time_ns()
+    records = [reader.Record('start', timestamp, None, 'wss://localhost')]
+    for (type, message) in synthetic.GENERATORS[exchange](count):
+        if type == 'send':
+            state.send(message)
+            continue
+        timestamp += interval
+        records.append(reader.Record('msg', timestamp, state.msg(message), message))
+    return records
+
+# subscribe of WebSocketDumper sending the subscribe frames of synthetic messages
+def synthetic_subscribe(exchange: str):
+    frames = [message for (type, message) in synthetic.GENERATORS[exchange](0) if type == 'send']
+    def subscribe(ws: dumpv2.WebSocketDumper):
+        for frame in frames:
+            ws.send(frame)
+    return subscribe
+
+# this runs in the server process, sends the port, then the number of messages sent when told to stop
+def serve(exchange: str, count: int, rate: float, connection):
+    interval = int(1_000_000_000 / rate) if rate else 1_000_000
+    records = synthetic_records(exchange, count, interval)
+    replay = standin.ReplayStandIn(lambda: records, exchange, 1.0 if rate else None).start()
+    connection.send(replay.port)
+    connection.recv()
+    replay.stop()
+    connection.send(replay.sent)
+
+def percentile(values: list, q: float):
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def directory_bytes(directory: str):
+    return sum(os.path.getsize(os.path.join(path, name)) for (path, _, names) in os.walk(directory) for name in names)
+
+"""run the dumper of exchange against a stand-in serving count synthetic messages at rate (0 as fast as possible), returns metrics"""
+def run(exchange: str, count: int, rate: float, sample_interval: float = 0.001, **options):
+    (connection, child) = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(exchange, count, rate, child), daemon=True)
+    server.start()
+    directory = tempfile.mkdtemp(prefix='bench_pipeline_')
+    try:
+        port = connection.recv()
+        state = bench_state.STATES[exchange]()
+        dumper = dumpv2.WebSocketDumper(directory, exchange, 'ws://localhost:%d/' % port, synthetic_subscribe(exchange), state, **options)
+
+        # nanoseconds from receiving to written to the file of every message,
+        # when the first one is received and the last one is written
+        latencies = []
+        first_received = [None]
+        last_written = [0]
+        writer = dumper.writer.writer
+        # received times of messages of the batch not in the buffer yet, and of messages in the buffer
+        batch = collections.deque()
+        buffered = []
+        write_batch = writer.write_batch
+        def timed_write_batch(items):
+            batch.extend(timestamp for (type, _, timestamp) in items if type == dumpv2.MSG)
+            try:
+                return write_batch(items)
+            finally:
+                batch.clear()
+        writer.write_batch = timed_write_batch
+        # a message is analyzed right before it is put into the buffer, after the file of its minute is opened
+        analyze = writer.analyze
+        def timed_analyze(analyzer, msg: str):
+            if analyzer == writer.state.msg:
+                timestamp = batch.popleft()
+                buffered.append(timestamp)
+                if first_received[0] is None:
+                    first_received[0] = timestamp
+            return analyze(analyzer, msg)
+        writer.analyze = timed_analyze
+        # messages are written when the buffer is, flush keeps them while a snapshot is in progress
+        flush = writer.flush
+        def timed_flush(wait: bool = False):
+            flush(wait)
+            if len(writer.buffer) == 0 and len(buffered) > 0:
+                now = time.time_ns()
+                latencies.extend(now - timestamp for timestamp in buffered)
+                buffered.clear()
+                last_written[0] = now
+        writer.flush = timed_flush
+
+        # items in the queue of MultithreadedWriter
+        depths = []
+        running = threading.Event()
+        running.set()
+        def sample():
+            pipeline = dumper.writer
+            while running.is_set():
+                depths.append(pipeline.items_in - pipeline.items_out)
+                time.sleep(sample_interval)
+        sampler = threading.Thread(target=sample, name='bench-sampler', daemon=True)
+
+        cpu = time.process_time()
+        sampler.start()
+        dumper.do()
+        dumper.writer.join()
+        cpu = time.process_time() - cpu
+        running.clear()
+        sampler.join()
+
+        connection.send(None)
+        sent = connection.recv()
+        if dumper.writer.exception is not None:
+            raise dumper.writer.exception
+
+        latencies.sort()
+        depths.sort()
+        received = len(latencies)
+        wall = (last_written[0] - first_received[0]) / 1_000_000_000 if received > 0 else 0
+        return {
+            'messages': received,
+            'sent': sent,
+            'msg_per_sec': received / wall if wall > 0 else 0,
+            'latency_p50_us': percentile(latencies, 0.5) / 1000,
+            'latency_p99_us': percentile(latencies, 0.99) / 1000,
+            'latency_max_us': (latencies[-1] if received > 0 else 0) / 1000,
+            'queue_p99': percentile(depths, 0.99),
+            'queue_max': dumper.writer.stats()['max_memory_items'],
+            'cpu_us_per_msg': cpu / received * 1_000_000 if received > 0 else 0,
+            'bytes': directory_bytes(directory),
+        }
+    finally:
+        server.join(5)
+        if server.is_alive():
+            server.terminate()
+        shutil.rmtree(directory)
+
+# returns names of metrics of result worse than baseline by more than tolerance
+def regressions(result: dict, baseline: dict, tolerance: float):
+    worse = []
+    for (metric, higher) in METRICS.items():
+        if metric not in baseline or baseline[metric] == 0:
+            continue
+        change = (result[metric] - baseline[metric]) / baseline[metric]
+        if (-change if higher else change) > tolerance:
+            worse.append(metric)
+    return worse
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the dumper end to end with a local stand-in server')
+    parser.add_argument('--count', type=int, default=200000, help='number of messages per exchange')
+    parser.add_argument('--exchange', nargs='+', choices=list(synthetic.GENERATORS), default=list(synthetic.GENERATORS), help='exchanges to run')
+    parser.add_argument('--rate', type=float, nargs='+', default=[0], help='messages/s the stand-in sends, 0 for as fast as possible')
+    parser.add_argument('--compresslevel', type=int, default=9, help='gzip compression level of Writer')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='json file of results to compare with')
+    parser.add_argument('--save', action='store_true', help='save results as the baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change of a metric reported as a regression')
+    args = parser.parse_args()
+
+    # websocket-client logs a normal close as an error
+    logging.disable(logging.ERROR)
+
+    baseline = dict()
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            saved = json.load(file)
+        if (saved['count'], saved['compresslevel']) == (args.count, args.compresslevel):
+            baseline = saved['results']
+        else:
+            print('baseline %s was made with --count %d --compresslevel %d, not compared' % (args.baseline, saved['count'], saved['compresslevel']))
+
+    results = dict()
+    flagged = 0
+    print('%-18s %10s %10s %10s %10s %8s %8s %10s %10s  %s' % ('run', 'msg/s', 'p50 us', 'p99 us', 'max us', 'queue99', 'queuemax', 'CPU us/msg', 'MB', 'regressions'))
+    for exchange in args.exchange:
+        for rate in args.rate:
+            name = '%s@%s' % (exchange, '%g' % rate if rate else 'max')
+            result = results[name] = run(exchange, args.count, rate, compresslevel=args.compresslevel)
+            worse = regressions(result, baseline[name], args.tolerance) if name in baseline else []
+            flagged += len(worse)
+            print('%-18s %10.0f %10.0f %10.0f %10.0f %8d %8d %10.2f %10.2f  %s' % (name, result['msg_per_sec'],
+                result['latency_p50_us'], result['latency_p99_us'], result['latency_max_us'], result['queue_p99'], result['queue_max'],
+                result['cpu_us_per_msg'], result['bytes'] / 1_000_000, ' '.join(worse) if name in baseline else '(no baseline)'))
+            if result['messages'] != result['sent']:
+                print('%s: %d messages sent but %d written' % (name, result['sent'], result['messages']))
+                flagged += 1
+
+    if args.save:
+        with open(args.baseline, 'w') as file:
+            json.dump({ 'count': args.count, 'compresslevel': args.compresslevel, 'results': results }, file, indent=2)
+        print('saved baseline to %s' % args.baseline)
+    if flagged > 0:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import dumpv2
+import bench_state
+import reader
+import recordfmt
+import synthetic
+
+import argparse
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+# benchmark of binary records against tab separated lines
+# compares stored bytes and read throughput on dump files
+
+# write synthetic messages to directory in tab separated lines, returns prefix
+def write_synthetic(directory: str, exchange: str, count: int, interval: int):
+    writer = dumpv2.Writer(directory, exchange, 'wss://localhost', bench_state.STATES[exchange]())
+    timestamp = time.time_ns()
+    items = []
+    for (type, message) in synthetic.GENERATORS[exchange](count):
+        items.append((dumpv2.SEND if type == 'send' else dumpv2.MSG, message, timestamp))
+        timestamp += interval
+    for i in range(0, len(items), 1000):
+        writer.write_batch(items[i:i+1000])
+    writer.end(timestamp)
+    return exchange
+
+# returns seconds to read every record of files
+def read_time(paths: list):
+    start = time.perf_counter()
+    for path in paths:
+        for record in reader.read_file(path):
+            pass
+    return time.perf_counter() - start
+
+def run(directory: str, prefix: str, compresslevel: int):
+    files = [path for (_, path) in reader.list_files(directory, prefix)]
+    converted = tempfile.mkdtemp(prefix='bench_recordfmt_')
+    try:
+        binary_files = []
+        raw = 0
+        raw_binary = 0
+        for path in files:
+            binary_path = os.path.join(converted, os.path.basename(path))
+            with gzip.open(path, 'rb') as input, gzip.open(binary_path, 'wb', compresslevel=compresslevel) as output:
+                recordfmt.to_binary(input, output)
+            with gzip.open(path, 'rb') as input:
+                raw += len(input.read())
+            with gzip.open(binary_path, 'rb') as input:
+                raw_binary += len(input.read())
+            binary_files.append(binary_path)
+
+        size = sum(os.path.getsize(path) for path in files)
+        size_binary = sum(os.path.getsize(path) for path in binary_files)
+        records = sum(1 for path in files for record in reader.read_file(path))
+
+        print('%-8s %12s %12s %12s %12s' % ('format', 'raw MB', 'gzip MB', 'records/s', 'raw MB/s'))
+        for (name, paths, raw_size, gzip_size) in (('tsv', files, raw, size), ('binary', binary_files, raw_binary, size_binary)):
+            duration = read_time(paths)
+            print('%-8s %12.2f %12.2f %12.0f %12.1f' % (name, raw_size / 1_000_000, gzip_size / 1_000_000, records / duration, raw_size / 1_000_000 / duration))
+    finally:
+        shutil.rmtree(converted)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare binary records against tab separated lines')
+    parser.add_argument('directory', nargs='?', help='dump directory of an exchange, synthetic messages are used if omitted')
+    parser.add_argument('--prefix', help='prefix of files in directory, name of directory by default')
+    parser.add_argument('--compresslevel', type=int, default=9, help='gzip compression level of converted files')
+    parser.add_argument('--count', type=int, default=200000, help='number of synthetic messages per exchange')
+    parser.add_argument('--interval', type=int, default=1_000_000, help='nanoseconds between synthetic messages')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    if args.directory is not None:
+        run(args.directory, args.prefix, args.compresslevel)
+        return
+
+    for exchange in synthetic.GENERATORS:
+        directory = tempfile.mkdtemp(prefix='bench_recordfmt_')
+        try:
+            print(exchange)
+            prefix = write_synthetic(directory, exchange, args.count, args.interval)
+            run(directory, prefix, args.compresslevel)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import dumpv2
+import bitmex
+import bitfinex
+import bitflyer
+import synthetic
+
+import argparse
+import json
+import time
+
+# benchmark of state analyzers
+# compares decoding every message (before) with classify-only fast path (after)
+
+STATES = {
+    'bitmex': bitmex.BitmexState,
+    'bitfinex': bitfinex.BitfinexState,
+    'bitflyer': bitflyer.BitflyerState,
+}
+
+
+def run(exchange: str, frames: list, lazy: bool):
+    state = STATES[exchange]()
+    start = time.perf_counter()
+    for (type, message) in frames:
+        if type == 'send':
+            state.send(message)
+        elif lazy:
+            state.msg(message)
+        else:
+            state.parse(message)
+    return len(frames) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark state analyzers with synthetic messages')
+    parser.add_argument('--count', type=int, default=200000, help='number of messages per exchange')
+    parser.add_argument('--repeat', type=int, default=3, help='take the best of this many runs')
+    args = parser.parse_args()
+
+    backend = dumpv2.json_loads
+    print('json backend: %s' % backend.__module__)
+    print('%-10s %16s %16s %16s %8s' % ('exchange', 'json msg/s', 'backend msg/s', 'lazy msg/s', 'speedup'))
+
+    for exchange, generator in synthetic.GENERATORS.items():
+        frames = list(generator(args.count))
+
+        # before: stdlib json on every message
+        dumpv2.json_loads = json.loads
+        before = max(run(exchange, frames, False) for _ in range(args.repeat))
+        # faster json backend on every message
+        dumpv2.json_loads = backend
+        full = max(run(exchange, frames, False) for _ in range(args.repeat))
+        # after: decode only messages which update state
+        lazy = max(run(exchange, frames, True) for _ in range(args.repeat))
+
+        print('%-10s %16.0f %16.0f %16.0f %7.2fx' % (exchange, before, full, lazy, lazy / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import dumpv2
+import bench_state
+import synthetic
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+# benchmark of Writer
+# measures uncompressed MB/s, CPU time per message and compression ratio
+
+# state which does not analyze anything, to measure only the write path
+class NullState:
+    def msg(self, message: str):
+        return 'channel'
+
+    def send(self, message: str):
+        return 'channel'
+
+    def snapshot(self):
+        return []
+
+
+def run(exchange: str, items: list, use_state: bool, **options):
+    directory = tempfile.mkdtemp(prefix='bench_writer_')
+    try:
+        state = bench_state.STATES[exchange]() if use_state else NullState()
+        writer = dumpv2.Writer(directory, exchange, 'wss://localhost', state, **options)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        # the queue of MultithreadedWriter is drained roughly by this size
+        for i in range(0, len(items), 1000):
+            writer.write_batch(items[i:i+1000])
+        writer.end(items[-1][2])
+        cpu = time.process_time() - cpu
+        wall = time.perf_counter() - wall
+
+        written = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        return wall, cpu, written
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark Writer with synthetic messages')
+    parser.add_argument('--count', type=int, default=200000, help='number of messages per exchange')
+    parser.add_argument('--compresslevel', type=int, nargs='+', default=[1, 6, 9], help='gzip compression levels to compare')
+    parser.add_argument('--flush-size', type=int, default=dumpv2.Writer.DEFAULT_FLUSH_SIZE, help='bytes buffered before passed to gzip')
+    parser.add_argument('--interval', type=int, default=1_000_000, help='nanoseconds between messages')
+    parser.add_argument('--state', action='store_true', help='include analyzing messages by the exchange state')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    print('%-10s %6s %10s %10s %12s %8s' % ('exchange', 'level', 'MB', 'MB/s', 'CPU us/msg', 'ratio'))
+    for exchange, generator in synthetic.GENERATORS.items():
+        items = []
+        timestamp = time.time_ns()
+        for (type, message) in generator(args.count):
+            items.append((dumpv2.SEND if type == 'send' else dumpv2.MSG, message, timestamp))
+            timestamp += args.interval
+        size = sum(len(message) for (_, message, _) in items) / 1_000_000
+
+        for compresslevel in args.compresslevel:
+            wall, cpu, written = run(exchange, items, args.state, compresslevel=compresslevel, flush_size=args.flush_size)
+            print('%-10s %6d %10.1f %10.1f %12.2f %8.2f' % (exchange, compresslevel, size, size / wall, cpu / len(items) * 1_000_000, size * 1_000_000 / written))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,61 @@
 import dumpv2
-from common import DIR
+from common import DIR, DIR_METADATA
+import metadata
+import common
+import standby
 
 import websocket
 import urllib.request
 import json
 import logging
+import bisect
+import argparse
 
 logger = logging.getLogger('Bitfinex')
 
 # number of channels Bitfinex allows to open at maximum
 BITFINEX_CHANNEL_LIMIT = 30
+# seconds between opening connections, Bitfinex limits connections per minute
+BITFINEX_CONNECTION_INTERVAL = 3
+
+BITFINEX_URL = 'wss://api-pub.bitfinex.com/ws/2'
+BITFINEX_TICKERS_URL = 'https://api.bitfinex.com/v2/tickers?symbols=ALL'
 
 class BitfinexState():
     def __init__(self):
         # map of id versus channel
         self.idvch = dict()
+        # map of message head '[chanId,' vs channel
+        # only for channels which do not need to be decoded
+        self.heads = dict()
         self.orderbooks = dict()
+        # map of chanId vs set of prices changed since the last snapshot
+        # None if changes are not tracked
+        self.changed = None
+
+    # start tracking changes for incremental snapshots
+    def track_changes(self):
+        self.changed = dict()
 
     def send(self, message: str):
         obj = json.loads(message)
         return '%s_%s' % (obj['channel'], obj['symbol'])
 
     def msg(self, message: str):
-        obj = json.loads(message)
+        channel = self.classify(message)
+        if channel is not None:
+            return channel
+        return self.parse(message)
+
+    # returns channel name only by looking at the head of the message
+    # returns None if the message has to be fully decoded
+    def classify(self, message: str):
+        # normal channel message is [chanId,...]
+        return self.heads.get(message[:message.find(',') + 1])
+
+    # decode the whole message and update state
+    def parse(self, message: str):
+        obj = dumpv2.json_loads(message)
 
         if type(obj) == dict:
             if obj['event'] == 'subscribed':
@@ -32,6 +65,8 @@ class BitfinexState():
                 chanId = obj['chanId']
 
                 channel = self.idvch[chanId] = '%s_%s' % (event_channel, symbol)
+                if not channel.startswith('book'):
+                    self.heads['[%d,' % chanId] = channel
                 
                 return channel
 
@@ -56,8 +91,20 @@ class BitfinexState():
 
             if chanId not in self.orderbooks:
                 # first time to get data for this orderbook channel
-                self.orderbooks[chanId] = dict()
+                # each side has a map of price vs (count, amount) and a sorted list of its prices
+                self.orderbooks[chanId] = {
+                    'bids': dict(),
+                    'bidPrices': list(),
+                    'asks': dict(),
+                    'askPrices': list(),
+                }
             orderbook = self.orderbooks[chanId]
+            memBids = orderbook['bids']
+            memBidPrices = orderbook['bidPrices']
+            memAsks = orderbook['asks']
+            memAskPrices = orderbook['askPrices']
+            if self.changed is not None:
+                changed = self.changed.setdefault(chanId, set())
 
             orders = obj[1]
             # no orders, probably because maintainance
@@ -74,24 +121,39 @@ class BitfinexState():
                 count = order[1]
                 amount = order[2]
                 if count == 0:
-                    if price in orderbook:
-                        del orderbook[price]
+                    if price in memBids:
+                        del memBids[price]
+                        del memBidPrices[bisect.bisect_left(memBidPrices, price)]
+                    elif price in memAsks:
+                        del memAsks[price]
+                        del memAskPrices[bisect.bisect_left(memAskPrices, price)]
+                elif amount < 0:
+                    # remove all bids with logical error, they are at the top of bids
+                    pos = bisect.bisect_left(memBidPrices, price)
+                    for remove in memBidPrices[pos:]:
+                        del memBids[remove]
+                        if self.changed is not None:
+                            changed.add(remove)
+                    del memBidPrices[pos:]
+
+                    if price not in memAsks:
+                        bisect.insort(memAskPrices, price)
+                    memAsks[price] = (count, amount)
                 else:
-                    # remove all orders with logical error
-                    dueToRemove = set()
-                    if amount < 0:
-                        for memPrice in orderbook:
-                            if memPrice >= price and orderbook[memPrice]['amount'] >= 0:
-                                dueToRemove.add(memPrice)
-                    else:
-                        for memPrice in orderbook:
-                            if memPrice <= price and orderbook[memPrice]['amount'] <= 0:
-                                dueToRemove.add(memPrice)
-
-                    for remove in dueToRemove:
-                        del orderbook[remove]
-
-                    orderbook[price] = { 'count': count, 'amount': amount }
+                    # remove all asks with logical error, they are at the top of asks
+                    pos = bisect.bisect_right(memAskPrices, price)
+                    for remove in memAskPrices[:pos]:
+                        del memAsks[remove]
+                        if self.changed is not None:
+                            changed.add(remove)
+                    del memAskPrices[:pos]
+
+                    if price not in memBids:
+                        bisect.insort(memBidPrices, price)
+                    memBids[price] = (count, amount)
+
+                if self.changed is not None:
+                    changed.add(price)
                     
             return channel
 
@@ -99,30 +161,143 @@ class BitfinexState():
     # CHANNEL_SUBSCRIBED: a map of subscribed channel ids vs its name
     # book_[symbol]: a snapshot of the orderbook of [symbol] in the raw format
     def snapshot(self):
-        states = []
-        chvid = dict()
+        return self.snapshot_view()()
+
+    # copy the state and returns a function which serializes the copy
+    # the function can be called in the different thread while this state keeps changing
+    # if incremental, books only contain prices changed since the last snapshot
+    # and removed prices have count of 0
+    def snapshot_view(self, incremental: bool = False):
+        idvch = self.idvch.copy()
+        # list of (chanId, prices in ascending order, map of price vs (count, amount))
+        books = []
+        if incremental and self.changed is not None:
+            for chanId, prices in self.changed.items():
+                orderbook = self.orderbooks[chanId]
+                levels = dict()
+                for price in prices:
+                    if price in orderbook['bids']:
+                        levels[price] = orderbook['bids'][price]
+                    elif price in orderbook['asks']:
+                        levels[price] = orderbook['asks'][price]
+                    else:
+                        levels[price] = (0, 0)
+                books.append((chanId, sorted(prices), levels))
+        else:
+            # elements of sides are tuples and never updated in place
+            for chanId, orderbook in self.orderbooks.items():
+                # price ascending, bids are always below asks
+                prices = orderbook['bidPrices'] + orderbook['askPrices']
+                levels = orderbook['bids'].copy()
+                levels.update(orderbook['asks'])
+                books.append((chanId, prices, levels))
+
+        if self.changed is not None:
+            self.changed = dict()
+
+        def serialize():
+            states = []
+            chvid = dict()
+            for chanId, channel in idvch.items():
+                chvid[channel] = chanId
+            states.append((dumpv2.CHANNEL_SUBSCRIBED, json.dumps(chvid)))
+
+            for chanId, prices, levels in books:
+                orders = []
+                for price in prices:
+                    count, amount = levels[price]
+                    orders.append([price, count, amount])
+                states.append((idvch[chanId], json.dumps(orders)))
+            return states
+
+        return serialize
+
+
+# protocol of standby.StandbyDumper
+# channels are the same as BitfinexState, keys are messages without chanId which differs on each connection
+class BitfinexStandbyProtocol:
+    def __init__(self):
+        # map of chanId vs channel on this connection
+        self.idvch = dict()
+        # chanIds of which the first message, a snapshot, is not yet received
+        self.snapshots = set()
+        # map of chanId on this connection vs chanId in the file, None before takeover
+        self.ids = None
+        # map of channel vs chanId in the file, None before takeover
+        self.file_ids = None
+
+    def send(self, frame: str):
+        pass
+
+    def classify(self, message: str):
+        if message.startswith('{'):
+            obj = dumpv2.json_loads(message)
+            if obj.get('event') != 'subscribed':
+                return (None, None)
+            channel = self.idvch[obj['chanId']] = '%s_%s' % (obj['channel'], obj['symbol'])
+            self.snapshots.add(obj['chanId'])
+            return (channel, None)
+        comma = message.find(',')
+        chanId = int(message[1:comma])
+        if message.startswith('"hb"', comma + 1):
+            return (None, None)
+        channel = self.idvch.get(chanId)
+        if chanId in self.snapshots:
+            self.snapshots.discard(chanId)
+            return (channel, None)
+        return (channel, message[comma:])
+
+    # map of channel vs chanId in the file
+    def channel_ids(self):
+        if self.file_ids is not None:
+            return self.file_ids
+        return { channel: chanId for chanId, channel in self.idvch.items() }
+
+    def channels(self):
+        return set(self.channel_ids())
+
+    def takeover(self, previous):
+        self.file_ids = dict(previous.channel_ids())
+        self.ids = dict()
         for chanId, channel in self.idvch.items():
-            chvid[channel] = chanId
-        states.append((dumpv2.CHANNEL_SUBSCRIBED, json.dumps(chvid)))
+            self.file_id(chanId)
 
-        for chanId, memOrders in self.orderbooks.items():
-            orders = []
-            for price, elem in sorted(memOrders.items()):
-                orders.append([price, elem['count'], elem['amount']])
-            states.append((self.idvch[chanId], json.dumps(orders)))
-        return states
-
-
-def subscribe_gen():
-    # before start dumping, bitfinex has too much currencies so it has channel limitation
-    # we must cherry pick the best one to observe its trade
-    # we can determine this by retrieving trading volumes for each symbol and pick coins which volume is in the most
+    # returns chanId in the file of chanId on this connection, channels the file does not have get unused ones
+    def file_id(self, chanId: int):
+        file_id = self.ids.get(chanId)
+        if file_id is None:
+            channel = self.idvch[chanId]
+            file_id = self.file_ids.get(channel)
+            if file_id is None:
+                used = set(self.file_ids.values())
+                file_id = chanId
+                while file_id in used:
+                    file_id += 1
+                self.file_ids[channel] = file_id
+            self.ids[chanId] = file_id
+        return file_id
+
+    def rewrite(self, message: str):
+        if self.ids is None:
+            return message
+        if message.startswith('{'):
+            obj = dumpv2.json_loads(message)
+            if obj.get('event') != 'subscribed':
+                return message
+            obj['chanId'] = self.file_id(obj['chanId'])
+            return json.dumps(obj, separators=(',', ':'))
+        comma = message.find(',')
+        return '[%d%s' % (self.file_id(int(message[1:comma])), message[comma:])
+
+# returns every trading symbol sorted by USD volume
+def fetch_symbols():
+    # we can determine the best symbols to observe by retrieving trading volumes for each symbol
 
     logger.info('Retrieving market volumes')
 
-    sub_symbols = None
+    symbols = None
 
-    request = urllib.request.Request('https://api.bitfinex.com/v2/tickers?symbols=ALL')
+    request = urllib.request.Request(BITFINEX_TICKERS_URL)
     with urllib.request.urlopen(request, timeout=1) as response:
         tickers = json.load(response)
 
@@ -168,13 +343,22 @@ def subscribe_gen():
         itr = sorted(itr, key=lambda arr: arr[1], reverse=True)
 
         # take only symbol, not an object
-        itr = map(lambda ticker: ticker[0], itr)
-
-        # trim it down to fit a channel limit
-        sub_symbols = list(itr)[:BITFINEX_CHANNEL_LIMIT//2]
+        symbols = list(map(lambda ticker: ticker[0], itr))
 
     logger.info('Retrieving Done')
 
+    return symbols
+
+# symbols are cached so reconnecting does not wait for REST API
+symbols_cache = metadata.MetadataCache(DIR_METADATA, 'bitfinex_symbols', fetch_symbols)
+
+def subscribe_gen(sub_symbols: list = None):
+    if sub_symbols is None:
+        # before start dumping, bitfinex has too much currencies so it has channel limitation
+        # we must cherry pick the best one to observe its trade
+        # trim it down to fit a channel limit
+        sub_symbols = symbols_cache.get()[:BITFINEX_CHANNEL_LIMIT//2]
+
     def subscribe(ws: dumpv2.WebSocketDumper):
         subscribe_obj = dict(
             event='subscribe',
@@ -203,13 +387,80 @@ def subscribe_gen():
 
     return subscribe
 
-def gen():
+# partition of PartitionedWriter which makes a stream for each symbol
+# channel is like trades_tBTCUSD
+def symbol_partition(channel: str):
+    (_, _, symbol) = channel.partition('_')
+    return symbol or None
+
+PARTITIONS = {
+    'channel': dumpv2.channel_partition,
+    'symbol': symbol_partition,
+}
+
+# options are passed to WebSocketDumper, or standby.StandbyDumper with standby_options
+def gen(standby_options: dict = None, **options):
     subscribe = subscribe_gen()
     state = BitfinexState()
-    return dumpv2.WebSocketDumper(DIR, 'bitfinex', 'wss://api-pub.bitfinex.com/ws/2', subscribe, state)
+    if standby_options is not None:
+        return standby.StandbyDumper(DIR, 'bitfinex', BITFINEX_URL, subscribe, state, BitfinexStandbyProtocol, **standby_options, **options)
+    return dumpv2.WebSocketDumper(DIR, 'bitfinex', BITFINEX_URL, subscribe, state, **options)
+
+# returns gen of index-th shard out of count shards
+# each shard has its own connection, state and file prefix
+def gen_shard(index: int, count: int, standby_options: dict = None, **options):
+    def gen():
+        # symbols are split every time it reconnects, so new symbols will be in some shard
+        sub_symbols = dumpv2.shard(symbols_cache.get(), count, index)
+        per_shard = BITFINEX_CHANNEL_LIMIT//2
+        if len(sub_symbols) > per_shard:
+            # channels over the limit are rejected by Bitfinex, the ones of the least volume are left out
+            logger.error('shard %d has %d symbols over the channel limit, %s are not dumped, restart with more shards than %d'
+                % (index, len(sub_symbols), ' '.join(sub_symbols[per_shard:]), count))
+            sub_symbols = sub_symbols[:per_shard]
+        subscribe = subscribe_gen(sub_symbols)
+        state = BitfinexState()
+        if standby_options is not None:
+            return standby.StandbyDumper(DIR, 'bitfinex', BITFINEX_URL, subscribe, state, BitfinexStandbyProtocol, prefix='bitfinex-%d' % index, **standby_options, **options)
+        return dumpv2.WebSocketDumper(DIR, 'bitfinex', BITFINEX_URL, subscribe, state, prefix='bitfinex-%d' % index, **options)
+    return gen
+
+# returns number of shards needed to subscribe every symbol
+# symbols are not evenly split by dumpv2.shard, shards are added until none of them is over the limit
+def shard_count():
+    symbols = symbols_cache.get()
+    per_shard = BITFINEX_CHANNEL_LIMIT//2
+    count = max(1, (len(symbols) + per_shard - 1) // per_shard)
+    while any(len(dumpv2.shard(symbols, count, index)) > per_shard for index in range(count)):
+        count += 1
+    return count
 
 def main():
-    dumpv2.Reconnecter(gen).do()
+    parser = argparse.ArgumentParser(description='dump bitfinex')
+    parser.add_argument('--shards', type=int, default=1, help='number of connections, 0 to subscribe every symbol')
+    parser.add_argument('--partition', choices=list(PARTITIONS), help='write each channel or symbol into its own directory')
+    common.add_writer_arguments(parser)
+    common.add_standby_arguments(parser)
+    common.add_metrics_arguments(parser)
+    common.add_profiling_arguments(parser)
+    args = parser.parse_args()
+    common.start_metrics(args)
+    common.start_profiling(args, 'bitfinex')
+
+    options = common.writer_options(args, 'bitfinex')
+    options['standby_options'] = common.standby_options(args)
+    if args.partition is not None:
+        options['partition'] = PARTITIONS[args.partition]
+
+    try:
+        if args.shards == 1:
+            dumpv2.Reconnecter(lambda: gen(**options)).do()
+        else:
+            count = args.shards or shard_count()
+            gens = [gen_shard(index, count, **options) for index in range(count)]
+            dumpv2.ShardedReconnecter(gens, BITFINEX_CONNECTION_INTERVAL).do()
+    finally:
+        common.close_writer_options(options)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,9 +1,13 @@
 import dumpv2
-from common import DIR
+from common import DIR, DIR_METADATA
+import metadata
+import common
+import standby
 
 import websocket
 import urllib.request
 import json
+import argparse
 
 # prefixes for individual channel
 BITFLYER_CHANNEL_PREFIXES = [
@@ -13,6 +17,12 @@ BITFLYER_CHANNEL_PREFIXES = [
     'lightning_ticker_',
 ]
 
+# head of a normal channel message
+CHANNEL_MESSAGE_PREFIX = '{"jsonrpc":"2.0","method":"channelMessage","params":{"channel":"'
+
+BITFLYER_URL = 'wss://ws.lightstream.bitflyer.com/json-rpc'
+BITFLYER_MARKETS_URL = 'https://api.bitflyer.com/v1/markets'
+
 class BitflyerState:
     def __init__(self):
         # idvch is map of subscribe request id vs channel name
@@ -22,6 +32,13 @@ class BitflyerState:
         self.subscribed = list()
         # orderbook map[channel][asks/bids][price]size
         self.map = dict()
+        # prices changed since the last snapshot map[channel][asks/bids]set of price
+        # None if changes are not tracked
+        self.changed = None
+
+    # start tracking changes for incremental snapshots
+    def track_changes(self):
+        self.changed = dict()
 
     def send(self, message: str):
         obj = json.loads(message)
@@ -31,7 +48,30 @@ class BitflyerState:
         return self.idvch[obj['id']]
 
     def msg(self, message: str):
-        obj = json.loads(message)
+        channel = self.classify(message)
+        if channel is not None:
+            return channel
+        return self.parse(message)
+
+    # returns channel name only by looking at the head of the message
+    # returns None if the message has to be fully decoded
+    def classify(self, message: str):
+        # normal channel message starts with
+        # {"jsonrpc":"2.0","method":"channelMessage","params":{"channel":"[channel]",
+        if not message.startswith(CHANNEL_MESSAGE_PREFIX):
+            return None
+        end = message.find('"', len(CHANNEL_MESSAGE_PREFIX))
+        if end == -1:
+            return None
+        channel = message[len(CHANNEL_MESSAGE_PREFIX):end]
+        if channel.startswith('lightning_board_'):
+            # board and board snapshot update orderbook in memory
+            return None
+        return channel
+
+    # decode the whole message and update state
+    def parse(self, message: str):
+        obj = dumpv2.json_loads(message)
 
         if 'method' in obj:
             if obj['method'] == 'channelMessage':
@@ -43,6 +83,11 @@ class BitflyerState:
 
                 if channel.startswith('lightning_board_snapshot_'):
                     pair = channel[len('lightning_board_snapshot_'):]
+                    if self.changed is not None and pair in self.map:
+                        # every price in the old orderbook could be removed
+                        changed = self.changed.setdefault(pair, { 'asks': set(), 'bids': set() })
+                        changed['asks'].update(self.map[pair]['asks'])
+                        changed['bids'].update(self.map[pair]['bids'])
                     # this is the partial orderbook, don't be confused, this is not a complete snapshot
                     memOrderbook = self.map[pair] = dict()
                     memAsks = memOrderbook['asks'] = dict()
@@ -59,6 +104,11 @@ class BitflyerState:
 
                 msgObj = obj['params']['message']
 
+                if self.changed is not None:
+                    changed = self.changed.setdefault(pair, { 'asks': set(), 'bids': set() })
+                    changed['asks'].update(ask['price'] for ask in msgObj['asks'] if ask['price'] != 0)
+                    changed['bids'].update(bid['price'] for bid in msgObj['bids'] if bid['price'] != 0)
+
                 for ask in msgObj['asks']:
                     if ask['price'] == 0:
                         # itayose market order execution, ignore
@@ -90,23 +140,51 @@ class BitflyerState:
     # lightning_board_snapshot_[symbol]: generated snapshot of orderbooks of [symbol]
     #   in the same format with "message" attribute in raw data
     def snapshot(self):
-        states = []
+        return self.snapshot_view()()
 
-        states.append((dumpv2.CHANNEL_SUBSCRIBED, json.dumps(self.subscribed)))
+    # copy the state and returns a function which serializes the copy
+    # the function can be called in the different thread while this state keeps changing
+    # if incremental, orderbooks only contain prices changed since the last snapshot
+    # and removed prices have size of 0, the same as board messages
+    def snapshot_view(self, incremental: bool = False):
+        subscribed = list(self.subscribed)
+        books = dict()
+        if incremental and self.changed is not None:
+            for pair, changed in self.changed.items():
+                memAsks = self.map[pair]['asks']
+                memBids = self.map[pair]['bids']
+                books[pair] = {
+                    'asks': { price: memAsks.get(price, 0) for price in changed['asks'] },
+                    'bids': { price: memBids.get(price, 0) for price in changed['bids'] },
+                }
+        else:
+            for pair, orderbook in self.map.items():
+                books[pair] = { 'asks': orderbook['asks'].copy(), 'bids': orderbook['bids'].copy() }
+
+        if self.changed is not None:
+            self.changed = dict()
+
+        def serialize():
+            states = []
+
+            states.append((dumpv2.CHANNEL_SUBSCRIBED, json.dumps(subscribed)))
 
-        for pair, orderbook in self.map.items():
-            message = dict()
-            message['asks'] = [ { 'price': price, 'size': size } for price, size in sorted(orderbook['asks'].items()) ]
-            message['bids'] = [ { 'price': price, 'size': size } for price, size in sorted(orderbook['bids'].items(), reverse=True) ]
-            states.append(('lightning_board_snapshot_%s' % pair, json.dumps(message)))
-        return states
+            for pair, orderbook in books.items():
+                message = dict()
+                message['asks'] = [ { 'price': price, 'size': size } for price, size in sorted(orderbook['asks'].items()) ]
+                message['bids'] = [ { 'price': price, 'size': size } for price, size in sorted(orderbook['bids'].items(), reverse=True) ]
+                states.append(('lightning_board_snapshot_%s' % pair, json.dumps(message)))
+            return states
 
+        return serialize
 
-def subscribe_gen():
+
+# returns product codes of every market
+def fetch_product_codes():
     product_codes = None
 
     # get markets
-    request = urllib.request.Request('https://api.bitflyer.com/v1/markets')
+    request = urllib.request.Request(BITFLYER_MARKETS_URL)
 
     with urllib.request.urlopen(request, timeout=1) as response:
         markets = json.load(response)
@@ -115,6 +193,15 @@ def subscribe_gen():
         # convert it to an array of 'product_code'
         product_codes = [obj['product_code'] for obj in markets]
 
+    return product_codes
+
+# product codes are cached so reconnecting does not wait for REST API
+product_codes_cache = metadata.MetadataCache(DIR_METADATA, 'bitflyer_product_codes', fetch_product_codes)
+
+def subscribe_gen(product_codes: list = None):
+    if product_codes is None:
+        product_codes = product_codes_cache.get()
+
     def subscribe(ws: dumpv2.WebSocketDumper):
         # sending subscribe call to the server
         subscribe_obj = dict(
@@ -136,13 +223,109 @@ def subscribe_gen():
 
     return subscribe
 
-def gen():
+# partition of PartitionedWriter which makes a stream for each market
+def symbol_partition(channel: str):
+    for prefix in BITFLYER_CHANNEL_PREFIXES:
+        if channel.startswith(prefix):
+            return channel[len(prefix):]
+    return None
+
+PARTITIONS = {
+    'channel': dumpv2.channel_partition,
+    'symbol': symbol_partition,
+}
+
+# protocol of standby.StandbyDumper
+# channels are the same as BitflyerState, keys are whole channel messages as both connections receive the same ones
+class BitflyerStandbyProtocol:
+    def __init__(self):
+        # map of subscribe request id vs channel
+        self.idvch = dict()
+        # channels of which response to subscribe is received
+        self.subscribed = set()
+
+    def send(self, frame: str):
+        obj = json.loads(frame)
+        self.idvch[obj['id']] = obj['params']['channel']
+
+    def classify(self, message: str):
+        if message.startswith(CHANNEL_MESSAGE_PREFIX):
+            end = message.find('"', len(CHANNEL_MESSAGE_PREFIX))
+            return (message[len(CHANNEL_MESSAGE_PREFIX):end], message)
+        obj = dumpv2.json_loads(message)
+        channel = self.idvch.get(obj.get('id'))
+        if channel is None:
+            return (None, None)
+        self.subscribed.add(channel)
+        return (channel, None)
+
+    def channels(self):
+        return self.subscribed
+
+    def takeover(self, previous):
+        pass
+
+    def rewrite(self, message: str):
+        return message
+
+# options are passed to WebSocketDumper, or standby.StandbyDumper with standby_options
+def gen(standby_options: dict = None, **options):
     subscribe = subscribe_gen()
     state = BitflyerState()
-    return dumpv2.WebSocketDumper(DIR, 'bitflyer', 'wss://ws.lightstream.bitflyer.com/json-rpc', subscribe, state)
+    if standby_options is not None:
+        return standby.StandbyDumper(DIR, 'bitflyer', BITFLYER_URL, subscribe, state, BitflyerStandbyProtocol, **standby_options, **options)
+    return dumpv2.WebSocketDumper(DIR, 'bitflyer', BITFLYER_URL, subscribe, state, **options)
+
+# returns gen of index-th shard out of count shards
+# each shard has its own connection, state and file prefix
+def gen_shard(index: int, count: int, standby_options: dict = None, **options):
+    def gen():
+        subscribe = subscribe_gen(dumpv2.shard(product_codes_cache.get(), count, index))
+        state = BitflyerState()
+        if standby_options is not None:
+            return standby.StandbyDumper(DIR, 'bitflyer', BITFLYER_URL, subscribe, state, BitflyerStandbyProtocol, prefix='bitflyer-%d' % index, **standby_options, **options)
+        return dumpv2.WebSocketDumper(DIR, 'bitflyer', BITFLYER_URL, subscribe, state, prefix='bitflyer-%d' % index, **options)
+    return gen
+
+# returns gen of a connection of product_code only
+def gen_market(product_code: str, standby_options: dict = None, **options):
+    def gen():
+        subscribe = subscribe_gen([product_code])
+        state = BitflyerState()
+        if standby_options is not None:
+            return standby.StandbyDumper(DIR, 'bitflyer', BITFLYER_URL, subscribe, state, BitflyerStandbyProtocol, prefix='bitflyer-%s' % product_code, **standby_options, **options)
+        return dumpv2.WebSocketDumper(DIR, 'bitflyer', BITFLYER_URL, subscribe, state, prefix='bitflyer-%s' % product_code, **options)
+    return gen
 
 def main():
-    dumpv2.Reconnecter(gen).do()
+    parser = argparse.ArgumentParser(description='dump bitflyer')
+    parser.add_argument('--shards', type=int, default=1, help='number of connections, 0 for a connection per market')
+    parser.add_argument('--partition', choices=list(PARTITIONS), help='write each channel or market into its own directory')
+    common.add_writer_arguments(parser)
+    common.add_standby_arguments(parser)
+    common.add_metrics_arguments(parser)
+    common.add_profiling_arguments(parser)
+    args = parser.parse_args()
+    common.start_metrics(args)
+    common.start_profiling(args, 'bitflyer')
+
+    options = common.writer_options(args, 'bitflyer')
+    options['standby_options'] = common.standby_options(args)
+    if args.partition is not None:
+        options['partition'] = PARTITIONS[args.partition]
+
+    try:
+        if args.shards == 1:
+            dumpv2.Reconnecter(lambda: gen(**options)).do()
+        elif args.shards == 0:
+            # markets listed later are not dumped until restarted
+            gens = [gen_market(product_code, **options) for product_code in product_codes_cache.get()]
+            dumpv2.ShardedReconnecter(gens).do()
+        else:
+            gens = [gen_shard(index, args.shards, **options) for index in range(args.shards)]
+            dumpv2.ShardedReconnecter(gens).do()
+    finally:
+        common.close_writer_options(options)
 
 if __name__ == '__main__':
     main()
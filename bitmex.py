@@ -1,20 +1,88 @@
 import dumpv2
 import json
+import bisect
+import argparse
 from common import DIR
+import common
+import standby
 
 import websocket
+import logging
+
+# sorted list with O(log n) insertion if it is installed
+try:
+    from sortedcontainers import SortedList
+except ImportError:
+    # list keeping order with bisect, insertion is O(n)
+    class SortedList(list):
+        def add(self, value):
+            bisect.insort(self, value)
+
+        def remove(self, value):
+            self.pop(bisect.bisect_left(self, value))
+
+        def bisect_left(self, value):
+            return bisect.bisect_left(self, value)
+
+        def bisect_right(self, value):
+            return bisect.bisect_right(self, value)
+
+logger = logging.getLogger('Bitmex')
+
+# bigger than any order id, used to search the price index
+INF = float('inf')
+
+# head of a normal table message
+TABLE_PREFIX = '{"table":"'
+# tables which need to be decoded to update state
+STATEFUL_TABLES = ('orderBookL2', 'instrument')
 
 class BitmexState:
     def __init__(self):
         self.subscribed = list()
+        # map of (symbol, side, id) vs price and size, ordered by insertion
         self.orderbooks = dict()
+        # map of (symbol, side) vs SortedList of (price, id) of orders in self.orderbooks
+        # used to find crossed orders without scanning every order
+        self.indexes = dict()
         self.instruments = dict()
+        # keys of orderbooks and symbols of instruments changed since the last snapshot
+        # None if changes are not tracked
+        self.changed_orders = None
+        self.changed_instruments = None
+
+    # start tracking changes for incremental snapshots
+    def track_changes(self):
+        self.changed_orders = set()
+        self.changed_instruments = set()
 
     def send(self, message: str):
         pass
 
     def msg(self, message: str):
-        obj = json.loads(message)
+        channel = self.classify(message)
+        if channel is not None:
+            return channel
+        return self.parse(message)
+
+    # returns channel name only by looking at the head of the message
+    # returns None if the message has to be fully decoded
+    def classify(self, message: str):
+        # normal table message starts with {"table":"[channel]",
+        if not message.startswith(TABLE_PREFIX):
+            return None
+        end = message.find('"', len(TABLE_PREFIX))
+        if end == -1:
+            return None
+        channel = message[len(TABLE_PREFIX):end]
+        if channel in STATEFUL_TABLES:
+            # these update state in memory
+            return None
+        return channel
+
+    # decode the whole message and update state
+    def parse(self, message: str):
+        obj = dumpv2.json_loads(message)
 
         if 'table' in obj:
             channel = obj['table']
@@ -23,26 +91,49 @@ class BitmexState:
                 if obj['action'] == 'partial' or obj['action'] == 'insert':
                     # orderbook snapshot
                     for elem in obj['data']:
-                        dueToRemove = set()
+                        symbol = elem['symbol']
+                        price = elem['price']
+
+                        # remove all orders of the other side which are crossing this order
+                        # crossed orders are always at the top of the other side
+                        crossed = None
                         if elem['side'] == 'Sell':
-                            for memKey in self.orderbooks:
-                                if memKey[0] == elem['symbol'] \
-                                    and memKey[1] == 'Buy' \
-                                    and self.orderbooks[memKey]['price'] >= elem['price']:
-                                    dueToRemove.add(memKey)
+                            other_side = 'Buy'
+                            other = self.indexes.get((symbol, other_side))
+                            if other:
+                                # buy orders with price >= this price
+                                pos = other.bisect_left((price,))
+                                crossed = other[pos:]
+                                del other[pos:]
                         else:
-                            for memKey in self.orderbooks:
-                                if memKey[0] == elem['symbol'] \
-                                    and memKey[1] == 'Sell' \
-                                    and self.orderbooks[memKey]['price'] <= elem['price']:
-                                    dueToRemove.add(memKey)
+                            other_side = 'Sell'
+                            other = self.indexes.get((symbol, other_side))
+                            if other:
+                                # sell orders with price <= this price
+                                pos = other.bisect_right((price, INF))
+                                crossed = other[:pos]
+                                del other[:pos]
 
-                        for remove in dueToRemove:
-                            print(remove, self.orderbooks[remove])
-                            del self.orderbooks[remove]
+                        if crossed:
+                            for (_, id) in crossed:
+                                remove = (symbol, other_side, id)
+                                logger.debug('crossed order removed %s %s', remove, self.orderbooks[remove])
+                                del self.orderbooks[remove]
+                                if self.changed_orders is not None:
+                                    self.changed_orders.add(remove)
 
-                        key = (elem['symbol'], elem['side'], elem['id'])
-                        self.orderbooks[key] = { 'price': elem['price'], 'size': elem['size'] }
+                        key = (symbol, elem['side'], elem['id'])
+                        index = self.indexes.get((symbol, elem['side']))
+                        if index is None:
+                            index = self.indexes[(symbol, elem['side'])] = SortedList()
+                        if key in self.orderbooks:
+                            # the same id is inserted again, its price might have changed
+                            before = self.orderbooks[key]
+                            index.remove((before['price'], elem['id']))
+                        index.add((price, elem['id']))
+                        self.orderbooks[key] = { 'price': price, 'size': elem['size'] }
+                        if self.changed_orders is not None:
+                            self.changed_orders.add(key)
 
                 elif obj['action'] == 'update':
                     # update order size
@@ -52,18 +143,27 @@ class BitmexState:
                             # key is not in the orderbook
                             continue
                         before = self.orderbooks[key]
+                        # replace, not update, elements could be referenced by snapshot in progress
                         self.orderbooks[key] = { 'price': before['price'], 'size': elem['size'] }
+                        if self.changed_orders is not None:
+                            self.changed_orders.add(key)
                 elif obj['action'] == 'delete':
                     # delete order from orderbook
                     for elem in obj['data']:
                         key = (elem['symbol'], elem['side'], elem['id'])
                         if key in self.orderbooks:
-                            del self.orderbooks[key]
+                            before = self.orderbooks.pop(key)
+                            index = self.indexes[(elem['symbol'], elem['side'])]
+                            index.remove((before['price'], elem['id']))
+                            if self.changed_orders is not None:
+                                self.changed_orders.add(key)
             elif channel == 'instrument':
                 if obj['action'] == 'partial':
                     for elem in obj['data']:
                         # just store the whole element to dict key as symbol
                         self.instruments[elem['symbol']] = elem
+                        if self.changed_instruments is not None:
+                            self.changed_instruments.add(elem['symbol'])
                 elif obj['action'] == 'update':
                     for elem in obj['data']:
                         # update value of element of instrument dict
@@ -72,6 +172,8 @@ class BitmexState:
                             # sometimes, bitmex does not send insert/partial for instruemnts
                             if elem['symbol'] in self.instruments:
                                 self.instruments[elem['symbol']][key] = value
+                        if self.changed_instruments is not None and elem['symbol'] in self.instruments:
+                            self.changed_instruments.add(elem['symbol'])
 
             return channel
 
@@ -91,29 +193,106 @@ class BitmexState:
             return dumpv2.CHANNEL_UNKNOWN
 
     def snapshot(self):
-        states = []
-        # subscribed snapshot
-        states.append((dumpv2.CHANNEL_SUBSCRIBED, json.dumps(self.subscribed)))
-        # orderbook snapshot
-        data = []
-        for (symbol, side, id), elem in self.orderbooks.items():
-            data.append({ 'symbol': symbol, 'side': side, 'id': id, 'price': elem['price'], 'size': elem['size'] })
-        states.append(('orderBookL2', json.dumps(data)))
-
-        # instrument snapshot
-        # symbol key of dict is only for updating
-        # symbol is also included in the value of dict
-        states.append(('instrument', json.dumps(list(self.instruments.values()))))
-        return states
-
-
-def gen():
+        return self.snapshot_view()()
+
+    # copy the state and returns a function which serializes the copy
+    # the function can be called in the different thread while this state keeps changing
+    # if incremental, only orders and instruments changed since the last snapshot are included
+    # and removed orders only have symbol, side and id
+    def snapshot_view(self, incremental: bool = False):
+        subscribed = list(self.subscribed)
+        if incremental and self.changed_orders is not None:
+            orderbooks = { key: self.orderbooks.get(key) for key in self.changed_orders }
+            instruments = [dict(self.instruments[symbol]) for symbol in self.changed_instruments]
+        else:
+            # elements of orderbooks are never updated in place
+            orderbooks = self.orderbooks.copy()
+            instruments = [dict(elem) for elem in self.instruments.values()]
+
+        if self.changed_orders is not None:
+            self.changed_orders = set()
+            self.changed_instruments = set()
+
+        def serialize():
+            states = []
+            # subscribed snapshot
+            states.append((dumpv2.CHANNEL_SUBSCRIBED, json.dumps(subscribed)))
+            # orderbook snapshot
+            data = []
+            for (symbol, side, id), elem in orderbooks.items():
+                if elem is None:
+                    # removed
+                    data.append({ 'symbol': symbol, 'side': side, 'id': id })
+                else:
+                    data.append({ 'symbol': symbol, 'side': side, 'id': id, 'price': elem['price'], 'size': elem['size'] })
+            states.append(('orderBookL2', json.dumps(data)))
+
+            # instrument snapshot
+            # symbol key of dict is only for updating
+            # symbol is also included in the value of dict
+            states.append(('instrument', json.dumps(instruments)))
+            return states
+
+        return serialize
+
+
+BITMEX_URL = 'wss://www.bitmex.com/realtime?subscribe=announcement,chat,connected,funding,' \
+    'instrument,insurance,liquidation,orderBookL2,publicNotifications,settlement,trade'
+
+# protocol of standby.StandbyDumper
+# channels are tables, keys are whole messages as both connections receive the same ones
+class BitmexStandbyProtocol:
+    def __init__(self):
+        # tables of which partial is received
+        self.tables = set()
+
+    def send(self, frame: str):
+        pass
+
+    def classify(self, message: str):
+        if not message.startswith(TABLE_PREFIX):
+            return (None, None)
+        end = message.find('"', len(TABLE_PREFIX))
+        if end == -1:
+            return (None, None)
+        table = message[len(TABLE_PREFIX):end]
+        if '"action":"partial"' in message:
+            self.tables.add(table)
+            return (table, None)
+        return (table, message)
+
+    def channels(self):
+        return self.tables
+
+    def takeover(self, previous):
+        pass
+
+    def rewrite(self, message: str):
+        return message
+
+# options are passed to WebSocketDumper, or standby.StandbyDumper with standby_options
+def gen(standby_options: dict = None, **options):
     state = BitmexState()
-    return dumpv2.WebSocketDumper(DIR, 'bitmex', 'wss://www.bitmex.com/realtime?subscribe=announcement,chat,connected,funding,' \
-               'instrument,insurance,liquidation,orderBookL2,publicNotifications,settlement,trade', None, state)
+    if standby_options is not None:
+        return standby.StandbyDumper(DIR, 'bitmex', BITMEX_URL, None, state, BitmexStandbyProtocol, **standby_options, **options)
+    return dumpv2.WebSocketDumper(DIR, 'bitmex', BITMEX_URL, None, state, **options)
 
 def main():
-    dumpv2.Reconnecter(gen).do()
+    parser = argparse.ArgumentParser(description='dump bitmex')
+    common.add_writer_arguments(parser)
+    common.add_standby_arguments(parser)
+    common.add_metrics_arguments(parser)
+    common.add_profiling_arguments(parser)
+    args = parser.parse_args()
+    common.start_metrics(args)
+    common.start_profiling(args, 'bitmex')
+
+    options = common.writer_options(args, 'bitmex')
+    options['standby_options'] = common.standby_options(args)
+    try:
+        dumpv2.Reconnecter(lambda: gen(**options)).do()
+    finally:
+        common.close_writer_options(options)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,5 +1,77 @@
+import compression
+import metrics
+import profiling
+import recompress
+
 import logging
+import os
 
 DIR = 'dump/'
+# cache of metadata retrieved from REST APIs
+DIR_METADATA = os.path.join(DIR, '.metadata')
+# dictionaries of compression trained by traindict.py
+DIR_DICTIONARY = os.path.join(DIR, '.dictionaries')
+
+logging.basicConfig(format='[%(asctime)s][%(levelname)s] %(message)s', level=logging.INFO)
+
+"""add arguments of options of Writer to parser of main"""
+def add_writer_arguments(parser):
+    parser.add_argument('--compression', choices=compression.BACKENDS, default='gzip', help='compression of files, dictionary trained by traindict.py is used other than gzip')
+    parser.add_argument('--recompress', type=int, metavar='LEVEL', help='write files at the lowest level and recompress them at LEVEL in worker processes')
+    parser.add_argument('--recompress-workers', type=int, default=recompress.Recompressor.DEFAULT_WORKERS, help='number of worker processes recompressing files')
+
+"""returns options of WebSocketDumper from arguments added by add_writer_arguments"""
+def writer_options(args, exchange: str):
+    options = dict()
+    directory = os.path.join(DIR_DICTIONARY, exchange)
+    if args.recompress is not None:
+        options['compressor'] = compression.load(args.compression, directory, 1)
+        options['recompressor'] = recompress.Recompressor(args.recompress_workers, compressor=compression.load(args.compression, directory, args.recompress))
+    elif args.compression != 'gzip':
+        options['compressor'] = compression.load(args.compression, directory)
+    return options
+
+"""release what writer_options made, called when the dumper exits"""
+def close_writer_options(options: dict):
+    recompressor = options.get('recompressor')
+    if recompressor is not None:
+        # files being recompressed are finished, the rest are resumed by markers next time
+        recompressor.shutdown(cancel_futures=True)
+
+"""add arguments of standby.StandbyDumper to parser of main"""
+def add_standby_arguments(parser):
+    parser.add_argument('--standby', action='store_true', help='keep a second connection open which takes over when the active one is closed')
+    parser.add_argument('--rotate', type=float, metavar='MINUTES', help='with --standby, close the active connection every MINUTES to hand over to the standby one')
+
+"""returns options of standby.StandbyDumper from arguments added by add_standby_arguments, None if not in standby mode"""
+def standby_options(args):
+    if not args.standby:
+        return None
+    options = dict()
+    if args.rotate is not None:
+        options['rotate_interval'] = args.rotate * 60
+    return options
+
+"""add arguments of metrics to parser of main"""
+def add_metrics_arguments(parser):
+    parser.add_argument('--stats-interval', type=float, default=metrics.Reporter.DEFAULT_INTERVAL, help='seconds between summaries of metrics in the log')
+    parser.add_argument('--stats-file', help='append a json line of metrics to this file every interval')
+    parser.add_argument('--metrics-port', type=int, help='serve metrics as json on http://localhost:PORT/metrics')
+
+"""start reporting metrics as told by arguments added by add_metrics_arguments"""
+def start_metrics(args):
+    reporter = metrics.Reporter(metrics.REGISTRY, args.stats_interval, args.stats_file).start()
+    if args.metrics_port is not None:
+        metrics.MetricsServer(metrics.REGISTRY, args.metrics_port, reporter).start()
+    return reporter
+
+"""add arguments of profiling to parser of main"""
+def add_profiling_arguments(parser):
+    parser.add_argument('--profile', action='store_true', help='profile from the start, SIGUSR1 starts and stops profiling anyway')
+    parser.add_argument('--profile-interval', type=float, default=profiling.Profiler.DEFAULT_INTERVAL, help='seconds between samples of stacks')
 
-logging.basicConfig(format='[%(asctime)s][%(levelname)s] %(message)s', level=logging.INFO)
\ No newline at end of file
+"""let SIGUSR1 toggle profiling into files named name in DIR, and start it if told by arguments"""
+def start_profiling(args, name: str):
+    profiling.install_signal(DIR, name, args.profile_interval)
+    if args.profile:
+        profiling.start(DIR, name, args.profile_interval)
@@ -0,0 +1,311 @@
+import compression
+import reader
+import recordfmt
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+
+# compacts minute files of a day into one archive, read by reader.read_archive and reader.seek_archive
+#
+# python compact.py dump/bitmex dump/bitfinex --day 2020-09-13 --delete
+#
+# archive is the files of a day concatenated as they are, gzip archive is a valid multi-member gzip
+# index of the archive lists every file with its offset in the archive, time range,
+# channels and whether it starts with a checkpoint, so a day is listed by reading one small file
+# with --by-channel, records are split into an archive of each channel instead,
+# start, err and end lines go to CONTROL_STREAM
+#
+# record counts of the archive are verified against the original files before it is renamed in place,
+# original files are only removed after that
+
+CONTROL_STREAM = reader.CONTROL_STREAM
+
+# returns (start, end) nanoseconds of UTC day in YYYYMMDD
+def day_range(day: str):
+    start = datetime.datetime.strptime(day, '%Y%m%d').replace(tzinfo=datetime.timezone.utc)
+    end = start + datetime.timedelta(days=1)
+    return (int(start.timestamp()) * 1_000_000_000, int(end.timestamp()) * 1_000_000_000)
+
+# returns day in YYYYMMDD of nanoseconds
+def day_of(time: int):
+    return datetime.datetime.fromtimestamp(time // 1_000_000_000, datetime.timezone.utc).strftime('%Y%m%d')
+
+"""returns set of prefixes of files in directory, shards of an exchange have their own prefixes"""
+def list_prefixes(directory: str):
+    prefixes = set()
+    for name in os.listdir(directory):
+        split = compression.split_extension(name)
+        if split is None:
+            continue
+        (prefix, _, time) = split[0].rpartition('_')
+        if time.isdigit():
+            prefixes.add(prefix)
+    return prefixes
+
+"""returns index of a file made by reading it, for files without an index
+
+offsets of checkpoints are not known, whether the file starts with a checkpoint is in 'checkpoint'
+"""
+def scan_index(path: str):
+    index = {
+        'name': os.path.basename(path),
+        'start': None,
+        'end': None,
+        'channels': collections.Counter(),
+        'checkpoints': [],
+        'records': 0,
+    }
+    for record in reader.read_file(path):
+        if index['start'] is None:
+            index['start'] = record.time
+            index['checkpoint'] = record.type == 'start' or record.type == 'state'
+        index['end'] = record.time
+        index['records'] += 1
+        if record.type == 'msg' or record.type == 'send':
+            index['channels'][record.channel] += 1
+        elif record.type == 'state' or record.type == 'diff':
+            index['checkpoints'].append([record.type, record.channel, None, None])
+    if index['start'] is None:
+        # empty file of a crash
+        index['start'] = index['end'] = int(compression.split_extension(path)[0].rpartition('_')[2])
+        index['checkpoint'] = False
+    return index
+
+def count_records(records):
+    return sum(1 for record in records)
+
+# write index of archive next to it, returns path of the index
+def write_archive_index(path: str, prefix: str, day: str, members: list):
+    index_path = path + '.idx'
+    with open(index_path, 'w') as file:
+        json.dump({ 'prefix': prefix, 'day': day, 'members': members }, file, separators=(',', ':'))
+    return index_path
+
+# copy dictionaries of compression of files to the archive directory, archive is read with them
+def copy_dictionaries(directory: str, archive_directory: str):
+    source = os.path.join(directory, compression.DICTIONARY_DIRECTORY)
+    if not os.path.isdir(source):
+        return
+    destination = os.path.join(archive_directory, compression.DICTIONARY_DIRECTORY)
+    os.makedirs(destination, exist_ok=True)
+    for name in os.listdir(source):
+        if name.endswith('.dict') and not os.path.exists(os.path.join(destination, name)):
+            shutil.copy(os.path.join(source, name), os.path.join(destination, name))
+
+"""concatenate files into archive at path, returns members"""
+def write_archive(path: str, files: list, indexes: dict):
+    members = []
+    with open(path, 'wb') as output:
+        for (_, file_path) in files:
+            index = indexes.get(file_path)
+            if index is None:
+                member = scan_index(file_path)
+            else:
+                member = dict(index)
+                member['records'] = count_records(reader.read_file(file_path))
+                member['checkpoint'] = reader.is_checkpoint(file_path, index)
+            with open(file_path, 'rb') as file:
+                data = file.read()
+            member['offset'] = output.tell()
+            member['length'] = len(data)
+            output.write(data)
+            members.append(member)
+    return members
+
+"""split records of files into archives of channels in directory, returns map of channel vs members"""
+def write_channel_archives(directory: str, files: list, indexes: dict, compresslevel: int):
+    os.makedirs(directory, exist_ok=True)
+    outputs = dict()
+    members = collections.defaultdict(list)
+    try:
+        for (_, file_path) in files:
+            index = indexes.get(file_path)
+            checkpoint = reader.is_checkpoint(file_path, index)
+            # tab separated lines and member index of each channel in this file
+            lines = collections.defaultdict(bytearray)
+            parts = dict()
+            for record in reader.read_file(file_path):
+                channel = record.channel if record.channel is not None else CONTROL_STREAM
+                part = parts.get(channel)
+                if part is None:
+                    part = parts[channel] = {
+                        'name': os.path.basename(file_path),
+                        'start': record.time,
+                        'channels': collections.Counter(),
+                        'checkpoints': [],
+                        'records': 0,
+                        'checkpoint': checkpoint,
+                    }
+                part['end'] = record.time
+                part['records'] += 1
+                if record.type == 'msg' or record.type == 'send':
+                    part['channels'][record.channel] += 1
+                elif record.type == 'state' or record.type == 'diff':
+                    part['checkpoints'].append([record.type, record.channel, None, None])
+                lines[channel] += recordfmt.tsv_line(recordfmt.TYPES[record.type.encode()], record.time,
+                    record.channel.encode() if record.channel is not None else None,
+                    record.message.encode() if record.message is not None else None)
+
+            for (channel, part) in parts.items():
+                output = outputs.get(channel)
+                if output is None:
+                    output = outputs[channel] = open(os.path.join(directory, '%s.archive.tmp' % channel), 'wb')
+                data = gzip.compress(lines[channel], compresslevel, mtime=0)
+                part['offset'] = output.tell()
+                part['length'] = len(data)
+                output.write(data)
+                members[channel].append(part)
+    finally:
+        for output in outputs.values():
+            output.close()
+    return members
+
+"""compact files of prefix in directory opened in day (YYYYMMDD), returns summary
+
+original files are removed if delete and the archive is verified
+"""
+def compact_day(directory: str, prefix: str, day: str, by_channel: bool = False, compresslevel: int = 9, delete: bool = False, force: bool = False):
+    logger = logging.getLogger('compact')
+    (start, end) = day_range(day)
+    files = [(time, path) for (time, path) in reader.list_files(directory, prefix) if start <= time < end]
+    summary = { 'directory': directory, 'prefix': prefix, 'day': day, 'files': len(files), 'records': 0, 'bytes': 0, 'archive_bytes': 0 }
+    if len(files) == 0:
+        return summary
+
+    path = reader.archive_path(directory, prefix, day)
+    target = path[:-len('.archive')] if by_channel else path
+    if os.path.exists(target) and not force:
+        logger.info('%s is already compacted', target)
+        summary['files'] = 0
+        return summary
+
+    archive_directory = os.path.join(directory, reader.ARCHIVE_DIRECTORY)
+    os.makedirs(archive_directory, exist_ok=True)
+    copy_dictionaries(directory, archive_directory)
+    indexes = reader.load_indexes(directory, prefix)
+
+    if by_channel:
+        temporary = target + '.tmp'
+        if os.path.exists(temporary):
+            # left by a crash
+            shutil.rmtree(temporary)
+        channels = write_channel_archives(temporary, files, indexes, compresslevel)
+        archives = []
+        for (channel, members) in channels.items():
+            archive = os.path.join(temporary, '%s.archive' % channel)
+            os.replace(archive + '.tmp', archive)
+            write_archive_index(archive, prefix, day, members)
+            archives.append((archive, members))
+        # records of every channel add up to the original files
+        expected = sum(count_records(reader.read_file(file_path)) for (_, file_path) in files)
+        split = sum(member['records'] for (_, members) in archives for member in members)
+        if split != expected:
+            raise ValueError('%s has %d records, original files have %d' % (target, split, expected))
+    else:
+        temporary = path + '.tmp'
+        members = write_archive(temporary, files, indexes)
+        write_archive_index(temporary, prefix, day, members)
+        archives = [(temporary, members)]
+
+    # read the archive back
+    for (archive, members) in archives:
+        for member in members:
+            records = count_records(reader.read_members(archive, [member]))
+            if records != member['records']:
+                raise ValueError('%s of %s has %d records, original file has %d' % (member['name'], archive, records, member['records']))
+        summary['records'] += sum(member['records'] for member in members)
+        summary['archive_bytes'] += os.path.getsize(archive)
+
+    if by_channel:
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        os.replace(temporary, target)
+    else:
+        # index first, archive without index is not listed as compacted
+        os.replace(temporary + '.idx', path + '.idx')
+        os.replace(temporary, path)
+
+    summary['bytes'] = sum(os.path.getsize(file_path) for (_, file_path) in files)
+    if delete:
+        remove_from_manifest(directory, prefix, set(os.path.basename(file_path) for (_, file_path) in files))
+        for (_, file_path) in files:
+            os.remove(file_path)
+            index_path = reader.index_path(file_path)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+    logger.info('compacted %d files of %s into %s', len(files), prefix, target)
+    return summary
+
+"""rewrite manifest of prefix in directory without lines of files of names
+
+a line Writer appends while this rewrites could be lost, the index next to the file is read instead
+"""
+def remove_from_manifest(directory: str, prefix: str, names: set):
+    path = os.path.join(directory, '%s.manifest' % prefix)
+    if not os.path.exists(path):
+        return
+    temporary = path + '.tmp'
+    with open(path) as file, open(temporary, 'w') as output:
+        for line in file:
+            try:
+                name = json.loads(line)['name']
+            except (ValueError, KeyError):
+                # half written line of a crash
+                continue
+            if name not in names:
+                output.write(line)
+    os.replace(temporary, path)
+
+"""returns days in YYYYMMDD of files of prefix in directory, except today which is still being written"""
+def list_days(directory: str, prefix: str):
+    today = day_of(int(datetime.datetime.now(datetime.timezone.utc).timestamp()) * 1_000_000_000)
+    days = set(day_of(time) for (time, _) in reader.list_files(directory, prefix))
+    days.discard(today)
+    return sorted(days)
+
+def main():
+    parser = argparse.ArgumentParser(description='compact minute files of a day into an archive')
+    parser.add_argument('directories', nargs='+', help='dump directories of exchanges')
+    parser.add_argument('--day', action='append', help='UTC day to compact in YYYY-MM-DD, every day before today by default')
+    parser.add_argument('--by-channel', action='store_true', help='write an archive of each channel instead of one of a whole day')
+    parser.add_argument('--compresslevel', type=int, default=9, help='gzip compression level of archives of channels')
+    parser.add_argument('--delete', action='store_true', help='remove original files after the archive is verified')
+    parser.add_argument('--force', action='store_true', help='compact again even if the archive exists')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s][%(levelname)s] %(message)s', level=logging.INFO)
+
+    tasks = []
+    for directory in args.directories:
+        for prefix in sorted(list_prefixes(directory)):
+            days = [day.replace('-', '') for day in args.day] if args.day else list_days(directory, prefix)
+            for day in days:
+                tasks.append((directory, prefix, day))
+
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = { executor.submit(compact_day, directory, prefix, day, args.by_channel, args.compresslevel, args.delete, args.force): (directory, prefix, day) for (directory, prefix, day) in tasks }
+        for future in concurrent.futures.as_completed(futures):
+            (directory, prefix, day) = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                logging.error('failed to compact %s of %s in %s: %s', day, prefix, directory, e)
+                failed += 1
+                continue
+            if summary['files'] > 0:
+                print('%s %s %s: %d files, %d records, %d -> %d bytes' % (directory, prefix, day,
+                    summary['files'], summary['records'], summary['bytes'], summary['archive_bytes']))
+    if failed > 0:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
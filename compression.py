@@ -0,0 +1,211 @@
+import gzip
+import hashlib
+import io
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compression backends of dump files
+#
+# gzip is the default, files are plain gzip
+# zlib and zstd compress with a dictionary trained from previous dumps by traindict.py
+# these files start with an uncompressed header line
+#   DUMPDICT\t<backend>\t<dictionary id>\n
+# followed by zlib streams or zstd frames, one for a whole file or one for each block
+# dictionary is copied next to files written with it, so files can be read wherever they are moved
+
+DICTIONARY_MAGIC = b'DUMPDICT\t'
+# directory next to files where dictionaries are copied
+DICTIONARY_DIRECTORY = '.dictionaries'
+# maximum size of zlib dictionary, it can only refer back this many bytes
+ZLIB_DICTIONARY_SIZE = 32*1024
+
+BACKENDS = ['gzip', 'zlib'] + (['zstd'] if zstandard is not None else [])
+# extension of dump files of each backend, only gzip files are named .gz
+EXTENSIONS = {'gzip': '.gz', 'zlib': '.zz', 'zstd': '.zst'}
+
+"""returns (name without extension, extension) of a dump file, None if name is not of one"""
+def split_extension(name: str):
+    for extension in EXTENSIONS.values():
+        if name.endswith(extension):
+            return (name[:-len(extension)], extension)
+    return None
+
+"""returns id of dictionary, which is a hash of its content"""
+def dictionary_id(dictionary: bytes):
+    return hashlib.sha256(dictionary).hexdigest()[:16]
+
+class GzipCompressor:
+    name = 'gzip'
+    extension = EXTENSIONS['gzip']
+    dictionary_id = None
+
+    def __init__(self, level: int = 9):
+        self.level = level
+
+    # returns stream to write whole file through
+    def open(self, path: str):
+        return gzip.open(path, 'ab', compresslevel=self.level)
+
+    # returns data compressed independently of anything else in the file
+    def compress(self, data: bytes):
+        return gzip.compress(data, self.level, mtime=0)
+
+    # returns bytes written at the beginning of the file in blocks
+    def header(self):
+        return b''
+
+    def install(self, directory: str):
+        pass
+
+class DictionaryCompressor:
+    def __init__(self, dictionary: bytes, level: int):
+        self.dictionary = dictionary
+        self.dictionary_id = dictionary_id(dictionary)
+        self.level = level
+
+    def open(self, path: str):
+        return DictionaryWriter(path, self)
+
+    def header(self):
+        return b'%s%s\t%s\n' % (DICTIONARY_MAGIC, self.name.encode(), self.dictionary_id.encode())
+
+    """copy dictionary to directory of files if it is not there"""
+    def install(self, directory: str):
+        path = os.path.join(directory, DICTIONARY_DIRECTORY, '%s.dict' % self.dictionary_id)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to temporary file and rename it, dictionary is never half written
+        temporary = '%s.tmp' % path
+        with open(temporary, 'wb') as file:
+            file.write(self.dictionary)
+        os.replace(temporary, path)
+
+class ZlibCompressor(DictionaryCompressor):
+    name = 'zlib'
+    extension = EXTENSIONS['zlib']
+
+    def __init__(self, dictionary: bytes, level: int = 9):
+        # zlib only looks back 32KiB, the end of dictionary is the nearest
+        super().__init__(dictionary[-ZLIB_DICTIONARY_SIZE:], level)
+
+    def compressobj(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS, zdict=self.dictionary)
+
+    def compress(self, data: bytes):
+        compressor = self.compressobj()
+        return compressor.compress(data) + compressor.flush()
+
+class ZstdCompressor(DictionaryCompressor):
+    name = 'zstd'
+    extension = EXTENSIONS['zstd']
+
+    # higher levels are too slow to keep up with messages
+    def __init__(self, dictionary: bytes, level: int = 9):
+        if zstandard is None:
+            raise ValueError('zstandard is not installed')
+        super().__init__(dictionary, level)
+        self.zstd = zstandard.ZstdCompressor(level=level, dict_data=zstandard.ZstdCompressionDict(dictionary))
+
+    def compressobj(self):
+        return self.zstd.compressobj()
+
+    def compress(self, data: bytes):
+        return self.zstd.compress(data)
+
+# writes whole file as one zlib stream or zstd frame
+class DictionaryWriter:
+    def __init__(self, path: str, compressor: DictionaryCompressor):
+        self.file = open(path, 'ab')
+        self.file.write(compressor.header())
+        self.compressor = compressor.compressobj()
+
+    def write(self, data: bytes):
+        self.file.write(self.compressor.compress(data))
+
+    def close(self):
+        self.file.write(self.compressor.flush())
+        self.file.close()
+
+# reads consecutive zlib streams
+class ZlibReader(io.RawIOBase):
+    def __init__(self, file, dictionary: bytes):
+        self.file = file
+        self.dictionary = dictionary
+        self.decompressor = zlib.decompressobj(zlib.MAX_WBITS, zdict=dictionary)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.pending) == 0:
+            data = self.decompressor.unused_data or self.file.read(64*1024)
+            if len(data) == 0:
+                return 0
+            if self.decompressor.eof:
+                # next stream starts
+                self.decompressor = zlib.decompressobj(zlib.MAX_WBITS, zdict=self.dictionary)
+            self.pending = self.decompressor.decompress(data)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+"""returns dictionary of id, looked up next to file and in directories"""
+def find_dictionary(id: str, path: str, directories: list = ()):
+    candidates = [os.path.join(os.path.dirname(path), DICTIONARY_DIRECTORY)] + list(directories)
+    for directory in candidates:
+        try:
+            with open(os.path.join(directory, '%s.dict' % id), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            pass
+    raise FileNotFoundError('dictionary %s of %s is not found' % (id, path))
+
+"""returns readable stream of decompressed file, starting from offset of compressed file
+
+file is a binary file opened at the beginning, backend is detected from the header
+if offset is not 0, it has to be the beginning of a block
+dictionary is looked up next to path, which is the name of file by default
+"""
+def open_reader(file, offset: int = 0, directories: list = (), path: str = None):
+    head = file.peek(len(DICTIONARY_MAGIC))[:len(DICTIONARY_MAGIC)]
+    if head != DICTIONARY_MAGIC:
+        file.seek(offset)
+        # reads every following gzip member as well
+        return gzip.GzipFile(fileobj=file, mode='rb')
+
+    (_, name, id) = file.readline().rstrip(b'\n').decode().split('\t')
+    file.seek(max(offset, file.tell()))
+    dictionary = find_dictionary(id, path or file.name, directories)
+    if name == 'zlib':
+        return io.BufferedReader(ZlibReader(file, dictionary))
+    elif name == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstandard is not installed to read %s' % (path or file.name))
+        decompressor = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(dictionary))
+        return io.BufferedReader(decompressor.stream_reader(file, read_across_frames=True))
+    else:
+        raise ValueError('unknown compression %s' % name)
+
+"""returns compressor of backend with the current dictionary in directory, written by traindict.py"""
+def load(backend: str, directory: str, level: int = None):
+    options = dict() if level is None else { 'level': level }
+    if backend == 'gzip':
+        return GzipCompressor(**options)
+    with open(os.path.join(directory, 'current')) as file:
+        id = file.read().strip()
+    with open(os.path.join(directory, '%s.dict' % id), 'rb') as file:
+        dictionary = file.read()
+    if backend == 'zlib':
+        return ZlibCompressor(dictionary, **options)
+    elif backend == 'zstd':
+        return ZstdCompressor(dictionary, **options)
+    else:
+        raise ValueError('unknown compression %s' % backend)
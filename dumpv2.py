@@ -4,34 +4,169 @@ import os
 import websocket
 import gzip
 import time
+from time import perf_counter
 import datetime
 import logging
 import threading
-import queue
+import collections
 import sys
+import json
+import struct
+import zlib
+import concurrent.futures
+
+import compression
+import metrics
+import profiling
+import recordfmt
+
+# use faster json decoder if it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 CHANNEL_UNKNOWN = '!unknown'
 CHANNEL_SUBSCRIBED = "!subscribed"
 
+# types of items passed to writer
+OPEN = 0
+MSG = 1
+SEND = 2
+ERR = 3
+END = 4
+
+# returns time of the first line in lines
+def first_time(lines):
+    start = lines.find(b'\t') + 1
+    end = lines.find(b'\t', start)
+    newline = lines.find(b'\n', start)
+    if end < 0 or newline < end:
+        # end line has no tab after time
+        end = newline
+    return int(lines[start:end])
+
 class Writer():
-    def __init__(self, directory: str, prefix: str, url: str, state):
+    # compression level of gzip
+    DEFAULT_COMPRESSLEVEL = 9
+    # lines are formatted into a buffer and passed to gzip when it gets bigger than this
+    DEFAULT_FLUSH_SIZE = 256*1024
+    # or when this nanoseconds passed since the last flush
+    DEFAULT_FLUSH_INTERVAL = 1_000_000_000
+    # minutes between state snapshots
+    DEFAULT_SNAPSHOT_INTERVAL = 10
+    # minutes between full state snapshots when snapshots are incremental
+    DEFAULT_FULL_SNAPSHOT_INTERVAL = 60
+
+    def __init__(self, directory: str, prefix: str, url: str, state,
+            compresslevel: int = DEFAULT_COMPRESSLEVEL,
+            flush_size: int = DEFAULT_FLUSH_SIZE,
+            flush_interval: int = DEFAULT_FLUSH_INTERVAL,
+            snapshot_interval: int = DEFAULT_SNAPSHOT_INTERVAL,
+            incremental_snapshot: bool = False,
+            full_snapshot_interval: int = DEFAULT_FULL_SNAPSHOT_INTERVAL,
+            index: bool = True,
+            blocks: bool = False,
+            record_format: str = 'tsv',
+            compressor = None,
+            recompressor = None):
         self.directory = directory
         self.prefix = prefix
         self.url = url
         # analyze message and returns what channel it is
         self.state = state
+
+        self.compresslevel = compresslevel
+        # compression backend, gzip of compresslevel if not given
+        self.compressor = compressor or compression.GzipCompressor(compresslevel)
+        # if given, closed files are recompressed by recompress.Recompressor in the background
+        # compresslevel can be low to keep up with messages
+        self.recompressor = recompressor
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
         
         self.stream = None
         self.min_opened = None
         self.last_time = 0
 
+        # formatted lines not yet passed to gzip
+        self.buffer = bytearray()
+        self.flushed_time = 0
+        # map of channel name vs its encoded bytes
+        self.channels = dict()
+
+        # snapshots are serialized in the background from a copy of the state
+        # lines after a snapshot are kept in the buffer until the snapshot is done
+        self.snapshot_interval = snapshot_interval
+        # if incremental, snapshots in between full snapshots only contain changes
+        # they are written as diff lines instead of state lines
+        self.incremental_snapshot = incremental_snapshot
+        self.full_snapshot_interval = full_snapshot_interval
+        if incremental_snapshot:
+            self.state.track_changes()
+        self.snapshot_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshot')
+        # future of snapshot in progress
+        self.snapshot = None
+        # seconds taken to copy and serialize, and bytes of the last snapshot
+        self.snapshot_count = 0
+        self.last_snapshot_copy = 0
+        self.last_snapshot_duration = 0
+        self.last_snapshot_bytes = 0
+
+        # if index, write what the file contains next to it when it is closed
+        # and append it to the manifest of the directory, readers can pick files without decompressing
+        self.index = index
+        # name of the current file
+        self.file_name = None
+        # time of the first and the last line in the current file
+        self.file_start = 0
+        self.file_end = 0
+        # uncompressed bytes passed to gzip in the current file
+        self.position = 0
+        # map of channel name vs number of msg and send lines in the current file
+        self.counts = dict()
+        # list of [type, channel, offset, length] of start, state and diff lines in the current file
+        self.checkpoints = []
+
+        # if blocks, each flush is compressed as an independent gzip member (or zlib stream or zstd frame)
+        # readers can start decompressing from any block, plain gunzip reads it as one stream
+        self.blocks = blocks
+        # list of [compressed offset, uncompressed offset, time of the first line] of blocks in the current file
+        self.block_offsets = []
+        # compressed bytes written to the current file
+        self.compressed_position = 0
+
+        # tsv writes tab separated lines, binary writes records encoded by recordfmt
+        if record_format not in ('tsv', 'binary'):
+            raise ValueError('unknown record format %s' % record_format)
+        self.record_format = record_format
+        self.encoder = recordfmt.Encoder() if record_format == 'binary' else None
+
         self.logger = logging.getLogger('writer')
+        # warnings of every message are logged at most once a minute
+        self.throttle = metrics.Throttle(self.logger)
         self.closed = False
 
+        # metrics are shared by every Writer of the prefix and go on over reconnections
+        group = metrics.REGISTRY.group(prefix)
+        # msg lines of each channel
+        self.messages = group.counters('messages')
+        # channels of StreamState are analyzed and timed by PartitionedWriter
+        self.state_seconds = None if isinstance(state, StreamState) else group.histogram('state_seconds')
+        self.snapshot_seconds = group.histogram('snapshot_seconds')
+        # uncompressed and compressed bytes of closed files
+        file_bytes = self.file_bytes = group.counter('file_bytes')
+        compressed_bytes = self.compressed_bytes = group.counter('compressed_bytes')
+        group.gauge('compression_ratio', lambda: file_bytes.value / compressed_bytes.value if compressed_bytes.value > 0 else 0)
+        self.unknown_channels = group.counter('unknown_channels')
+        self.time_backwards = group.counter('time_backwards')
+
     def no_time_backwards(self, time: int):
         # prevent time from going backwards
         if time < self.last_time:
-            self.logger.warn('time is going backwards??!!!')
+            self.time_backwards.add()
+            self.throttle.warning('backwards', 'time is going backwards??!!!')
             return self.last_time
             # no last_time update
         else:
@@ -39,6 +174,21 @@ class Writer():
             self.last_time = time
             return time
 
+    # pass buffered lines to gzip
+    # if wait, wait for snapshot in progress, otherwise nothing is written until it is done
+    def flush(self, wait: bool = False):
+        if self.snapshot is not None:
+            if not wait and not self.snapshot.done():
+                return
+            self.write_snapshot()
+        if len(self.buffer) > 0:
+            self.write(self.buffer)
+            self.buffer.clear()
+            if self.blocks and self.encoder is not None:
+                # next block can be decoded by itself
+                self.encoder.reset()
+        self.flushed_time = self.last_time
+
     def open(self, time: int):
         if self.closed:
             self.logger.error('already closed')
@@ -57,109 +207,676 @@ class Writer():
             # this shows if this is the first time
             is_first_time = self.stream == None
 
-            # close previous file
-            if not is_first_time:
-                self.stream.flush()
-                self.stream.close()
+            if is_first_time:
+                # make directories if not exist
+                os.makedirs(self.directory, exist_ok=True)
+                # dictionary is kept next to files
+                self.compressor.install(self.directory)
+                if self.recompressor is not None:
+                    # files left by the previous process
+                    self.recompressor.resume(self.directory, self.prefix)
+            else:
+                # close previous file
+                self.close_file()
 
             self.logger.info('making new file')
 
             # this is the first time, open new file
-            file_path = os.path.join(self.directory, '%s_%d.gz' % (self.prefix, time))
-            
-            # make directories if not exist
-            if not os.path.exists(self.directory):
-                os.makedirs(self.directory)
+            self.file_name = '%s_%d%s' % (self.prefix, time, self.compressor.extension)
+            file_path = os.path.join(self.directory, self.file_name)
 
-            # open gzip stream
-            self.stream = gzip.open(file_path, 'at')
+            if self.blocks:
+                # blocks are compressed by write
+                self.stream = open(file_path, 'ab')
+                self.stream.write(self.compressor.header())
+                self.compressed_position = self.stream.tell()
+            else:
+                # open compressed stream
+                self.stream = self.compressor.open(file_path)
 
             # record the time opened
             self.min_opened = time_min
+            self.file_start = time
+            self.position = 0
+
+            if self.encoder is not None:
+                # previous time and channel ids are not carried over to the new file
+                self.encoder.reset(False)
+                self.write_header(recordfmt.MAGIC)
 
             if is_first_time:
                 # write start line
-                self.stream.write('start\t%d\t%s\n' % (time, self.url))
+                url = self.url.encode()
+                if self.compressor.dictionary_id is not None:
+                    # dictionary is needed to read files of this connection
+                    url += b'\t%s:%s' % (self.compressor.name.encode(), self.compressor.dictionary_id.encode())
+                if self.encoder is None:
+                    self.buffer += b'start\t%d\t%s\n' % (time, url)
+                else:
+                    self.encoder.record(self.buffer, recordfmt.START, time, None, url)
+                self.checkpoints.append(['start', None, self.position, len(self.buffer)])
             else:
-                if time_min % 10 == 0:
+                if time_min % self.snapshot_interval == 0:
                     # if this is not the first file and first digit of minute is 0, then
                     # write state snapshot
-                    snapshot = self.state.snapshot()
-                    for (channel, state) in snapshot:
-                        self.stream.writelines(['state\t%s\t%s\t' % (time, channel), state, '\n'])
+                    self.start_snapshot(time, self.incremental_snapshot and time_min % self.full_snapshot_interval != 0)
 
-    """write message"""
-    def msg(self, msg: str, time: int):
-        time = self.no_time_backwards(time)
-        self.open(time)
-        # get channel name
+    def close_file(self):
+        self.flush(True)
+        self.stream.close()
+        self.file_bytes.add(self.position)
+        self.compressed_bytes.add(os.path.getsize(os.path.join(self.directory, self.file_name)))
+        if self.index:
+            try:
+                self.write_index()
+            except Exception:
+                # the file itself is fine, readers fall back to decompressing it
+                self.logger.exception('failed to write index of %s', self.file_name)
+        if self.recompressor is not None:
+            self.recompressor.submit(os.path.join(self.directory, self.file_name))
+        self.counts.clear()
+        self.checkpoints.clear()
+        self.block_offsets.clear()
+
+    # write index of the closed file, and append it to the manifest
+    def write_index(self):
+        index = {
+            'name': self.file_name,
+            'start': self.file_start,
+            'end': self.file_end,
+            'bytes': self.position,
+            # size of the file the offsets of blocks are for
+            'compressed': os.path.getsize(os.path.join(self.directory, self.file_name)),
+            'channels': self.counts,
+            'checkpoints': self.checkpoints,
+            'format': self.record_format,
+        }
+        if self.blocks:
+            index['blocks'] = self.block_offsets
+        line = json.dumps(index, separators=(',', ':'))
+
+        # write to temporary file and rename it, index file is never half written
+        path = os.path.join(self.directory, '%s_%d.idx' % (self.prefix, self.file_start))
+        temporary = '%s.tmp' % path
+        with open(temporary, 'w') as file:
+            file.write(line)
+        os.replace(temporary, path)
+
+        with open(os.path.join(self.directory, '%s.manifest' % self.prefix), 'a') as file:
+            file.write(line + '\n')
+
+    # pass lines to the current file
+    def write(self, lines):
+        profiler = profiling.current
+        if profiler is not None:
+            start = perf_counter()
+        if self.blocks:
+            block = self.compressor.compress(lines)
+            time = first_time(lines) if self.encoder is None else recordfmt.first_time(lines)
+            self.block_offsets.append([self.compressed_position, self.position, time])
+            self.stream.write(block)
+            self.compressed_position += len(block)
+        else:
+            self.stream.write(lines)
+        self.position += len(lines)
+        if profiler is not None:
+            profiler.add('compress', perf_counter() - start)
+
+    # write header of the file, it is not a block
+    def write_header(self, header: bytes):
+        if self.blocks:
+            member = self.compressor.compress(header)
+            self.stream.write(member)
+            self.compressed_position += len(member)
+        else:
+            self.stream.write(header)
+        self.position += len(header)
+
+    def start_snapshot(self, time: int, incremental: bool):
+        start = perf_counter()
+        # copying is done on this thread, state can't change while copying
+        view = self.state.snapshot_view(incremental)
+        self.last_snapshot_copy = perf_counter() - start
+        profiler = profiling.current
+        if profiler is not None:
+            profiler.add('snapshot_copy', self.last_snapshot_copy)
+
+        line_type = b'diff' if incremental else b'state'
+        record_type = recordfmt.DIFF if incremental else recordfmt.STATE
+        binary = self.encoder is not None
+        def serialize():
+            start = perf_counter()
+            lines = bytearray()
+            # [type, channel, offset, length] of each line, offset is relative to the snapshot
+            checkpoints = []
+            for (channel, state) in view():
+                offset = len(lines)
+                if binary:
+                    recordfmt.snapshot_record(lines, record_type, time, channel.encode(), state.encode())
+                else:
+                    lines += b'%s\t%d\t%s\t' % (line_type, time, channel.encode())
+                    lines += state.encode()
+                    lines += b'\n'
+                checkpoints.append([line_type.decode(), channel, offset, len(lines) - offset])
+            duration = perf_counter() - start
+            profiler = profiling.current
+            if profiler is not None:
+                profiler.add('snapshot_serialize', duration)
+            return (lines, checkpoints, duration)
+        self.snapshot = self.snapshot_executor.submit(serialize)
+
+    def write_snapshot(self):
+        (lines, checkpoints, duration) = self.snapshot.result()
+        self.snapshot = None
+        for checkpoint in checkpoints:
+            checkpoint[2] += self.position
+        self.checkpoints += checkpoints
+        if len(lines) > 0:
+            self.write(lines)
+
+        self.snapshot_count += 1
+        self.snapshot_seconds.observe(self.last_snapshot_copy + duration)
+        self.last_snapshot_duration = duration
+        self.last_snapshot_bytes = len(lines)
+        self.logger.info('snapshot took %.3fs to copy and %.3fs to serialize, %d bytes',
+            self.last_snapshot_copy, duration, len(lines))
+
+    def channel_bytes(self, channel: str):
+        encoded = self.channels.get(channel)
+        if encoded is None:
+            encoded = self.channels[channel] = channel.encode()
+        return encoded
+
+    # analyze message and returns its channel name
+    def analyze(self, analyzer, msg: str):
+        start = perf_counter()
         try:
-            channel = self.state.msg(msg)
+            channel = analyzer(msg)
         except Exception:
             self.logger.exception('channel analyzer failed %s', msg)
             channel = CHANNEL_UNKNOWN
+        if self.state_seconds is not None:
+            elapsed = perf_counter() - start
+            self.state_seconds.observe(elapsed)
+            profiler = profiling.current
+            if profiler is not None:
+                profiler.add('state', elapsed)
         if channel is None:
             channel = CHANNEL_UNKNOWN
         if channel == CHANNEL_UNKNOWN:
-            self.logger.warning('unknown channel detected %s', msg)
-        # write a line
-        self.stream.writelines(['msg\t%d\t%s\t' % (time, channel), msg, '\n'])
+            self.unknown_channels.add()
+            self.throttle.warning('unknown', 'unknown channel detected %s', msg)
+        return channel
+
+    """write items of (type, msg, time) at once, returns True if it ended"""
+    def write_batch(self, items):
+        buffer = self.buffer
+        counts = self.counts
+        encoder = self.encoder
+
+        for (type, msg, time) in items:
+            time = self.no_time_backwards(time)
+
+            if (self.stream == None) or (self.min_opened != time // 60_000_000_000):
+                self.open(time)
+            self.file_end = time
+
+            if type == MSG:
+                channel = self.analyze(self.state.msg, msg)
+                counts[channel] = counts.get(channel, 0) + 1
+                self.messages.add(channel)
+                if encoder is None:
+                    buffer += b'msg\t%d\t%s\t' % (time, self.channel_bytes(channel))
+                    buffer += msg.encode()
+                    buffer += b'\n'
+                else:
+                    encoder.record(buffer, recordfmt.MSG, time, channel, msg.encode())
+            elif type == SEND:
+                channel = self.analyze(self.state.send, msg)
+                counts[channel] = counts.get(channel, 0) + 1
+                if encoder is None:
+                    buffer += b'send\t%d\t%s\t' % (time, self.channel_bytes(channel))
+                    buffer += msg.encode()
+                    buffer += b'\n'
+                else:
+                    encoder.record(buffer, recordfmt.SEND, time, channel, msg.encode())
+            elif type == ERR:
+                if encoder is None:
+                    buffer += b'err\t%d\t' % time
+                    buffer += msg.encode()
+                    buffer += b'\n'
+                else:
+                    encoder.record(buffer, recordfmt.ERR, time, None, msg.encode())
+            elif type == END:
+                if encoder is None:
+                    buffer += b'end\t%d\n' % time
+                else:
+                    encoder.record(buffer, recordfmt.END, time)
+
+                self.closed = True
+                self.close_file()
+                self.shutdown()
+                return True
+
+            if len(buffer) >= self.flush_size:
+                self.flush()
+
+        if self.last_time - self.flushed_time >= self.flush_interval:
+            self.flush()
+        return False
+
+    """stop the snapshot thread, called when it ended or failed, a snapshot in progress is dropped"""
+    def shutdown(self):
+        self.snapshot_executor.shutdown(wait=False, cancel_futures=True)
+
+    """write message"""
+    def msg(self, msg: str, time: int):
+        self.write_batch(((MSG, msg, time),))
 
     def send(self, msg: str, time: int):
-        time = self.no_time_backwards(time)
-        self.open(time)
-        # get channel name
+        self.write_batch(((SEND, msg, time),))
+
+    def err(self, msg: str, time: int):
+        self.write_batch(((ERR, msg, time),))
+
+    def end(self, time: int):
+        self.write_batch(((END, None, time),))
+
+# partition of PartitionedWriter which makes a stream for each channel
+def channel_partition(channel: str):
+    return channel
+
+# stream of records which are not of any stream, start, err, end and messages of unknown channel
+CONTROL_STREAM = '!control'
+
+"""state of a stream of PartitionedWriter, channels are analyzed by PartitionedWriter beforehand"""
+class StreamState:
+    def __init__(self, writer, stream: str):
+        self.writer = writer
+        self.stream = stream
+        # channels of msg and send items passed to the Writer of the stream, in order
+        self.channels = collections.deque()
+
+    def msg(self, message: str):
+        return self.channels.popleft()
+
+    def send(self, message: str):
+        return self.channels.popleft()
+
+    def track_changes(self):
+        # changes are tracked by the state of PartitionedWriter
+        pass
+
+    def snapshot_view(self, incremental: bool = False):
+        return self.writer.snapshot_view(self.stream, incremental)
+
+# serializes the copy of the state only once for every stream
+class SharedView:
+    def __init__(self, view):
+        self.view = view
+        self.lock = threading.Lock()
+        self.states = None
+
+    def __call__(self):
+        with self.lock:
+            if self.states is None:
+                self.states = self.view()
+            return self.states
+
+"""writer which writes records of each stream into its own directory
+
+partition maps channel to stream name, or None for the control stream
+records of a stream are written by Writer into directory/stream/prefix_time.gz
+(.zz or .zst if compressed with a dictionary)
+with its own index and checkpoints made from snapshot entries of its channels
+order of records across streams is written into directory/prefix_time.order every minute
+so the whole exchange can be replayed in the original order by reader.replay
+"""
+class PartitionedWriter:
+    # options are passed to Writer of each stream
+    def __init__(self, directory: str, prefix: str, url: str, state, partition = channel_partition, **options):
+        self.directory = directory
+        self.prefix = prefix
+        self.url = url
+        self.state = state
+        self.partition = partition
+        self.options = options
+
+        self.compresslevel = options.get('compresslevel', Writer.DEFAULT_COMPRESSLEVEL)
+        self.snapshot_interval = options.get('snapshot_interval', Writer.DEFAULT_SNAPSHOT_INTERVAL)
+        if options.get('incremental_snapshot', False):
+            self.state.track_changes()
+
+        # map of stream name vs its Writer
+        self.streams = dict()
+        # map of stream name vs items not yet passed to its Writer
+        self.pending = dict()
+        # map of channel vs stream name
+        self.routes = dict()
+
+        # minute in unixtime of the current order file
+        self.minute = None
+        self.last_time = 0
+        # copy of the state at the beginning of the minute, shared by every stream
+        self.view = None
+
+        # order file of the current minute
+        # '=stream\tfile' tells the file of the stream in this minute, state and diff lines at its beginning come first
+        # 'stream\tcount' tells the next count records are from the stream
+        # records written by Writer on its own, start and end except of the control stream, are not counted
+        self.order = None
+        self.order_name = None
+        self.order_start = 0
+        self.order_end = 0
+        self.order_buffer = bytearray()
+        # map of stream name vs its file in the current minute
+        self.order_files = dict()
+        # stream of the current run and the number of records in it
+        self.run_stream = None
+        self.run_count = 0
+
+        self.logger = logging.getLogger('writer')
+        self.throttle = metrics.Throttle(self.logger)
+        self.closed = False
+
+        group = metrics.REGISTRY.group(prefix)
+        self.state_seconds = group.histogram('state_seconds')
+        self.time_backwards = group.counter('time_backwards')
+
+    def no_time_backwards(self, time: int):
+        if time < self.last_time:
+            self.time_backwards.add()
+            self.throttle.warning('backwards', 'time is going backwards??!!!')
+            return self.last_time
+        self.last_time = time
+        return time
+
+    # returns channel, exceptions are logged here and unknown channels are logged by Writer of the stream
+    def analyze(self, analyzer, msg: str):
+        start = perf_counter()
         try:
-            channel = self.state.send(msg)
+            channel = analyzer(msg)
         except Exception:
             self.logger.exception('channel analyzer failed %s', msg)
             channel = CHANNEL_UNKNOWN
+        elapsed = perf_counter() - start
+        self.state_seconds.observe(elapsed)
+        profiler = profiling.current
+        if profiler is not None:
+            profiler.add('state', elapsed)
         if channel is None:
             channel = CHANNEL_UNKNOWN
-        if channel == CHANNEL_UNKNOWN:
-            self.logger.warning('unknown channel detected %s', msg)
-        # write a line
-        self.stream.writelines(['send\t%d\t%s\t' % (time, channel), msg, '\n'])
+        return channel
+
+    def route(self, channel: str):
+        stream = self.routes.get(channel)
+        if stream is None:
+            if channel != CHANNEL_UNKNOWN and channel != CHANNEL_SUBSCRIBED:
+                stream = self.partition(channel)
+            if stream is None:
+                stream = CONTROL_STREAM
+            self.routes[channel] = stream
+        return stream
+
+    # called by StreamState in Writer.open, returns a view of snapshot entries of the stream
+    def snapshot_view(self, stream: str, incremental: bool):
+        if self.view is None:
+            # copied only once in a minute, every stream opened at the beginning of the minute
+            self.view = SharedView(self.state.snapshot_view(incremental))
+        view = self.view
+        def serialize():
+            return [(channel, state) for (channel, state) in view() if self.route(channel) == stream]
+        return serialize
+
+    # returns Writer of the stream with the file of the current minute opened
+    def stream_writer(self, stream: str, time: int):
+        writer = self.streams.get(stream)
+        if writer is None:
+            writer = self.streams[stream] = Writer(os.path.join(self.directory, stream), self.prefix, self.url, StreamState(self, stream), **self.options)
+            self.pending[stream] = []
+        if writer.min_opened != self.minute:
+            self.open_stream(stream, time)
+        return writer
+
+    def open_stream(self, stream: str, time: int):
+        writer = self.streams[stream]
+        # items of the previous minute go to the previous file
+        self.dispatch_stream(stream)
+        is_first_time = writer.stream is None
+        writer.open(time)
+
+        self.write_run()
+        self.order_buffer += b'=%s\t%s\n' % (stream.encode(), writer.file_name.encode())
+        self.order_files[stream] = writer.file_name
+        if is_first_time and stream == CONTROL_STREAM:
+            # start line of the connection
+            self.record_run(CONTROL_STREAM)
+
+    def record_run(self, stream: str):
+        if stream == self.run_stream:
+            self.run_count += 1
+        else:
+            self.write_run()
+            self.run_stream = stream
+            self.run_count = 1
+
+    def write_run(self):
+        if self.run_count > 0:
+            self.order_buffer += b'%s\t%d\n' % (self.run_stream.encode(), self.run_count)
+        self.run_stream = None
+        self.run_count = 0
+
+    # pass pending items to Writer of the stream
+    def dispatch_stream(self, stream: str):
+        items = self.pending[stream]
+        if len(items) > 0:
+            self.pending[stream] = []
+            self.streams[stream].write_batch(items)
+
+    def dispatch(self):
+        for stream, writer in self.streams.items():
+            if len(self.pending[stream]) > 0:
+                self.dispatch_stream(stream)
+            elif writer.stream is not None and self.last_time - writer.flushed_time >= writer.flush_interval:
+                # quiet streams are flushed as well
+                writer.flush()
+        if len(self.order_buffer) > 0:
+            self.order.write(self.order_buffer)
+            self.order_buffer.clear()
+
+    # start a new minute, open new order file
+    def rotate(self, time: int):
+        is_first_time = self.minute is None
+        if is_first_time:
+            os.makedirs(self.directory, exist_ok=True)
+        else:
+            self.dispatch()
+            self.close_order()
+
+        self.minute = time // 60_000_000_000
+        self.view = None
+        self.order_name = '%s_%d.order' % (self.prefix, time)
+        self.order = gzip.open(os.path.join(self.directory, self.order_name), 'ab', compresslevel=self.compresslevel)
+        self.order_start = time
+        self.order_files = dict()
+
+        if is_first_time:
+            self.stream_writer(CONTROL_STREAM, time)
+        elif self.minute % self.snapshot_interval == 0:
+            # every stream starts this minute with its snapshot, made from the copy of the state at this moment
+            for stream in list(self.streams):
+                self.open_stream(stream, time)
+
+    def close_order(self):
+        self.write_run()
+        self.order.write(self.order_buffer)
+        self.order_buffer.clear()
+        self.order.close()
+
+        entry = {
+            'name': self.order_name,
+            'start': self.order_start,
+            'end': self.order_end,
+            'files': self.order_files,
+        }
+        with open(os.path.join(self.directory, '%s.manifest' % self.prefix), 'a') as file:
+            file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    """write items of (type, msg, time) at once, returns True if it ended"""
+    def write_batch(self, items):
+        for (type, msg, time) in items:
+            if self.closed:
+                self.logger.error('already closed')
+                return True
+            time = self.no_time_backwards(time)
+
+            if self.minute != time // 60_000_000_000:
+                self.rotate(time)
+            self.order_end = time
+
+            if type == MSG or type == SEND:
+                channel = self.analyze(self.state.msg if type == MSG else self.state.send, msg)
+                stream = self.route(channel)
+                writer = self.stream_writer(stream, time)
+                writer.state.channels.append(channel)
+            elif type == OPEN:
+                # nothing to write other than the start line
+                self.stream_writer(CONTROL_STREAM, time)
+                continue
+            else:
+                stream = CONTROL_STREAM
+                self.stream_writer(stream, time)
+
+            self.pending[stream].append((type, msg, time))
+            self.record_run(stream)
+
+            if type == END:
+                self.closed = True
+                self.dispatch()
+                for stream, writer in self.streams.items():
+                    if stream != CONTROL_STREAM:
+                        writer.write_batch(((END, None, time),))
+                self.close_order()
+                return True
+
+        self.dispatch()
+        return False
+
+    """stop the snapshot threads of every stream"""
+    def shutdown(self):
+        for writer in self.streams.values():
+            writer.shutdown()
+
+    def open(self, time: int):
+        self.write_batch(((OPEN, None, time),))
+
+    def msg(self, msg: str, time: int):
+        self.write_batch(((MSG, msg, time),))
+
+    def send(self, msg: str, time: int):
+        self.write_batch(((SEND, msg, time),))
 
     def err(self, msg: str, time: int):
-        time = self.no_time_backwards(time)
-        self.open(time)
-        self.stream.writelines(['err\t%d\t' % time, msg, '\n'])
+        self.write_batch(((ERR, msg, time),))
 
     def end(self, time: int):
-        time = self.no_time_backwards(time)
-        self.open(time)
-        # write a line
-        self.stream.write('end\t%s\n' % time)
-        
-        self.closed = True
-        self.stream.flush()
-        self.stream.close()
+        self.write_batch(((END, None, time),))
 
 class MultithreadedWriter(threading.Thread):
-    def __init__(self, directory: str, prefix: str, url: str, state):
+    # bytes of pending messages kept in memory before spilling to disk
+    DEFAULT_MEMORY_LIMIT = 256*1024*1024
+    # rough size of an item in memory except the message itself
+    ITEM_OVERHEAD = 128
+    # header of a spilled item, type, time and length of message
+    SPILL_HEADER = struct.Struct('<BqI')
+
+    # options are passed to Writer, or PartitionedWriter if partition is given
+    def __init__(self, directory: str, prefix: str, url: str, state, memory_limit: int = DEFAULT_MEMORY_LIMIT, partition = None, **options):
         super().__init__()
-        self.writer = Writer(directory, prefix, url, state)
-        self.queue = queue.Queue()
+        if partition is None:
+            self.writer = Writer(directory, prefix, url, state, **options)
+        else:
+            self.writer = PartitionedWriter(directory, prefix, url, state, partition, **options)
+        # items of (type, msg, time)
+        # deque.append and deque.popleft are thread-safe without taking a lock
+        self.queue = collections.deque()
+        # set when an item is put into the queue
+        self.wakeup = threading.Event()
         self.exception = None
 
+        self.memory_limit = memory_limit
+        # bytes put into and taken from the queue
+        # each of them is only updated by one thread
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.items_in = 0
+        self.items_out = 0
+
+        # when the queue is over memory_limit, items are appended to this file instead
+        # until the writer thread reads all of them back
+        self.spill_path = os.path.join(directory, '.%s_%d_%d.overflow' % (prefix, os.getpid(), id(self)))
+        self.spill_lock = threading.Lock()
+        self.spilling = False
+        self.spill_writer = None
+        self.spill_reader = None
+        # bytes appended to and read from the spill file since it was emptied
+        self.spill_written = 0
+        self.spill_read = 0
+
+        # high-water marks
+        self.max_memory_items = 0
+        self.max_memory_bytes = 0
+        self.max_spill_bytes = 0
+        self.spilled_items = 0
+
+        self.logger = logging.getLogger('writer')
+
+        group = metrics.REGISTRY.group(prefix)
+        group.gauge('queue_items', lambda: self.items_in - self.items_out)
+        group.gauge('queue_bytes', lambda: self.bytes_in - self.bytes_out)
+        group.gauge('spill_bytes', lambda: self.spill_written - self.spill_read)
+        # seconds the oldest item of a batch waited to be written
+        self.lag_seconds = group.histogram('lag_seconds')
+
+    # take every item in the memory queue, called by the one writing them
+    def take(self):
+        items = []
+        size = 0
+        while len(self.queue) > 0:
+            item = self.queue.popleft()
+            items.append(item)
+            if item[1] is not None:
+                size += len(item[1])
+        self.bytes_out += size + len(items)*self.ITEM_OVERHEAD
+        self.items_out += len(items)
+        if len(items) > 0:
+            self.lag_seconds.observe((time.time_ns() - items[0][2]) / 1_000_000_000)
+        return items
+
     # this runs in the different thread
     def run_with_exception(self):
         while True:
-            # this will block if there is no item in the queue until it become available
-            item = self.queue.get()
-            if item['type'] == "open":
-                self.writer.open(item['time'])
-            elif item['type'] == "msg":
-                self.writer.msg(item['msg'], item['time'])
-            elif item['type'] == "send":
-                self.writer.send(item['msg'], item['time'])
-            elif item['type'] == "err":
-                self.writer.err(item['msg'], item['time'])
-            elif item['type'] == "end":
-                self.writer.end(item['time'])
+            # this will block until an item is put
+            self.wakeup.wait()
+            # clear before draining, items put after this will set it again
+            self.wakeup.clear()
+
+            # take every item available in one wakeup
+            items = self.take()
+
+            profiler = profiling.current
+            if profiler is not None:
+                start = perf_counter()
+            ended = self.writer.write_batch(items)
+            if profiler is not None:
+                profiler.add('write_batch', perf_counter() - start)
+            if ended:
                 break # end this thread
-            self.queue.task_done()
+
+            if self.spilling:
+                # writer caught up with the memory queue, read spilled items back in order
+                if self.writer.write_batch(self.unspill()):
+                    break
 
     # this runs in the different thread
     def run(self):
@@ -168,41 +885,148 @@ class MultithreadedWriter(threading.Thread):
             self.run_with_exception()
         except Exception as e:
             self.exception = e
+        finally:
+            # snapshot threads are left running if write_batch failed before END
+            self.writer.shutdown()
+            self.close_spill()
+            self.logger.info('writer high-water marks: %d items %d bytes in memory, %d items %d bytes spilled',
+                self.max_memory_items, self.max_memory_bytes, self.spilled_items, self.max_spill_bytes)
 
-    def open(self, time: int):
+    def put(self, item: tuple):
         if self.exception != None: raise Exception("Error occurred on writer thread") from self.exception
-        self.queue.put({ 'type': "open", 'time': time })
+
+        size = self.ITEM_OVERHEAD
+        if item[1] is not None:
+            size += len(item[1])
+        memory_bytes = self.bytes_in - self.bytes_out + size
+
+        if self.spilling or memory_bytes > self.memory_limit:
+            # items must go to the spill file while it has items to keep the order
+            with self.spill_lock:
+                self.spill(item)
+        else:
+            self.queue.append(item)
+            self.bytes_in += size
+            self.items_in += 1
+
+            if memory_bytes > self.max_memory_bytes:
+                self.max_memory_bytes = memory_bytes
+            memory_items = self.items_in - self.items_out
+            if memory_items > self.max_memory_items:
+                self.max_memory_items = memory_items
+
+        # check after append so the writer thread never misses this item
+        if not self.wakeup.is_set():
+            self.wakeup.set()
+
+    # append item to the spill file, called with spill_lock
+    def spill(self, item: tuple):
+        if not self.spilling:
+            self.logger.warning('writer is behind, spilling messages to disk')
+            self.spilling = True
+        if self.spill_writer is None:
+            os.makedirs(os.path.dirname(self.spill_path) or '.', exist_ok=True)
+            self.spill_writer = open(self.spill_path, 'wb')
+            self.spill_reader = open(self.spill_path, 'rb')
+
+        (type, msg, time) = item
+        data = b'' if msg is None else msg.encode('utf-8', 'surrogatepass')
+        self.spill_writer.write(self.SPILL_HEADER.pack(type, time, len(data)))
+        self.spill_writer.write(data)
+        self.spill_written += self.SPILL_HEADER.size + len(data)
+        self.spilled_items += 1
+
+        if self.spill_written - self.spill_read > self.max_spill_bytes:
+            self.max_spill_bytes = self.spill_written - self.spill_read
+
+    # read spilled items back up to memory_limit bytes, this runs in the different thread
+    def unspill(self):
+        items = []
+        with self.spill_lock:
+            if len(self.queue) > 0:
+                # items put before spilling started have to be written first
+                self.wakeup.set()
+                return items
+
+            self.spill_writer.flush()
+            size = 0
+            while self.spill_read < self.spill_written and size < self.memory_limit:
+                (type, time, length) = self.SPILL_HEADER.unpack(self.spill_reader.read(self.SPILL_HEADER.size))
+                data = self.spill_reader.read(length)
+                msg = None if type == OPEN or type == END else data.decode('utf-8', 'surrogatepass')
+                items.append((type, msg, time))
+                self.spill_read += self.SPILL_HEADER.size + length
+                size += length + self.ITEM_OVERHEAD
+
+            if self.spill_read < self.spill_written:
+                # come back for the rest
+                self.wakeup.set()
+            else:
+                # read everything, start over with an empty file
+                self.spill_writer.seek(0)
+                self.spill_writer.truncate()
+                self.spill_reader.seek(0)
+                self.spill_written = 0
+                self.spill_read = 0
+                self.spilling = False
+                self.logger.info('writer caught up, spilled messages are written')
+        return items
+
+    def close_spill(self):
+        with self.spill_lock:
+            if self.spill_writer is not None:
+                self.spill_writer.close()
+                self.spill_reader.close()
+                self.spill_writer = None
+                os.remove(self.spill_path)
+
+    """high-water marks of pending items"""
+    def stats(self):
+        return {
+            'max_memory_items': self.max_memory_items,
+            'max_memory_bytes': self.max_memory_bytes,
+            'max_spill_bytes': self.max_spill_bytes,
+            'spilled_items': self.spilled_items,
+        }
+
+    def open(self, time: int):
+        self.put((OPEN, None, time))
 
     def msg(self, msg: str, time: int):
-        if self.exception != None: raise Exception("Error occurred on writer thread") from self.exception
-        self.queue.put({ 'type': "msg", 'msg': msg,  'time': time })
+        self.put((MSG, msg, time))
 
     def send(self, msg: str, time: int):
-        if self.exception != None: raise Exception("Error occurred on writer thread") from self.exception
-        self.queue.put({ 'type': "send", 'msg': msg, 'time': time })
+        self.put((SEND, msg, time))
 
     def err(self, msg: str, time: int):
-        if self.exception != None: raise Exception("Error occurred on writer thread") from self.exception
-        self.queue.put({ 'type': "err", 'msg': msg, 'time': time })
+        self.put((ERR, msg, time))
 
     def end(self, time: int):
-        if self.exception != None: raise Exception("Error occurred on writer thread") from self.exception
-        self.queue.put({ 'type': "end", 'time': time })
+        self.put((END, None, time))
 
 """dump WebSocket stream"""
 class WebSocketDumper:
-    def __init__(self, dir_dump: str, exchange: str, url: str, subscribe, state):
+    # files are written in dir_dump/exchange/ with prefix, which is exchange if not given
+    # options are passed to Writer
+    def __init__(self, dir_dump: str, exchange: str, url: str, subscribe, state, memory_limit: int = MultithreadedWriter.DEFAULT_MEMORY_LIMIT, prefix: str = None, **options):
         self.url = url
         # called when connected
         self.subscribe = subscribe
+        self.prefix = prefix or exchange
+        # called when connected, before subscribe, set by Reconnecter
+        self.on_connect = None
         
         # create new writer for this dumper
-        self.writer = MultithreadedWriter(os.path.join(dir_dump, exchange), exchange, url, state)
+        self.writer = MultithreadedWriter(os.path.join(dir_dump, exchange), self.prefix, url, state, memory_limit, **options)
         # WebSocketApp for serving WebSocket stream
         self.ws_app = None
         
         self.logger = logging.getLogger('websocket')
 
+        group = metrics.REGISTRY.group(self.prefix)
+        self.received = group.counter('received')
+        self.received_bytes = group.counter('received_bytes')
+
     def send(self, message: str):
         self.ws_app.send(message)
         timestamp = time.time_ns()
@@ -216,17 +1040,23 @@ class WebSocketDumper:
         self.logger.info('Connecting to [%s]...' % self.url)
 
         # listeners
-        def on_close(ws):
+        def on_close(ws, *args):
+            # newer websocket-client passes close status code and message
             self.logger.warn('WebSocket closed for [%s]' % self.url)
             self.writer.end(time.time_ns())
 
         def on_message(ws, message):
             timestamp = time.time_ns()
+            self.received.add()
+            self.received_bytes.add(len(message))
             try:
                 self.writer.msg(message, timestamp)
             except Exception:
                 self.logger.exception("writer msg returned error")
                 ws.close()
+            profiler = profiling.current
+            if profiler is not None:
+                profiler.add('on_message', (time.time_ns() - timestamp) / 1_000_000_000)
 
 
         def on_error(ws, error):
@@ -242,6 +1072,8 @@ class WebSocketDumper:
 
         def on_open(ws):
             self.logger.info('WebSocket opened for [%s]' % self.url)
+            if self.on_connect is not None:
+                self.on_connect()
 
             if self.subscribe != None:
                 try:
@@ -267,40 +1099,117 @@ class WebSocketDumper:
             self.writer.end(time.time_ns())
             raise e
 
+    # close connection from the different thread
+    def close(self):
+        if self.ws_app is not None:
+            self.ws_app.close()
+
 class Reconnecter:
     DEFAULT_RECONNECTION_TIME = 1  # default wait time is 1 second
     MAX_RECONNECTION_TIME = 60  # reconnection time will not be more than this value
 
     def __init__(self, gen_dump):
         self.gen_dump = gen_dump
+        # dumper of the current connection
+        self.dumper = None
+        # set when stop() is called
+        self.stopped = threading.Event()
+        # monotonic time of the last disconnection, None while connected or before the first connection
+        self.disconnected = None
+        # metrics of the prefix of the first dumper
+        self.metrics = None
 
         self.logger = logging.getLogger('reconnector')
 
+    # called by the dumper when connected
+    def connected(self):
+        self.metrics.counter('connections').add()
+        if self.disconnected is not None:
+            self.metrics.counter('reconnects').add()
+            self.metrics.counter('downtime_seconds').add(time.monotonic() - self.disconnected)
+            self.disconnected = None
+
+    # stop reconnecting and close the current connection, called from the different thread
+    def stop(self):
+        self.stopped.set()
+        dumper = self.dumper
+        if dumper is not None:
+            dumper.close()
+
     def do(self):
         # seconds to wait
         time_wait = self.DEFAULT_RECONNECTION_TIME
         # last connection time
         time_connect = None
 
-        while True:
+        while not self.stopped.is_set():
             time_connect = datetime.datetime.utcnow()
 
             try:
-                self.gen_dump().do()
+                self.dumper = self.gen_dump()
+                if self.metrics is None:
+                    self.metrics = metrics.REGISTRY.group(self.dumper.prefix)
+                self.dumper.on_connect = self.connected
+                self.dumper.do()
             except KeyboardInterrupt as e:
                 raise e
             except Exception:
                 self.logger.exception('uncatched error in dumper')
+            self.dumper = None
+            if self.metrics is not None and self.disconnected is None:
+                # includes time waiting to reconnect and failed connections
+                self.disconnected = time.monotonic()
+
+            if self.stopped.is_set():
+                break
 
             # wait seconds not to dead loop
             # wait if disconnected in less than 5 minites from connection
             if ((datetime.datetime.utcnow() - time_connect) / datetime.timedelta(minutes=1) <= 5):
                 # wait
                 self.logger.warn('Waiting %d seconds...' % time_wait)
-                time.sleep(time_wait)
+                self.stopped.wait(time_wait)
 
                 # set wait time as twice as the time before
                 time_wait = min(time_wait*2, self.MAX_RECONNECTION_TIME)
             else:
                 # reset wait time and do not wait
                 time_wait = self.DEFAULT_RECONNECTION_TIME
+
+"""take index-th shard of items split into count shards"""
+def shard(items: list, count: int, index: int):
+    # assigned by hash of the name, an item stays in its shard when the list is refreshed and reordered,
+    # so shards reconnecting at different times never both have it or both miss it
+    return [item for item in items if zlib.crc32(item.encode()) % count == index]
+
+"""run reconnecting dumpers of every gen in its own thread"""
+class ShardedReconnecter:
+    def __init__(self, gen_dumps: list, stagger: float = 0):
+        self.reconnecters = [Reconnecter(gen_dump) for gen_dump in gen_dumps]
+        # seconds to wait between starting shards, for exchanges which limit connection rate
+        self.stagger = stagger
+
+        self.logger = logging.getLogger('reconnector')
+
+    def do(self):
+        threads = []
+        try:
+            for index, reconnecter in enumerate(self.reconnecters):
+                if index > 0:
+                    time.sleep(self.stagger)
+                self.logger.info('Starting shard %d/%d' % (index + 1, len(self.reconnecters)))
+                thread = threading.Thread(target=reconnecter.do, name='shard-%d' % index, daemon=True)
+                thread.start()
+                threads.append(thread)
+
+            for thread in threads:
+                # join with timeout, otherwise KeyboardInterrupt is not delivered
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt as e:
+            self.logger.warn('Got kill command, stopping shards')
+            for reconnecter in self.reconnecters:
+                reconnecter.stop()
+            for thread in threads:
+                thread.join(10)
+            raise e
@@ -0,0 +1,359 @@
+import dumpv2
+import reader
+import compact
+
+import argparse
+import calendar
+import collections
+import concurrent.futures
+import fnmatch
+import json
+import logging
+import os
+import shutil
+import struct
+import time
+
+import numpy as np
+
+# exports trades and orderbook deltas of dumps into columnar arrays
+#
+# python export.py dump/bitmex dump/bitfinex --output export --day 2020-09-13
+#
+# every channel of a day is a directory of .npy files, one for each column
+#   {output}/{prefix}/{day}/{channel}/{column}.npy
+# channels of bitmex are split by symbol like trade_XBTUSD and orderBookL2_XBTUSD,
+# snapshots of bitflyer are in the board channel like lightning_board_BTC_JPY
+# files are decoded in worker processes and appended to columns in order,
+# only a few files are in memory at once
+
+# columns of trades, side is BUY or SELL of the taker, 0 if unknown
+# exchange_time is in nanoseconds, id is 0 for bitmex whose ids are not numbers
+TRADE_COLUMNS = (('time', np.int64), ('exchange_time', np.int64), ('id', np.int64),
+    ('price', np.float64), ('size', np.float64), ('side', np.int8))
+# columns of orderbook deltas, one row for each level
+# price and size are NaN if the exchange does not send them, count is of bitfinex, id is of bitmex
+BOOK_COLUMNS = (('time', np.int64), ('action', np.int8), ('side', np.int8),
+    ('price', np.float64), ('size', np.float64), ('count', np.int64), ('id', np.int64))
+
+BUY = 1
+SELL = -1
+# sides of book
+BID = 1
+ASK = -1
+
+# actions of book
+RESET = 0     # a new connection, the book is empty
+SNAPSHOT = 1  # a level of a snapshot, levels of a snapshot of the same time replace the whole book
+SET = 2       # insert or replace a level
+UPDATE = 3    # update size of an order of bitmex
+DELETE = 4    # delete a level
+
+NAN = float('nan')
+
+"""rows of a channel in lists of each column"""
+class Table:
+    def __init__(self, columns: tuple):
+        self.columns = columns
+        self.lists = tuple([] for _ in columns)
+
+    def append(self, *row):
+        for (values, value) in zip(self.lists, row):
+            values.append(value)
+
+    def arrays(self):
+        return { name: np.array(values, dtype=dtype) for ((name, dtype), values) in zip(self.columns, self.lists) }
+
+"""tables of channels of a file, filtered by patterns of channel names"""
+class Tables(dict):
+    def __init__(self, patterns: list):
+        self.patterns = patterns
+        # a new connection starts in this file, books have to be reset
+        self.reset = None
+
+    # returns table of channel or None if it is not exported
+    def get_table(self, channel: str, columns: tuple):
+        table = self.get(channel)
+        if table is None and channel not in self:
+            if self.patterns and not any(fnmatch.fnmatchcase(channel, pattern) for pattern in self.patterns):
+                table = self[channel] = None
+                return None
+            table = self[channel] = Table(columns)
+            if columns is BOOK_COLUMNS and self.reset is not None:
+                table.append(self.reset, RESET, 0, NAN, NAN, 0, 0)
+        return table
+
+# map of 'YYYY-mm-ddTHH:MM:SS' vs nanoseconds, most trades are in the same second as the previous one
+iso_seconds = dict()
+
+# returns nanoseconds of ISO 8601 time in UTC like 2020-09-13T00:00:00.1234567Z
+def iso_time(text: str):
+    (seconds, _, fraction) = text.rstrip('Z').partition('.')
+    base = iso_seconds.get(seconds)
+    if base is None:
+        if len(iso_seconds) > 100000:
+            iso_seconds.clear()
+        base = iso_seconds[seconds] = calendar.timegm(time.strptime(seconds, '%Y-%m-%dT%H:%M:%S')) * 1_000_000_000
+    if len(fraction) == 0:
+        return base
+    return base + int(fraction[:9].ljust(9, '0'))
+
+# orderBookL2 of bitmex
+BITMEX_ACTIONS = { 'partial': SNAPSHOT, 'insert': SET, 'update': UPDATE, 'delete': DELETE }
+
+def bitmex_book(tables: Tables, time: int, action: int, data: list):
+    for elem in data:
+        table = tables.get_table('orderBookL2_%s' % elem['symbol'], BOOK_COLUMNS)
+        if table is not None:
+            table.append(time, action, BID if elem['side'] == 'Buy' else ASK,
+                elem.get('price', NAN), elem.get('size', NAN), 0, elem['id'])
+
+def bitmex_msg(tables: Tables, record):
+    if record.channel == 'trade':
+        obj = dumpv2.json_loads(record.message)
+        # partial is of trades before subscribing
+        if obj.get('action') != 'insert':
+            return
+        for elem in obj['data']:
+            table = tables.get_table('trade_%s' % elem['symbol'], TRADE_COLUMNS)
+            if table is not None:
+                table.append(record.time, iso_time(elem['timestamp']), 0, elem['price'], elem['size'],
+                    BUY if elem['side'] == 'Buy' else SELL)
+    elif record.channel == 'orderBookL2':
+        obj = dumpv2.json_loads(record.message)
+        action = BITMEX_ACTIONS.get(obj.get('action'))
+        if action is not None:
+            bitmex_book(tables, record.time, action, obj['data'])
+
+def bitmex_state(tables: Tables, record):
+    if record.channel == 'orderBookL2':
+        bitmex_book(tables, record.time, SNAPSHOT, [elem for elem in json.loads(record.message) if 'price' in elem])
+
+def bitfinex_msg(tables: Tables, record):
+    if record.channel.startswith('trades_'):
+        obj = dumpv2.json_loads(record.message)
+        # te is a trade, tu is the same trade with its id, snapshot is of trades before subscribing
+        if type(obj) != list or len(obj) < 3 or obj[1] != 'te':
+            return
+        table = tables.get_table(record.channel, TRADE_COLUMNS)
+        if table is not None:
+            (id, mts, amount, price) = obj[2][:4]
+            table.append(record.time, mts * 1_000_000, id, price, abs(amount), BUY if amount > 0 else SELL)
+    elif record.channel.startswith('book_'):
+        table = tables.get_table(record.channel, BOOK_COLUMNS)
+        if table is None:
+            return
+        obj = dumpv2.json_loads(record.message)
+        if type(obj) != list or type(obj[1]) == str or len(obj[1]) == 0:
+            # event, heartbeat or nothing
+            return
+        orders = obj[1]
+        if type(orders[0]) == list:
+            for (price, count, amount) in orders:
+                table.append(record.time, SNAPSHOT, ASK if amount < 0 else BID, price, abs(amount), count, 0)
+        else:
+            (price, count, amount) = orders
+            # amount of a deleted level is 1 or -1 to tell its side
+            table.append(record.time, DELETE if count == 0 else SET, ASK if amount < 0 else BID,
+                price, 0 if count == 0 else abs(amount), count, 0)
+
+def bitfinex_state(tables: Tables, record):
+    if record.channel.startswith('book_'):
+        table = tables.get_table(record.channel, BOOK_COLUMNS)
+        if table is not None:
+            for (price, count, amount) in json.loads(record.message):
+                table.append(record.time, SNAPSHOT, ASK if amount < 0 else BID, price, abs(amount), count, 0)
+
+def bitflyer_board(table: Table, time: int, message: dict, snapshot: bool):
+    for (side, levels) in ((ASK, message['asks']), (BID, message['bids'])):
+        for level in levels:
+            if level['price'] == 0:
+                # itayose market order execution
+                continue
+            if snapshot:
+                action = SNAPSHOT
+            else:
+                action = DELETE if level['size'] == 0 else SET
+            table.append(time, action, side, level['price'], level['size'], 0, 0)
+
+def bitflyer_msg(tables: Tables, record):
+    if record.channel.startswith('lightning_executions_'):
+        table = tables.get_table(record.channel, TRADE_COLUMNS)
+        if table is None:
+            return
+        obj = dumpv2.json_loads(record.message)
+        if obj.get('method') != 'channelMessage':
+            # response to subscribe
+            return
+        for execution in obj['params']['message']:
+            side = BUY if execution['side'] == 'BUY' else SELL if execution['side'] == 'SELL' else 0
+            table.append(record.time, iso_time(execution['exec_date']), execution['id'], execution['price'], execution['size'], side)
+    elif record.channel.startswith('lightning_board_'):
+        snapshot = record.channel.startswith('lightning_board_snapshot_')
+        pair = record.channel[len('lightning_board_snapshot_' if snapshot else 'lightning_board_'):]
+        table = tables.get_table('lightning_board_%s' % pair, BOOK_COLUMNS)
+        if table is None:
+            return
+        obj = dumpv2.json_loads(record.message)
+        if obj.get('method') == 'channelMessage':
+            bitflyer_board(table, record.time, obj['params']['message'], snapshot)
+
+def bitflyer_state(tables: Tables, record):
+    if record.channel.startswith('lightning_board_snapshot_'):
+        table = tables.get_table('lightning_board_%s' % record.channel[len('lightning_board_snapshot_'):], BOOK_COLUMNS)
+        if table is not None:
+            bitflyer_board(table, record.time, json.loads(record.message), True)
+
+# exchange vs (function of msg records, function of state records)
+EXCHANGES = {
+    'bitmex': (bitmex_msg, bitmex_state),
+    'bitfinex': (bitfinex_msg, bitfinex_state),
+    'bitflyer': (bitflyer_msg, bitflyer_state),
+}
+
+"""returns map of channel vs (kind, map of column vs array) of a file, runs in a worker process
+
+state records at the beginning are exported as snapshots if snapshot,
+later files of a day are made of the same messages
+"""
+def extract_file(exchange: str, path: str, snapshot: bool, patterns: list):
+    (msg, state) = EXCHANGES[exchange]
+    tables = Tables(patterns)
+    started = False
+    for record in reader.read_file(path, types=['start', 'msg', 'state']):
+        if record.type == 'start':
+            started = True
+            tables.reset = record.time
+        elif record.type == 'state':
+            if snapshot and not started:
+                state(tables, record)
+        else:
+            started = True
+            msg(tables, record)
+
+    result = dict()
+    for (channel, table) in tables.items():
+        if table is not None and len(table.lists[0]) > 0:
+            result[channel] = ('book' if table.columns is BOOK_COLUMNS else 'trades', table.arrays())
+    return result
+
+"""appends arrays of columns to .npy files in directory
+
+header is written first with room for any number of rows, and rewritten with the number of rows on close
+files are only open while appending, a day of an exchange has too many channels to keep their columns open
+"""
+class ColumnWriter:
+    HEADER_SIZE = 128
+
+    def __init__(self, directory: str, columns: tuple):
+        os.makedirs(directory, exist_ok=True)
+        self.columns = columns
+        self.paths = [os.path.join(directory, '%s.npy' % name) for (name, _) in columns]
+        self.rows = 0
+        for (path, (_, dtype)) in zip(self.paths, columns):
+            with open(path, 'wb') as file:
+                file.write(self.header(dtype, 0))
+
+    # returns .npy header of version 1.0 padded to HEADER_SIZE
+    def header(self, dtype, rows: int):
+        header = repr({ 'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (rows,) })
+        header = header.ljust(self.HEADER_SIZE - 10 - 1) + '\n'
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+    def append(self, arrays: dict):
+        for (path, (name, dtype)) in zip(self.paths, self.columns):
+            with open(path, 'ab') as file:
+                file.write(arrays[name].astype(dtype, copy=False).tobytes())
+        self.rows += len(arrays[self.columns[0][0]])
+
+    # rewrite headers with the number of rows
+    def close(self):
+        for (path, (_, dtype)) in zip(self.paths, self.columns):
+            with open(path, 'r+b') as file:
+                file.write(self.header(dtype, self.rows))
+
+"""export files of prefix in directory opened in day (YYYYMMDD) into output, returns number of rows of each channel
+
+files are decoded by executor, at most in_flight of them are in memory
+"""
+def export_day(executor, exchange: str, directory: str, prefix: str, day: str, output: str, patterns: list = None, in_flight: int = 8, force: bool = False):
+    logger = logging.getLogger('export')
+    (start, end) = compact.day_range(day)
+    files = [path for (time, path) in reader.list_files(directory, prefix) if start <= time < end]
+    target = os.path.join(output, prefix, day)
+    if len(files) == 0 or (os.path.exists(target) and not force):
+        return dict()
+    temporary = target + '.tmp'
+    if os.path.exists(temporary):
+        # left by a crash
+        shutil.rmtree(temporary)
+
+    writers = dict()
+    kinds = dict()
+    def write(result: dict):
+        for (channel, (kind, arrays)) in result.items():
+            writer = writers.get(channel)
+            if writer is None:
+                writer = writers[channel] = ColumnWriter(os.path.join(temporary, channel), BOOK_COLUMNS if kind == 'book' else TRADE_COLUMNS)
+                kinds[channel] = kind
+            writer.append(arrays)
+
+    try:
+        pending = collections.deque()
+        for (i, path) in enumerate(files):
+            pending.append(executor.submit(extract_file, exchange, path, i == 0, patterns))
+            if len(pending) >= in_flight:
+                write(pending.popleft().result())
+        while len(pending) > 0:
+            write(pending.popleft().result())
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    rows = { channel: writer.rows for (channel, writer) in writers.items() }
+    os.makedirs(temporary, exist_ok=True)
+    with open(os.path.join(temporary, 'index.json'), 'w') as file:
+        json.dump({
+            'prefix': prefix,
+            'day': day,
+            'files': [os.path.basename(path) for path in files],
+            'channels': { channel: { 'kind': kinds[channel], 'rows': count } for (channel, count) in rows.items() },
+        }, file, indent=1)
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.replace(temporary, target)
+    logger.info('exported %d files of %s into %s', len(files), prefix, target)
+    return rows
+
+"""returns map of column vs array of channel of a day exported into output, arrays are memory mapped"""
+def load(output: str, prefix: str, day: str, channel: str):
+    directory = os.path.join(output, prefix, day, channel)
+    return { name[:-len('.npy')]: np.load(os.path.join(directory, name), mmap_mode='r')
+        for name in sorted(os.listdir(directory)) if name.endswith('.npy') }
+
+def main():
+    parser = argparse.ArgumentParser(description='export trades and orderbook deltas into columnar arrays')
+    parser.add_argument('directories', nargs='+', help='dump directories of exchanges')
+    parser.add_argument('--output', required=True, help='directory to write arrays')
+    parser.add_argument('--exchange', choices=list(EXCHANGES), help='exchange of dumps, guessed from prefixes by default')
+    parser.add_argument('--day', action='append', help='UTC day to export in YYYY-MM-DD, every day before today by default')
+    parser.add_argument('--channels', nargs='+', help='patterns of channels to export like trades_* or book_tBTCUSD')
+    parser.add_argument('--force', action='store_true', help='export again even if the day exists')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s][%(levelname)s] %(message)s', level=logging.INFO)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for directory in args.directories:
+            for prefix in sorted(compact.list_prefixes(directory)):
+                # shards have prefixes like bitfinex-0
+                exchange = args.exchange or prefix.partition('-')[0]
+                days = [day.replace('-', '') for day in args.day] if args.day else compact.list_days(directory, prefix)
+                for day in days:
+                    rows = export_day(executor, exchange, directory, prefix, day, args.output, args.channels, 2 * args.workers, args.force)
+                    for (channel, count) in sorted(rows.items()):
+                        print('%s %s %s: %d rows' % (prefix, day, channel, count))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import threading
+import time
+
+"""metadata retrieved by fetch, cached in memory and on disk, refreshed in the background when it gets old"""
+class MetadataCache:
+    # seconds until cached metadata gets old
+    DEFAULT_TTL = 60*60
+
+    def __init__(self, directory: str, name: str, fetch, ttl: float = DEFAULT_TTL):
+        self.path = os.path.join(directory, '%s.json' % name)
+        self.name = name
+        # function which retrieves metadata, must return json serializable value
+        self.fetch = fetch
+        self.ttl = ttl
+
+        self.value = None
+        # unixtime in seconds when value was fetched
+        self.fetched = 0
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+        self.logger = logging.getLogger('metadata')
+
+    """returns cached metadata, fetches it only if there is no cache at all"""
+    def get(self):
+        with self.lock:
+            if self.value is None:
+                self.load()
+            if self.value is None:
+                # nothing to use, have to wait for it
+                self.logger.info('fetching %s' % self.name)
+                self.store(self.fetch())
+            elif time.time() - self.fetched > self.ttl and not self.refreshing:
+                # use old one for now, refresh for the next time
+                self.refreshing = True
+                threading.Thread(target=self.refresh, name='metadata-%s' % self.name, daemon=True).start()
+            return self.value
+
+    def refresh(self):
+        try:
+            self.logger.info('refreshing %s' % self.name)
+            value = self.fetch()
+            with self.lock:
+                self.store(value)
+        except Exception:
+            # keep using the old one
+            self.logger.exception('failed to refresh %s' % self.name)
+        finally:
+            self.refreshing = False
+
+    # read cache file, called with lock
+    def load(self):
+        try:
+            with open(self.path) as file:
+                cache = json.load(file)
+            self.value = cache['value']
+            self.fetched = cache['fetched']
+        except FileNotFoundError:
+            pass
+        except Exception:
+            self.logger.exception('broken cache file %s' % self.path)
+
+    # update and write cache file, called with lock
+    def store(self, value):
+        self.value = value
+        self.fetched = time.time()
+
+        # write to temporary file and rename it, cache file is never half written
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary = '%s.tmp' % self.path
+        with open(temporary, 'w') as file:
+            json.dump({ 'fetched': self.fetched, 'value': value }, file)
+        os.replace(temporary, self.path)
@@ -0,0 +1,295 @@
+import bisect
+import http.server
+import json
+import logging
+import threading
+import time
+
+# counters, histograms and gauges of running dumpers
+# Writer, MultithreadedWriter, WebSocketDumper and Reconnecter register them in REGISTRY under the prefix of files
+# Reporter logs a summary and appends a stats record every interval, MetricsServer serves them over HTTP
+#
+# metrics are updated without locks, each of them is only updated by one thread
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def add(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+"""counters of labels, like messages of each channel"""
+class CounterMap:
+    def __init__(self):
+        self.values = dict()
+
+    def add(self, label: str, n=1):
+        self.values[label] = self.values.get(label, 0) + n
+
+    def snapshot(self):
+        return dict(self.values)
+
+"""value returned by a function, evaluated when it is read"""
+class Gauge:
+    def __init__(self, function):
+        self.function = function
+
+    def snapshot(self):
+        return self.function()
+
+"""histogram of seconds in exponential buckets, from 1 microsecond doubling up to about 2 minutes"""
+class Histogram:
+    BOUNDS = [0.000_001 * 2**i for i in range(28)]
+
+    def __init__(self):
+        # the last bucket is for values over the last bound
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # returns summary of counts, minus counts of since if given
+    # percentiles are upper bounds of buckets
+    def summary(self, since: list = None):
+        counts = self.counts if since is None else [count - previous for (count, previous) in zip(self.counts, since)]
+        total = sum(counts)
+        summary = { 'count': total }
+        for (name, q) in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            seen = 0
+            value = 0
+            for (i, count) in enumerate(counts):
+                seen += count
+                if total > 0 and seen >= total * q:
+                    value = self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+                    break
+            summary[name] = value
+        return summary
+
+    def snapshot(self):
+        summary = self.summary()
+        summary['sum'] = self.sum
+        summary['max'] = self.max
+        return summary
+
+"""metrics of a prefix, returns the existing metric of the same name so they go on over reconnections"""
+class Group:
+    def __init__(self):
+        self.metrics = dict()
+
+    def get(self, name: str, kind):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = kind()
+        return metric
+
+    def counter(self, name: str):
+        return self.get(name, Counter)
+
+    def counters(self, name: str):
+        return self.get(name, CounterMap)
+
+    def histogram(self, name: str):
+        return self.get(name, Histogram)
+
+    # gauge is replaced, the function of the latest connection is read
+    def gauge(self, name: str, function):
+        gauge = self.metrics[name] = Gauge(function)
+        return gauge
+
+    def snapshot(self):
+        snapshot = dict()
+        for (name, metric) in list(self.metrics.items()):
+            try:
+                snapshot[name] = metric.snapshot()
+            except Exception:
+                snapshot[name] = None
+        return snapshot
+
+class Registry:
+    def __init__(self):
+        # map of prefix vs Group
+        self.groups = dict()
+        self.lock = threading.Lock()
+
+    def group(self, prefix: str):
+        with self.lock:
+            group = self.groups.get(prefix)
+            if group is None:
+                group = self.groups[prefix] = Group()
+            return group
+
+    def snapshot(self):
+        return { prefix: group.snapshot() for (prefix, group) in list(self.groups.items()) }
+
+REGISTRY = Registry()
+
+"""logs a message at most once in interval seconds for each key, the number of suppressed ones is told with the next"""
+class Throttle:
+    DEFAULT_INTERVAL = 60
+
+    def __init__(self, logger, interval: float = DEFAULT_INTERVAL):
+        self.logger = logger
+        self.interval = interval
+        # map of key vs (monotonic time logged, number suppressed since)
+        self.logged = dict()
+
+    def log(self, level: int, key: str, message: str, *args):
+        now = time.monotonic()
+        (logged, suppressed) = self.logged.get(key, (None, 0))
+        if logged is not None and now - logged < self.interval:
+            self.logged[key] = (logged, suppressed + 1)
+            return
+        self.logged[key] = (now, 0)
+        if suppressed > 0:
+            message += ' (%d more in the last %ds)'
+            args += (suppressed, int(now - logged))
+        self.logger.log(level, message, *args)
+
+    def warning(self, key: str, message: str, *args):
+        self.log(logging.WARNING, key, message, *args)
+
+"""logs a summary of every group and appends a stats record to path every interval seconds in a thread
+
+stats record is a json line of time in nanoseconds, metrics snapshot,
+rates per second of counters and percentiles of histograms in the interval
+"""
+class Reporter:
+    DEFAULT_INTERVAL = 60
+
+    def __init__(self, registry: Registry = REGISTRY, interval: float = DEFAULT_INTERVAL, path: str = None):
+        self.registry = registry
+        self.interval = interval
+        self.path = path
+        # the latest record
+        self.record = None
+        # map of (prefix, name) vs previous value of counters and buckets of histograms
+        self.previous = dict()
+        self.previous_time = time.monotonic()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger('metrics')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='metrics-reporter', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.report()
+            except Exception:
+                self.logger.exception('failed to report metrics')
+
+    # returns rate of a counter, or a map of rates of a counter map, since the previous report
+    def rate(self, key: tuple, value, elapsed: float):
+        previous = self.previous.get(key)
+        self.previous[key] = value
+        if isinstance(value, dict):
+            previous = previous or dict()
+            return { label: (count - previous.get(label, 0)) / elapsed for (label, count) in value.items() }
+        return (value - (previous or 0)) / elapsed
+
+    def report(self):
+        now = time.monotonic()
+        elapsed = max(now - self.previous_time, 1e-9)
+        self.previous_time = now
+
+        metrics = dict()
+        rates = dict()
+        for (prefix, group) in list(self.registry.groups.items()):
+            metrics[prefix] = group.snapshot()
+            rates[prefix] = dict()
+            for (name, metric) in list(group.metrics.items()):
+                key = (prefix, name)
+                if isinstance(metric, (Counter, CounterMap)):
+                    rates[prefix][name] = self.rate(key, metrics[prefix][name], elapsed)
+                elif isinstance(metric, Histogram):
+                    counts = list(metric.counts)
+                    rates[prefix][name] = metric.summary(self.previous.get(key))
+                    self.previous[key] = counts
+        self.record = { 'time': time.time_ns(), 'interval': elapsed, 'metrics': metrics, 'rates': rates }
+
+        for prefix in sorted(metrics):
+            self.logger.info('%s: %s', prefix, self.summary(metrics[prefix], rates[prefix]))
+        if self.path is not None:
+            with open(self.path, 'a') as file:
+                file.write(json.dumps(self.record, separators=(',', ':')) + '\n')
+
+    # one line of a group, rates of counters, values of gauges and p99 of histograms in the interval
+    # zeros are left out
+    def summary(self, metrics: dict, rates: dict):
+        parts = []
+        for (name, value) in metrics.items():
+            rate = rates.get(name)
+            if isinstance(rate, dict) and 'p99' in rate:
+                if rate['count'] > 0:
+                    parts.append('%s p99 %.6f' % (name, rate['p99']))
+            elif isinstance(rate, dict):
+                rate = sum(rate.values())
+                if rate != 0:
+                    parts.append('%s %.1f/s' % (name, rate))
+            elif rate is not None:
+                if rate != 0:
+                    parts.append('%s %.1f/s' % (name, rate))
+            elif isinstance(value, (int, float)) and value != 0:
+                parts.append('%s %g' % (name, value))
+        return ', '.join(parts) or 'idle'
+
+"""local HTTP server which responds json of the metrics snapshot and the latest record of reporter"""
+class MetricsServer:
+    def __init__(self, registry: Registry = REGISTRY, port: int = 0, reporter: Reporter = None):
+        self.registry = registry
+        self.reporter = reporter
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                response = { 'time': time.time_ns(), 'metrics': server.registry.snapshot() }
+                if server.reporter is not None and server.reporter.record is not None:
+                    response['rates'] = server.reporter.record['rates']
+                    response['interval'] = server.reporter.record['interval']
+                body = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        # only reachable from this host
+        self.server = http.server.ThreadingHTTPServer(('localhost', port), Handler)
+        self.thread = None
+
+    def url(self):
+        return 'http://localhost:%d/metrics' % self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
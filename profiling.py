@@ -0,0 +1,153 @@
+import atexit
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+# opt-in profiling of a running dumper, started by --profile or by sending SIGUSR1, stopped by SIGUSR1 again
+#
+# kill -USR1 <pid>     start, files are written when it is sent again
+#
+# while profiling, stacks of every thread are sampled and written in the collapsed format of flamegraph.pl,
+# {name}_profile_{ns}.folded, one line of 'thread;outer;...;inner count' for each stack
+# hot paths of dumpv2 add their time to stages, written every second as a json line to {name}_profile_{ns}.stages
+# stages are
+#   on_message          callback of WebSocketApp putting a message into the writer queue
+#   state               state.msg and state.send analyzing channels
+#   write_batch         Writer.write_batch of a batch taken from the queue, including state and compress
+#   compress            passing buffered lines to gzip or the compressor
+#   snapshot_copy       copying the state for a snapshot
+#   snapshot_serialize  serializing the copy in the background
+#
+# hooks only read current when not profiling, which is None
+
+# Profiler while profiling
+current = None
+
+class Profiler:
+    # seconds between samples of stacks
+    DEFAULT_INTERVAL = 0.005
+    # seconds between records of stages
+    STAGE_INTERVAL = 1
+
+    def __init__(self, path: str, interval: float = DEFAULT_INTERVAL):
+        # files are path.folded and path.stages
+        self.path = path
+        self.interval = interval
+        # map of collapsed stack vs number of samples
+        self.stacks = dict()
+        self.samples = 0
+        # map of stage vs [count, seconds], updated by hooks
+        self.stages = dict()
+        # stages at the previous record
+        self.previous = dict()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger('profiling')
+
+    """add seconds spent in stage, called by hooks"""
+    def add(self, stage: str, seconds: float):
+        total = self.stages.get(stage)
+        if total is None:
+            total = self.stages[stage] = [0, 0.0]
+        total[0] += 1
+        total[1] += seconds
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.stage_file = open(self.path + '.stages', 'a')
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+        return self
+
+    """stop sampling and write the stacks"""
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write_stages()
+        self.stage_file.close()
+        with open(self.path + '.folded', 'w') as file:
+            for (stack, count) in sorted(self.stacks.items()):
+                file.write('%s %d\n' % (stack, count))
+        self.logger.info('%d samples in %.1fs written to %s.folded and %s.stages',
+            self.samples, time.perf_counter() - self.started, self.path, self.path)
+
+    def run(self):
+        own = threading.get_ident()
+        next_record = time.perf_counter() + self.STAGE_INTERVAL
+        while not self.stopped.wait(self.interval):
+            self.sample(own)
+            if time.perf_counter() >= next_record:
+                next_record += self.STAGE_INTERVAL
+                self.write_stages()
+
+    # take a sample of stacks of every thread but this one
+    def sample(self, own: int):
+        names = { thread.ident: thread.name for thread in threading.enumerate() }
+        for (ident, frame) in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            frames.append(names.get(ident, 'thread-%d' % ident))
+            # root first, semicolons separate frames in the collapsed format
+            stack = ';'.join(reversed(frames))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    # append count and seconds of every stage since the previous record
+    def write_stages(self):
+        record = { 'time': time.time_ns(), 'stages': dict() }
+        for (stage, (count, seconds)) in list(self.stages.items()):
+            (previous_count, previous_seconds) = self.previous.get(stage, (0, 0.0))
+            if count > previous_count:
+                record['stages'][stage] = { 'count': count - previous_count, 'seconds': seconds - previous_seconds }
+            self.previous[stage] = (count, seconds)
+        self.stage_file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.stage_file.flush()
+
+# profiler is created by start and stopped by stop, one at a time in a process
+lock = threading.Lock()
+
+"""start profiling into files named name in directory, does nothing if already profiling"""
+def start(directory: str, name: str, interval: float = Profiler.DEFAULT_INTERVAL):
+    global current
+    with lock:
+        if current is not None:
+            return current
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, '%s_profile_%d' % (name, time.time_ns()))
+        current = Profiler(path, interval).start()
+        current.logger.info('profiling into %s', path)
+        return current
+
+"""stop profiling and write files, does nothing if not profiling"""
+def stop():
+    global current
+    with lock:
+        if current is None:
+            return
+        (profiler, current) = (current, None)
+        profiler.stop()
+
+# files are written when the process exits while profiling
+atexit.register(stop)
+
+def toggle(directory: str, name: str, interval: float = Profiler.DEFAULT_INTERVAL):
+    if current is None:
+        start(directory, name, interval)
+    else:
+        stop()
+
+"""start or stop profiling when the process gets SIGUSR1, must be called from the main thread"""
+def install_signal(directory: str, name: str, interval: float = Profiler.DEFAULT_INTERVAL):
+    def handler(signum, frame):
+        # stopping waits for the sampler, not in the middle of whatever the main thread is doing
+        threading.Thread(target=toggle, args=(directory, name, interval), name='profiling-toggle').start()
+    signal.signal(signal.SIGUSR1, handler)
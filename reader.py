@@ -0,0 +1,472 @@
+import bisect
+import collections
+import gzip
+import io
+import itertools
+import json
+import os
+
+import compression
+import recordfmt
+
+# streaming reader of files written by dumpv2.Writer
+# files are read line by line, whole file is never loaded into memory
+
+# type: start, msg, send, err, state, diff or end
+# time: nanoseconds in unixtime
+# channel: None for start, err and end
+# message: url for start, None for end
+Record = collections.namedtuple('Record', ['type', 'time', 'channel', 'message'])
+
+# types of lines which have channel
+CHANNEL_TYPES = frozenset([b'msg', b'send', b'state', b'diff'])
+# types of lines a file can start with to be a checkpoint
+# state could be restored from these without reading previous files
+CHECKPOINT_TYPES = frozenset([b'start', b'state'])
+
+"""returns list of (time, path) of files of prefix in directory sorted by time"""
+def list_files(directory: str, prefix: str = None):
+    if prefix is None:
+        # Writer uses exchange name as prefix, which is also the name of directory
+        prefix = os.path.basename(os.path.normpath(directory))
+
+    files = dict()
+    for name in os.listdir(directory):
+        split = compression.split_extension(name)
+        if split is None:
+            continue
+        (file_prefix, _, time) = split[0].rpartition('_')
+        if file_prefix != prefix or not time.isdigit():
+            continue
+        # recompression to another backend leaves the old file for a moment, both have the same records
+        files[int(time)] = os.path.join(directory, name)
+    return sorted(files.items())
+
+"""returns map of path vs index of files of prefix in directory
+
+indexes are written by Writer when a file is closed, the file being written
+or files written by an older Writer have no index
+"""
+def load_indexes(directory: str, prefix: str = None):
+    if prefix is None:
+        prefix = os.path.basename(os.path.normpath(directory))
+
+    indexes = dict()
+    try:
+        with open(os.path.join(directory, '%s.manifest' % prefix)) as file:
+            for line in file:
+                try:
+                    index = json.loads(line)
+                except ValueError:
+                    # last line could be half written if the process was killed
+                    continue
+                indexes[os.path.join(directory, index['name'])] = index
+    except FileNotFoundError:
+        pass
+
+    # manifest could lack some of indexes written next to files
+    for (time, path) in list_files(directory, prefix):
+        if path not in indexes:
+            index = read_index(path)
+            if index is not None:
+                indexes[path] = index
+    return indexes
+
+# returns path of the index of the file at path
+def index_path(path: str):
+    return compression.split_extension(path)[0] + '.idx'
+
+"""returns index of the file or None if it does not have one"""
+def read_index(path: str):
+    try:
+        with open(index_path(path)) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+# returns True if the file could contain records of channels, judged by its index
+def has_channels(index: dict, channels):
+    if any(channel in index['channels'] for channel in channels):
+        return True
+    return any(checkpoint[1] in channels for checkpoint in index['checkpoints'])
+
+"""returns list of (time, path) of files which could contain records between start and end of channels"""
+def select_files(directory: str, prefix: str = None, start: int = None, end: int = None, channels=None, indexes: dict = None):
+    files = list_files(directory, prefix)
+    if indexes is None:
+        indexes = load_indexes(directory, prefix)
+
+    selected = []
+    for i, (time, path) in enumerate(files):
+        if end is not None and time >= end:
+            break
+        index = indexes.get(path)
+        if index is None:
+            # have to decompress it to know
+            if start is not None and i + 1 < len(files) and files[i + 1][0] <= start:
+                # records of this file are all before start
+                continue
+        else:
+            if start is not None and index['end'] < start:
+                continue
+            if channels is not None and not has_channels(index, channels):
+                continue
+        selected.append((time, path))
+    return selected
+
+"""returns map of channel vs number of msg and send lines between files of start and end, from indexes"""
+def count_channels(directory: str, prefix: str = None, start: int = None, end: int = None):
+    counts = collections.Counter()
+    for index in load_indexes(directory, prefix).values():
+        if start is not None and index['end'] < start:
+            continue
+        if end is not None and index['start'] >= end:
+            continue
+        counts.update(index['channels'])
+    return counts
+
+# returns a line parser which returns Record or None if it is filtered out
+def line_parser(types=None, channels=None):
+    if types is not None:
+        types = frozenset(type.encode() for type in types)
+    if channels is not None:
+        channels = frozenset(channel.encode() for channel in channels)
+
+    def parse(line: bytes):
+        line = line.rstrip(b'\n')
+        tab = line.find(b'\t')
+        type = line[:tab]
+        if types is not None and type not in types:
+            return None
+
+        if type in CHANNEL_TYPES:
+            (_, time, channel, message) = line.split(b'\t', 3)
+            if channels is not None and channel not in channels:
+                return None
+            return Record(type.decode(), int(time), channel.decode(), message.decode())
+
+        # lines without channel are filtered out if channels are specified
+        if channels is not None:
+            return None
+        if type == b'start':
+            # dictionary of compression could follow url
+            (_, time, url) = line.split(b'\t', 3)[:3]
+            return Record('start', int(time), None, url.decode())
+        elif type == b'err':
+            (_, time, message) = line.split(b'\t', 2)
+            return Record('err', int(time), None, message.decode())
+        elif type == b'end':
+            (_, time) = line.split(b'\t', 1)
+            return Record('end', int(time), None, None)
+        else:
+            raise ValueError('unknown line type %s' % type)
+
+    return parse
+
+# marker of a file being recompressed, made by recompress.Recompressor
+PENDING_SUFFIX = '.pending'
+
+# returns True if compressed offsets in index are of the file at path
+# recompression replaces the file and its index one after the other, offsets are not used in between
+def index_matches(path: str, index: dict):
+    if index is None:
+        return False
+    size = index.get('compressed')
+    if size is None:
+        # index written before sizes were recorded, the marker is there until recompression is done
+        return not os.path.exists(path + PENDING_SUFFIX)
+    try:
+        return os.path.getsize(path) == size
+    except OSError:
+        return False
+
+# returns compressed offset of the last block starting at or before start, 0 if none
+def block_offset(index: dict, start: int):
+    blocks = index.get('blocks') if index is not None else None
+    if not blocks:
+        return 0
+    i = bisect.bisect_right([block[2] for block in blocks], start) - 1
+    # lines of the same time could continue from the previous block
+    while i > 0 and blocks[i][2] == start:
+        i -= 1
+    return blocks[i][0] if i >= 0 else 0
+
+# iterate records in stream of binary records, filtered by types and channels before decoding
+def read_binary(stream, header: bool, types=None, channels=None):
+    if types is not None:
+        types = frozenset(recordfmt.TYPES[type.encode()] for type in types)
+    if channels is not None:
+        channels = frozenset(channel.encode() for channel in channels)
+
+    for (type, time, channel, message) in recordfmt.decode(stream, header):
+        if types is not None and type not in types:
+            continue
+        if channels is not None and channel not in channels:
+            continue
+        if type == recordfmt.START:
+            # dictionary of compression could follow url
+            message = message.split(b'\t', 1)[0]
+        yield Record(recordfmt.TYPE_NAMES[type], time,
+            channel.decode() if channel is not None else None,
+            message.decode() if message is not None else None)
+
+"""iterate records of a file, filtered by types and channels before decoding
+
+if start is given and the file is written in blocks, decompression starts
+from the block containing start, records before start could still be returned
+both tab separated lines and binary records are read
+"""
+def read_file(path: str, types=None, channels=None, start: int = None, index: dict = None):
+    with open(path, 'rb') as file:
+        offset = 0
+        if start is not None:
+            if index is None:
+                index = read_index(path)
+            if index_matches(path, index):
+                offset = block_offset(index, start)
+        yield from read_stream(file, types, channels, offset, index)
+
+# iterate records of a file opened at the beginning, decompression starts from offset of a block
+# path is where dictionary of compression is looked up, name of file by default
+def read_stream(file, types=None, channels=None, offset: int = 0, index: dict = None, path: str = None):
+    with compression.open_reader(file, offset, path=path) as stream:
+        if offset == 0:
+            binary = recordfmt.is_binary(stream)
+        else:
+            # block has no header, format is in the index
+            binary = index.get('format') == 'binary'
+
+        if binary:
+            yield from read_binary(stream, offset == 0, types, channels)
+            return
+
+        parse = line_parser(types, channels)
+        for line in stream:
+            record = parse(line)
+            if record is not None:
+                yield record
+
+"""iterate records of files in directory in time order"""
+def read(directory: str, prefix: str = None, start: int = None, end: int = None, types=None, channels=None):
+    indexes = load_indexes(directory, prefix)
+    for (time, path) in select_files(directory, prefix, start, end, channels, indexes):
+        for record in read_file(path, types, channels, start, indexes.get(path)):
+            if start is not None and record.time < start:
+                continue
+            if end is not None and record.time >= end:
+                return
+            yield record
+
+"""returns True if the file starts with a checkpoint"""
+def is_checkpoint(path: str, index: dict = None):
+    if index is not None:
+        # start or state line at the very beginning
+        header = len(recordfmt.MAGIC) if index.get('format') == 'binary' else 0
+        return any(checkpoint[2] == header and checkpoint[0] in ('start', 'state') for checkpoint in index['checkpoints'])
+    with open(path, 'rb') as file, compression.open_reader(file) as stream:
+        if recordfmt.is_binary(stream):
+            for (type, _, _, _) in recordfmt.decode(stream):
+                return type == recordfmt.START or type == recordfmt.STATE
+            return False
+        line = stream.readline()
+    return line[:line.find(b'\t')] in CHECKPOINT_TYPES
+
+"""iterate records from the nearest checkpoint before time
+
+state lines (or start line of a new connection) come first,
+replay messages until time to get the state at time
+"""
+def seek(directory: str, time: int, prefix: str = None, end: int = None, types=None, channels=None):
+    files = list_files(directory, prefix)
+    indexes = load_indexes(directory, prefix)
+    # find the last file opened before time, and go back to the checkpoint
+    index = None
+    for i in range(len(files) - 1, -1, -1):
+        if files[i][0] <= time and is_checkpoint(files[i][1], indexes.get(files[i][1])):
+            index = i
+            break
+    if index is None:
+        raise ValueError('no checkpoint found before %d' % time)
+
+    for (file_time, path) in files[index:]:
+        if end is not None and file_time >= end:
+            break
+        for record in read_file(path, types, channels):
+            if end is not None and record.time >= end:
+                return
+            yield record
+
+# archives of a day written by compact.py are in this directory next to files
+ARCHIVE_DIRECTORY = 'archive'
+
+"""returns path of archive of prefix of day (YYYYMMDD) in directory, of channel if given"""
+def archive_path(directory: str, prefix: str, day: str, channel: str = None):
+    if channel is None:
+        return os.path.join(directory, ARCHIVE_DIRECTORY, '%s_%s.archive' % (prefix, day))
+    return os.path.join(directory, ARCHIVE_DIRECTORY, '%s_%s' % (prefix, day), '%s.archive' % channel)
+
+"""returns list of (day, path) of archives of prefix in directory sorted by day"""
+def list_archives(directory: str, prefix: str = None):
+    if prefix is None:
+        prefix = os.path.basename(os.path.normpath(directory))
+
+    archives = []
+    try:
+        names = os.listdir(os.path.join(directory, ARCHIVE_DIRECTORY))
+    except FileNotFoundError:
+        return archives
+    for name in names:
+        if not name.endswith('.archive'):
+            continue
+        (archive_prefix, _, day) = name[:-len('.archive')].rpartition('_')
+        if archive_prefix != prefix or not day.isdigit():
+            continue
+        archives.append((day, os.path.join(directory, ARCHIVE_DIRECTORY, name)))
+    archives.sort()
+    return archives
+
+"""returns index of archive, members are files in it sorted by time
+
+member is the index of the file with offset and length in the archive,
+number of records and whether it starts with a checkpoint
+"""
+def read_archive_index(path: str):
+    with open(path + '.idx') as file:
+        return json.load(file)
+
+# returns stream of the content of member in archive file as if it was a file on its own
+def open_member(file, member: dict):
+    file.seek(member['offset'])
+    return io.BufferedReader(io.BytesIO(file.read(member['length'])))
+
+# returns members which could contain records between start and end of channels
+def select_members(members: list, start: int = None, end: int = None, channels=None):
+    if end is not None:
+        members = members[:bisect.bisect_left([member['start'] for member in members], end)]
+    selected = []
+    for member in members:
+        if start is not None and member['end'] < start:
+            continue
+        if channels is not None and not has_channels(member, channels):
+            continue
+        selected.append(member)
+    return selected
+
+# iterate records of members in archive, records before start could still be returned
+def read_members(path: str, members: list, types=None, channels=None, start: int = None):
+    with open(path, 'rb') as file:
+        for member in members:
+            offset = block_offset(member, start) if start is not None else 0
+            yield from read_stream(open_member(file, member), types, channels, offset, member, path)
+
+"""iterate records of archive between start and end, see read"""
+def read_archive(path: str, start: int = None, end: int = None, types=None, channels=None):
+    members = select_members(read_archive_index(path)['members'], start, end, channels)
+    for record in read_members(path, members, types, channels, start):
+        if start is not None and record.time < start:
+            continue
+        if end is not None and record.time >= end:
+            return
+        yield record
+
+"""iterate records of archive from the nearest checkpoint before time, see seek"""
+def seek_archive(path: str, time: int, end: int = None, types=None, channels=None):
+    members = read_archive_index(path)['members']
+    i = bisect.bisect_right([member['start'] for member in members], time) - 1
+    while i >= 0 and not members[i]['checkpoint']:
+        i -= 1
+    if i < 0:
+        raise ValueError('no checkpoint found before %d in %s' % (time, path))
+
+    selected = select_members(members[i:], None, end)
+    for record in read_members(path, selected, types, channels):
+        if end is not None and record.time >= end:
+            return
+        yield record
+
+"""returns list of (time, path) of order files of a dump written by PartitionedWriter"""
+def list_order_files(directory: str, prefix: str = None):
+    if prefix is None:
+        prefix = os.path.basename(os.path.normpath(directory))
+
+    files = []
+    for name in os.listdir(directory):
+        if not name.endswith('.order'):
+            continue
+        (file_prefix, _, time) = name[:-len('.order')].rpartition('_')
+        if file_prefix != prefix or not time.isdigit():
+            continue
+        files.append((int(time), os.path.join(directory, name)))
+    files.sort()
+    return files
+
+# control stream of PartitionedWriter, see dumpv2.CONTROL_STREAM
+CONTROL_STREAM = '!control'
+# types of records counted in order files
+COUNTED_TYPES = frozenset(['msg', 'send'])
+CONTROL_COUNTED_TYPES = frozenset(['start', 'msg', 'send', 'err', 'end'])
+
+"""iterate records of a dump written by PartitionedWriter in the original order
+
+state and diff lines of every stream at the beginning of a minute come first,
+then records of every stream in the order they were received
+"""
+def replay(directory: str, prefix: str = None, start: int = None, end: int = None, types=None):
+    if prefix is None:
+        prefix = os.path.basename(os.path.normpath(directory))
+    if types is not None:
+        types = frozenset(types)
+
+    # records to yield, filtered by time and types
+    def select(records):
+        for record in records:
+            if start is not None and record.time < start:
+                continue
+            if types is not None and record.type not in types:
+                continue
+            yield record
+
+    files = list_order_files(directory, prefix)
+    for i, (time, path) in enumerate(files):
+        if end is not None and time >= end:
+            break
+        if start is not None and i + 1 < len(files) and files[i + 1][0] <= start:
+            continue
+
+        # map of stream vs (iterator of its records, counted types)
+        streams = dict()
+
+        with gzip.open(path, 'rb') as order:
+            for line in order:
+                line = line.rstrip(b'\n').decode()
+                if line.startswith('='):
+                    (stream, name) = line[1:].split('\t')
+                    records = read_file(os.path.join(directory, stream, name))
+                    # yield checkpoint at the beginning of the file and keep the first record after it
+                    checkpoint = []
+                    first = None
+                    for record in records:
+                        if record.type != 'state' and record.type != 'diff':
+                            first = record
+                            break
+                        checkpoint.append(record)
+                    yield from select(checkpoint)
+                    if first is not None:
+                        records = itertools.chain((first,), records)
+                    counted = CONTROL_COUNTED_TYPES if stream == CONTROL_STREAM else COUNTED_TYPES
+                    streams[stream] = (records, counted)
+                else:
+                    (stream, count) = line.split('\t')
+                    (records, counted) = streams[stream]
+                    run = []
+                    for record in records:
+                        if record.type not in counted:
+                            # written by Writer on its own
+                            continue
+                        run.append(record)
+                        if len(run) == int(count):
+                            break
+                    for record in select(run):
+                        if end is not None and record.time >= end:
+                            return
+                        yield record
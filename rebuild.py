@@ -0,0 +1,625 @@
+import dumpv2
+import reader
+
+import argparse
+import datetime
+import json
+import os
+import time
+
+import numpy as np
+
+# offline reconstruction of L2 orderbooks from dumps
+#
+# python rebuild.py dump/bitmex XBTUSD --start 2020-09-13T00:00 --end 2020-09-13T01:00 --interval 0.1 --depth 10 --output book.npz
+#
+# messages of an orderbook are decoded once into arrays of operations on levels,
+# which are applied to arrays of the whole book in batches between sample times
+# it follows the logic of BitmexState, BitfinexState and BitflyerState exactly,
+# including the removal of crossed levels, batches which could cross are applied one by one
+
+# operations
+SET = 0     # set level of price, insert order of bitmex
+DELETE = 1  # delete level or order
+UPDATE = 2  # update size of order if it exists, bitmex only
+REMOVE = 3  # delete level of price from whichever side has it, bitfinex only
+CLEAR = 4   # clear the whole book, a new connection or a snapshot of bitflyer
+
+# sides
+BID = 0
+ASK = 1
+
+"""arrays of operations, in the order of records
+
+key is order id of bitmex, count is number of orders of bitfinex
+"""
+class Ops:
+    COLUMNS = (('time', np.int64), ('op', np.int8), ('side', np.int8), ('key', np.int64),
+        ('price', np.float64), ('size', np.float64), ('count', np.int64))
+
+    def __init__(self):
+        for (name, _) in self.COLUMNS:
+            setattr(self, name, [])
+
+    def __len__(self):
+        return len(self.time)
+
+    def append(self, time: int, op: int, side: int = BID, key: int = 0, price: float = 0, size: float = 0, count: int = 0):
+        self.time.append(time)
+        self.op.append(op)
+        self.side.append(side)
+        self.key.append(key)
+        self.price.append(price)
+        self.size.append(size)
+        self.count.append(count)
+
+    # returns copy of operations in arrays and clears lists
+    def arrays(self):
+        arrays = Ops()
+        for (name, dtype) in self.COLUMNS:
+            setattr(arrays, name, np.array(getattr(self, name), dtype=dtype))
+            setattr(self, name, [])
+        return arrays
+
+# returns time of operations of record, the latest time of records so far
+# times could go back a little, a sample waits for the first later record
+def record_time(latest: int, record):
+    if latest is None or record.time > latest:
+        return record.time
+    return latest
+
+"""yields arrays of operations of the orderbook of symbol in orderBookL2 of bitmex
+
+state records are applied only at the beginning, later ones are made of the same messages
+"""
+def decode_bitmex(records, symbol: str, chunk_size: int):
+    ops = Ops()
+    started = False
+    time = None
+    for record in records:
+        time = record_time(time, record)
+        if record.type == 'start':
+            started = True
+            ops.append(time, CLEAR)
+        elif record.type == 'state':
+            if started or record.channel != 'orderBookL2':
+                continue
+            ops.append(time, CLEAR)
+            for elem in json.loads(record.message):
+                if elem['symbol'] == symbol:
+                    ops.append(time, SET, BID if elem['side'] == 'Buy' else ASK, elem['id'], elem['price'], elem['size'])
+        elif record.type == 'msg':
+            started = True
+            if record.channel != 'orderBookL2':
+                continue
+            obj = dumpv2.json_loads(record.message)
+            action = obj.get('action')
+            if action == 'partial' or action == 'insert':
+                op = SET
+            elif action == 'update':
+                op = UPDATE
+            elif action == 'delete':
+                op = DELETE
+            else:
+                continue
+            for elem in obj['data']:
+                if elem['symbol'] != symbol:
+                    continue
+                side = BID if elem['side'] == 'Buy' else ASK
+                ops.append(time, op, side, elem['id'], elem.get('price', 0), elem.get('size', 0))
+        if len(ops) >= chunk_size:
+            yield ops.arrays()
+    yield ops.arrays()
+
+"""yields arrays of operations of book channel of bitfinex, like book_tBTCUSD"""
+def decode_bitfinex(records, channel: str, chunk_size: int):
+    ops = Ops()
+    started = False
+    time = None
+    # chanId of the channel, the book starts over if it is subscribed again with another id
+    chan_id = None
+    for record in records:
+        time = record_time(time, record)
+        if record.type == 'start':
+            started = True
+            chan_id = None
+            ops.append(time, CLEAR)
+        elif record.type == 'state':
+            if started:
+                continue
+            if record.channel == dumpv2.CHANNEL_SUBSCRIBED:
+                chan_id = json.loads(record.message).get(channel)
+            elif record.channel == channel:
+                ops.append(time, CLEAR)
+                for (price, count, amount) in json.loads(record.message):
+                    ops.append(time, SET, ASK if amount < 0 else BID, 0, price, amount, count)
+        elif record.type == 'msg':
+            started = True
+            if record.channel != channel:
+                continue
+            obj = dumpv2.json_loads(record.message)
+            if type(obj) == dict:
+                if obj.get('event') == 'subscribed' and obj['chanId'] != chan_id:
+                    chan_id = obj['chanId']
+                    ops.append(time, CLEAR)
+                continue
+            if obj[0] != chan_id or type(obj[1]) == str:
+                # heartbeat
+                continue
+            orders = obj[1]
+            if len(orders) == 0:
+                continue
+            if type(orders[0]) != list:
+                orders = [orders]
+            for (price, count, amount) in orders:
+                if count == 0:
+                    ops.append(time, REMOVE, BID, 0, price)
+                else:
+                    ops.append(time, SET, ASK if amount < 0 else BID, 0, price, amount, count)
+        if len(ops) >= chunk_size:
+            yield ops.arrays()
+    yield ops.arrays()
+
+# append operations of asks and bids of a board message of bitflyer
+def board_ops(ops: Ops, time: int, message: dict):
+    for (side, levels) in ((ASK, message['asks']), (BID, message['bids'])):
+        for level in levels:
+            if level['price'] == 0:
+                # itayose market order execution
+                continue
+            ops.append(time, DELETE if level['size'] == 0 else SET, side, 0, level['price'], level['size'])
+
+"""yields arrays of operations of the orderbook of product code of bitflyer, like BTC_JPY"""
+def decode_bitflyer(records, pair: str, chunk_size: int):
+    board = 'lightning_board_%s' % pair
+    snapshot = 'lightning_board_snapshot_%s' % pair
+    ops = Ops()
+    started = False
+    # board messages are ignored until the first snapshot
+    initialized = False
+    time = None
+    for record in records:
+        time = record_time(time, record)
+        if record.type == 'start':
+            started = True
+            initialized = False
+            ops.append(time, CLEAR)
+        elif record.type == 'state':
+            if started or record.channel != snapshot:
+                continue
+            initialized = True
+            ops.append(time, CLEAR)
+            board_ops(ops, time, json.loads(record.message))
+        elif record.type == 'msg':
+            started = True
+            if record.channel != snapshot and (record.channel != board or not initialized):
+                continue
+            obj = dumpv2.json_loads(record.message)
+            if obj.get('method') != 'channelMessage':
+                # response to subscribe
+                continue
+            if record.channel == snapshot:
+                initialized = True
+                ops.append(time, CLEAR)
+            board_ops(ops, time, obj['params']['message'])
+        if len(ops) >= chunk_size:
+            yield ops.arrays()
+    yield ops.arrays()
+
+"""orderbook of price levels of bitfinex and bitflyer on a sorted grid of every price seen
+
+present[side][i] tells if there is a level of prices[i] on side, its size and count are valid only if present
+if crossing, a level removes levels of the other side crossing it as BitfinexState does
+"""
+class LevelBook:
+    def __init__(self, crossing: bool):
+        self.crossing = crossing
+        self.prices = np.empty(0)
+        self.present = np.zeros((2, 0), dtype=bool)
+        self.size = np.zeros((2, 0))
+        self.count = np.zeros((2, 0), dtype=np.int64)
+
+    # add prices of ops to the grid, returns index of each operation in the grid
+    def index(self, ops: Ops):
+        new = np.setdiff1d(ops.price, self.prices)
+        if len(new) > 0:
+            grid = np.union1d(self.prices, new)
+            position = np.searchsorted(grid, self.prices)
+            for name in ('present', 'size', 'count'):
+                before = getattr(self, name)
+                after = np.zeros((2, len(grid)), dtype=before.dtype)
+                after[:, position] = before
+                setattr(self, name, after)
+            self.prices = grid
+        return np.searchsorted(self.prices, ops.price)
+
+    def clear(self):
+        self.present[:] = False
+
+    # apply operations a to b, index is from self.index
+    def apply(self, ops: Ops, index, a: int, b: int):
+        clears = np.flatnonzero(ops.op[a:b] == CLEAR)
+        if len(clears) > 0:
+            self.clear()
+            a += clears[-1] + 1
+        if a == b:
+            return
+
+        op = ops.op[a:b]
+        side = ops.side[a:b]
+        i = index[a:b]
+        if self.crossing:
+            # bids and asks of the batch have to be apart from each other
+            bids = np.flatnonzero(self.present[BID])
+            asks = np.flatnonzero(self.present[ASK])
+            high = max(bids[-1] if len(bids) > 0 else -1, i[(op == SET) & (side == BID)].max(initial=-1))
+            low = min(asks[0] if len(asks) > 0 else len(self.prices), i[(op == SET) & (side == ASK)].min(initial=len(self.prices)))
+            if high >= low:
+                self.apply_each(ops, index, a, b)
+                return
+            # the side which could have the price
+            side = np.where(op == REMOVE, np.where(i <= high, BID, ASK), side)
+
+        # the last operation of each level wins
+        key = side.astype(np.int64) * len(self.prices) + i
+        (_, last) = np.unique(key[::-1], return_index=True)
+        last = len(key) - 1 - last
+        (side, i, position) = (side[last], i[last], last + a)
+        self.present[side, i] = op[last] == SET
+        self.size[side, i] = ops.size[position]
+        self.count[side, i] = ops.count[position]
+
+    # apply operations one by one, following BitfinexState
+    def apply_each(self, ops: Ops, index, a: int, b: int):
+        (bid, ask) = self.present
+        for position in range(a, b):
+            (op, side, i) = (ops.op[position], ops.side[position], index[position])
+            if op == REMOVE:
+                if bid[i]:
+                    bid[i] = False
+                elif ask[i]:
+                    ask[i] = False
+                continue
+            elif op == DELETE:
+                self.present[side, i] = False
+                continue
+            # set
+            if self.crossing:
+                if side == ASK:
+                    bid[i:] = False
+                else:
+                    ask[:i+1] = False
+            self.present[side, i] = True
+            self.size[side, i] = ops.size[position]
+            self.count[side, i] = ops.count[position]
+
+    # returns indexes of the best depth levels of bids and asks, best first
+    def top(self, depth: int):
+        bids = np.flatnonzero(self.present[BID])[::-1][:depth]
+        asks = np.flatnonzero(self.present[ASK])[:depth]
+        return (bids, asks)
+
+    # write the best depth levels into row of sample arrays
+    def sample(self, samples: dict, row: int, depth: int):
+        for (side, levels) in zip((BID, ASK), self.top(depth)):
+            name = 'bid' if side == BID else 'ask'
+            samples[name + '_price'][row, :len(levels)] = self.prices[levels]
+            samples[name + '_size'][row, :len(levels)] = self.size[side, levels]
+            if 'bid_count' in samples:
+                samples[name + '_count'][row, :len(levels)] = self.count[side, levels]
+
+"""orderbook of orders of a symbol of bitmex on a sorted grid of every (id, side) seen
+
+key of an order is id * 2 + side, an order is in the book if present
+"""
+class OrderBook:
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.side = np.empty(0, dtype=np.int64)
+        self.present = np.zeros(0, dtype=bool)
+        self.price = np.zeros(0)
+        self.size = np.zeros(0)
+
+    def index(self, ops: Ops):
+        keys = ops.key * 2 + ops.side
+        new = np.setdiff1d(keys, self.keys)
+        if len(new) > 0:
+            grid = np.union1d(self.keys, new)
+            position = np.searchsorted(grid, self.keys)
+            for name in ('present', 'price', 'size'):
+                before = getattr(self, name)
+                after = np.zeros(len(grid), dtype=before.dtype)
+                after[position] = before
+                setattr(self, name, after)
+            self.keys = grid
+            self.side = grid & 1
+        return np.searchsorted(self.keys, keys)
+
+    def clear(self):
+        self.present[:] = False
+
+    def apply(self, ops: Ops, index, a: int, b: int):
+        clears = np.flatnonzero(ops.op[a:b] == CLEAR)
+        if len(clears) > 0:
+            self.clear()
+            a += clears[-1] + 1
+        if a == b:
+            return
+
+        op = ops.op[a:b]
+        side = ops.side[a:b]
+        price = ops.price[a:b]
+        # inserted orders have to be apart from orders of the other side
+        bids = self.price[self.present & (self.side == BID)]
+        asks = self.price[self.present & (self.side == ASK)]
+        high = max(bids.max(initial=-np.inf), price[(op == SET) & (side == BID)].max(initial=-np.inf))
+        low = min(asks.min(initial=np.inf), price[(op == SET) & (side == ASK)].min(initial=np.inf))
+        if high >= low:
+            self.apply_each(ops, index, a, b)
+            return
+
+        # operations of each order in order, orders do not affect each other
+        order = np.argsort(index[a:b], kind='stable')
+        i = index[a:b][order]
+        op = op[order]
+        position = order + a
+        starts = np.flatnonzero(np.diff(i, prepend=-1))
+        sequence = np.arange(len(i))
+        # the last insert or delete and the last update of each order
+        last = np.maximum.reduceat(np.where((op == SET) | (op == DELETE), sequence, -1), starts)
+        last_update = np.maximum.reduceat(np.where(op == UPDATE, sequence, -1), starts)
+
+        i = i[starts]
+        inserted = last >= 0
+        present = np.where(inserted, op[last] == SET, self.present[i])
+        price = np.where(inserted, ops.price[position[last]], self.price[i])
+        size = np.where(inserted, ops.size[position[last]], self.size[i])
+        # updates after the insert, updates of missing orders are ignored
+        size = np.where(last_update > last, ops.size[position[last_update]], size)
+        self.present[i] = present
+        self.price[i] = price
+        self.size[i] = size
+
+    # apply operations one by one, following BitmexState
+    def apply_each(self, ops: Ops, index, a: int, b: int):
+        for position in range(a, b):
+            (op, i) = (ops.op[position], index[position])
+            if op == SET:
+                price = ops.price[position]
+                if ops.side[position] == ASK:
+                    self.present[(self.side == BID) & (self.price >= price)] = False
+                else:
+                    self.present[(self.side == ASK) & (self.price <= price)] = False
+                self.present[i] = True
+                self.price[i] = price
+                self.size[i] = ops.size[position]
+            elif op == UPDATE:
+                if self.present[i]:
+                    self.size[i] = ops.size[position]
+            elif op == DELETE:
+                self.present[i] = False
+
+    # returns indexes of the best depth orders of bids and asks, ordered by (price, id) as BitmexState.indexes
+    def top(self, depth: int):
+        result = []
+        for side in (BID, ASK):
+            orders = np.flatnonzero(self.present & (self.side == side))
+            prices = self.price[orders]
+            if len(orders) > depth:
+                # orders at the same price as the last one are kept to order by id
+                if side == BID:
+                    orders = orders[prices >= np.partition(prices, len(prices) - depth)[len(prices) - depth]]
+                else:
+                    orders = orders[prices <= np.partition(prices, depth - 1)[depth - 1]]
+            orders = orders[np.lexsort((self.keys[orders], self.price[orders]))]
+            result.append(orders[::-1][:depth] if side == BID else orders[:depth])
+        return tuple(result)
+
+    def sample(self, samples: dict, row: int, depth: int):
+        for (side, orders) in zip((BID, ASK), self.top(depth)):
+            name = 'bid' if side == BID else 'ask'
+            samples[name + '_price'][row, :len(orders)] = self.price[orders]
+            samples[name + '_size'][row, :len(orders)] = self.size[orders]
+
+# exchange vs (decoder, book, whether samples have count)
+EXCHANGES = {
+    'bitmex': (decode_bitmex, OrderBook, False),
+    'bitfinex': (decode_bitfinex, lambda: LevelBook(True), True),
+    'bitflyer': (decode_bitflyer, lambda: LevelBook(False), False),
+}
+
+# returns arrays of samples, prices are NaN and sizes are 0 where there are less than depth levels
+def sample_arrays(count: int, depth: int, counts: bool):
+    samples = {
+        'bid_price': np.full((count, depth), np.nan),
+        'bid_size': np.zeros((count, depth)),
+        'ask_price': np.full((count, depth), np.nan),
+        'ask_size': np.zeros((count, depth)),
+    }
+    if counts:
+        samples['bid_count'] = np.zeros((count, depth), dtype=np.int64)
+        samples['ask_count'] = np.zeros((count, depth), dtype=np.int64)
+    return samples
+
+"""returns map of name vs arrays of the best depth levels of book at each of times
+
+book is symbol of bitmex, book channel of bitfinex or product code of bitflyer
+a sample of time is the book after every record before the first record later than time
+"""
+def rebuild(exchange: str, records, book: str, times, depth: int, chunk_size: int = 1_000_000):
+    (decode, make_book, counts) = EXCHANGES[exchange]
+    times = np.asarray(times, dtype=np.int64)
+    samples = sample_arrays(len(times), depth, counts)
+    samples['time'] = times
+    orderbook = make_book()
+
+    # the next sample, and whether the book has changed since the previous one
+    row = 0
+    changed = True
+    def take(row: int):
+        nonlocal changed
+        if changed or row == 0:
+            orderbook.sample(samples, row, depth)
+            changed = False
+        else:
+            for (name, array) in samples.items():
+                if name != 'time':
+                    array[row] = array[row - 1]
+
+    for ops in decode(records, book, chunk_size):
+        if len(ops) == 0:
+            continue
+        index = orderbook.index(ops)
+        position = 0
+        for end in np.searchsorted(ops.time, times[row:], side='right'):
+            if end == len(ops):
+                # operations of the next chunk could still be before this sample
+                break
+            if end > position:
+                orderbook.apply(ops, index, position, end)
+                position = end
+                changed = True
+            take(row)
+            row += 1
+        if position < len(ops):
+            orderbook.apply(ops, index, position, len(ops))
+            changed = True
+
+    # samples after every record
+    for row in range(row, len(times)):
+        take(row)
+    return samples
+
+# write the best depth levels of book in state of exchange into row of sample arrays
+def state_sample(exchange: str, state, book: str, samples: dict, row: int, depth: int):
+    if state is None:
+        return
+    if exchange == 'bitmex':
+        sides = []
+        for side in ('Buy', 'Sell'):
+            index = state.indexes.get((book, side), [])
+            orders = index[::-1][:depth] if side == 'Buy' else index[:depth]
+            sides.append([(price, state.orderbooks[(book, side, id)]['size'], 0) for (price, id) in orders])
+    elif exchange == 'bitfinex':
+        chan_ids = [chan_id for (chan_id, channel) in state.idvch.items() if channel == book]
+        orderbook = state.orderbooks.get(chan_ids[-1]) if len(chan_ids) > 0 else None
+        if orderbook is None:
+            return
+        sides = [[(price, orderbook[name][price][1], orderbook[name][price][0]) for price in prices]
+            for (name, prices) in (('bids', orderbook['bidPrices'][::-1][:depth]), ('asks', orderbook['askPrices'][:depth]))]
+    else:
+        orderbook = state.map.get(book)
+        if orderbook is None:
+            return
+        sides = [[(price, size, 0) for (price, size) in sorted(orderbook['bids'].items(), reverse=True)[:depth]],
+            [(price, size, 0) for (price, size) in sorted(orderbook['asks'].items())[:depth]]]
+
+    for (name, levels) in zip(('bid', 'ask'), sides):
+        for (column, (price, size, count)) in enumerate(levels):
+            samples[name + '_price'][row, column] = price
+            samples[name + '_size'][row, column] = size
+            if name + '_count' in samples:
+                samples[name + '_count'][row, column] = count
+
+"""returns the same samples as rebuild by replaying records through the state class of exchange
+
+records have to start with a start record, state classes can not be restored from state records
+"""
+def replay_states(exchange: str, records, book: str, times, depth: int):
+    # imported here, exchange modules are only needed to verify
+    import bitmex
+    import bitfinex
+    import bitflyer
+    classes = { 'bitmex': bitmex.BitmexState, 'bitfinex': bitfinex.BitfinexState, 'bitflyer': bitflyer.BitflyerState }
+
+    times = np.asarray(times, dtype=np.int64)
+    samples = sample_arrays(len(times), depth, EXCHANGES[exchange][2])
+    samples['time'] = times
+    state = None
+    row = 0
+    latest = None
+    for record in records:
+        latest = record_time(latest, record)
+        while row < len(times) and times[row] < latest:
+            state_sample(exchange, state, book, samples, row, depth)
+            row += 1
+        if record.type == 'start':
+            state = classes[exchange]()
+        elif state is None:
+            raise ValueError('records have to start with a start record')
+        elif record.type == 'msg':
+            state.msg(record.message)
+        elif record.type == 'send':
+            state.send(record.message)
+    for row in range(row, len(times)):
+        state_sample(exchange, state, book, samples, row, depth)
+    return samples
+
+# returns number of samples which differ between arrays, NaN equals NaN
+def differences(expected, actual):
+    same = expected == actual
+    if expected.dtype.kind == 'f':
+        same |= np.isnan(expected) & np.isnan(actual)
+    if same.ndim > 1:
+        same = same.all(axis=-1)
+    return np.count_nonzero(~same)
+
+# returns nanoseconds of unixtime in nanoseconds or ISO format, UTC if it has no timezone
+def parse_time(text: str):
+    if text.isdigit():
+        return int(text)
+    parsed = datetime.datetime.fromisoformat(text)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp() * 1_000_000) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description='rebuild orderbooks from dumps')
+    parser.add_argument('source', help='dump directory of an exchange or an archive written by compact.py')
+    parser.add_argument('book', help='symbol of bitmex like XBTUSD, book channel of bitfinex like book_tBTCUSD or product code of bitflyer like BTC_JPY')
+    parser.add_argument('--exchange', choices=list(EXCHANGES), help='exchange of dump, guessed from the source by default')
+    parser.add_argument('--prefix', help='prefix of files in directory, name of directory by default')
+    parser.add_argument('--start', required=True, help='time of the first sample, nanoseconds or ISO format')
+    parser.add_argument('--end', required=True, help='samples are taken before this time')
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between samples')
+    parser.add_argument('--depth', type=int, default=10, help='number of levels of each side')
+    parser.add_argument('--output', help='npz file to write samples')
+    parser.add_argument('--verify', action='store_true', help='compare samples with the state class, replaying from the first file')
+    args = parser.parse_args()
+
+    archive = args.source.endswith('.archive')
+    if archive:
+        prefix = args.prefix or reader.read_archive_index(args.source)['prefix']
+    else:
+        prefix = args.prefix or os.path.basename(os.path.normpath(args.source))
+    # shards have prefixes like bitfinex-0
+    exchange = args.exchange or prefix.partition('-')[0]
+    start = parse_time(args.start)
+    end = parse_time(args.end)
+    times = np.arange(start, end, int(args.interval * 1_000_000_000), dtype=np.int64)
+
+    def source(from_checkpoint: bool):
+        if archive:
+            return reader.seek_archive(args.source, start, end) if from_checkpoint else reader.read_archive(args.source, end=end)
+        return reader.seek(args.source, start, prefix, end) if from_checkpoint else reader.read(args.source, prefix, end=end)
+
+    began = time.perf_counter()
+    samples = rebuild(exchange, source(not args.verify), args.book, times, args.depth)
+    duration = time.perf_counter() - began
+    print('rebuilt %d samples in %.2f seconds' % (len(times), duration))
+
+    if args.verify:
+        began = time.perf_counter()
+        expected = replay_states(exchange, source(False), args.book, times, args.depth)
+        print('replayed state class in %.2f seconds' % (time.perf_counter() - began))
+        for (name, array) in expected.items():
+            count = differences(array, samples[name])
+            if count > 0:
+                raise SystemExit('%s differs from the state class at %d samples' % (name, count))
+        print('samples match the state class')
+
+    if args.output is not None:
+        np.savez_compressed(args.output, **samples)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import compression
+import reader
+
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+
+# recompression of closed files at a higher level in worker processes
+# Writer compresses lightly so the writer thread keeps up with messages,
+# and hands each closed file to Recompressor, which replaces it with the smaller one
+#
+# a marker file is made next to the file until it is replaced,
+# files of markers left by a crash are recompressed when Writer opens the directory again
+#
+# the index is rewritten with the size of the new file before the file is replaced,
+# readers only use offsets of blocks while the size in the index matches the file
+# a file recompressed to another backend gets the extension of it, the old file is removed after the new one is there
+
+PENDING_SUFFIX = reader.PENDING_SUFFIX
+
+# bytes read at once from a file without blocks
+CHUNK_SIZE = 1024*1024
+
+# returns compressor of spec, compressors are made in worker processes from (name, level, dictionary)
+def make_compressor(spec: tuple):
+    (name, level, dictionary) = spec
+    if name == 'gzip':
+        return compression.GzipCompressor(level)
+    elif name == 'zlib':
+        return compression.ZlibCompressor(dictionary, level)
+    elif name == 'zstd':
+        return compression.ZstdCompressor(dictionary, level)
+    else:
+        raise ValueError('unknown compression %s' % name)
+
+"""recompress file at path with compressor of spec and replace it, runs in a worker process
+
+blocks are recompressed one by one, their offsets in the index are updated
+"""
+def recompress_file(path: str, spec: tuple):
+    compressor = make_compressor(spec)
+    directory = os.path.dirname(path)
+    compressor.install(directory)
+
+    index = reader.read_index(path)
+    blocks = index.get('blocks') if index is not None else None
+
+    new_path = compression.split_extension(path)[0] + compressor.extension
+    # temporary file could be left by a crash
+    temporary = '%s.tmp' % new_path
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    with open(path, 'rb') as file, compression.open_reader(file) as stream:
+        if blocks:
+            # only a block is in memory at a time
+            new_blocks = []
+            with open(temporary, 'wb') as output:
+                output.write(compressor.header())
+                if blocks[0][1] > 0:
+                    # header of records is not a block
+                    output.write(compressor.compress(stream.read(blocks[0][1])))
+                for i, (_, offset, time) in enumerate(blocks):
+                    new_blocks.append([output.tell(), offset, time])
+                    if i + 1 < len(blocks):
+                        output.write(compressor.compress(stream.read(blocks[i + 1][1] - offset)))
+                    else:
+                        output.write(compressor.compress(stream.read()))
+            index['blocks'] = new_blocks
+        else:
+            output = compressor.open(temporary)
+            while True:
+                data = stream.read(CHUNK_SIZE)
+                if len(data) == 0:
+                    break
+                output.write(data)
+            output.close()
+
+    if index is not None:
+        # index tells the size of the new file before it is replaced
+        index['compressed'] = os.path.getsize(temporary)
+        index['name'] = os.path.basename(new_path)
+        line = json.dumps(index, separators=(',', ':'))
+        index_path = reader.index_path(path)
+        with open('%s.tmp' % index_path, 'w') as file:
+            file.write(line)
+        os.replace('%s.tmp' % index_path, index_path)
+        # later line of the same file overrides the earlier one in the manifest
+        (prefix, _, _) = os.path.basename(path).rpartition('_')
+        with open(os.path.join(directory, '%s.manifest' % prefix), 'a') as file:
+            file.write(line + '\n')
+
+    os.replace(temporary, new_path)
+    if new_path != path:
+        os.remove(path)
+    os.remove(path + PENDING_SUFFIX)
+    return os.path.getsize(new_path)
+
+class Recompressor:
+    DEFAULT_WORKERS = 2
+    DEFAULT_LEVEL = 9
+
+    # files are recompressed by compressor, gzip of level if not given
+    def __init__(self, workers: int = DEFAULT_WORKERS, level: int = DEFAULT_LEVEL, compressor = None):
+        compressor = compressor or compression.GzipCompressor(level)
+        self.spec = (compressor.name, compressor.level, getattr(compressor, 'dictionary', None))
+        # workers are not forked from the dumper, which has threads holding locks
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+        # paths submitted and not done yet
+        self.submitted = set()
+        # directories and prefixes already resumed
+        self.resumed = set()
+
+        self.logger = logging.getLogger('recompress')
+
+    """recompress closed file at path in the background"""
+    def submit(self, path: str):
+        if path in self.submitted:
+            return
+        marker = path + PENDING_SUFFIX
+        if not os.path.exists(marker):
+            open(marker, 'w').close()
+        self.submitted.add(path)
+        size = os.path.getsize(path)
+        future = self.executor.submit(recompress_file, path, self.spec)
+        future.add_done_callback(lambda future: self.done(path, size, future))
+
+    def done(self, path: str, size: int, future):
+        self.submitted.discard(path)
+        if future.exception() is not None:
+            # marker is left, tried again when resumed
+            self.logger.error('failed to recompress %s: %s', path, future.exception())
+        else:
+            self.logger.info('recompressed %s from %d to %d bytes', path, size, future.result())
+
+    """submit files of markers of prefix in directory, left by a crash"""
+    def resume(self, directory: str, prefix: str):
+        if (directory, prefix) in self.resumed:
+            return
+        self.resumed.add((directory, prefix))
+        for name in os.listdir(directory):
+            if not name.startswith(prefix + '_') or not name.endswith(PENDING_SUFFIX):
+                continue
+            if compression.split_extension(name[:-len(PENDING_SUFFIX)]) is None:
+                continue
+            path = os.path.join(directory, name[:-len(PENDING_SUFFIX)])
+            if os.path.exists(path):
+                self.logger.info('resuming recompression of %s', path)
+                self.submit(path)
+            else:
+                os.remove(os.path.join(directory, name))
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
@@ -0,0 +1,276 @@
+import argparse
+import gzip
+import os
+
+# compact binary encoding of records, an alternative to tab separated lines
+#
+# file starts with MAGIC, followed by records of
+#   type: 1 byte
+#   start, msg, send, err and end:
+#     time: zigzag varint of nanoseconds from the time of the previous record (0 at first)
+#   state and diff:
+#     time: varint of nanoseconds, not a delta
+#     channel: varint length and bytes
+#   msg and send:
+#     channel: varint id, if it is the next unused id, varint length and bytes follow to define it
+#   every type except end:
+#     message: varint length and bytes
+#
+# state and diff records do not use nor change previous time and channel ids,
+# they are serialized in the background and written before lines buffered meanwhile
+# reset record clears previous time and channel ids, decoding can start from any record after it
+
+MAGIC = b'\x93DUMPBIN\x01\n'
+
+START = 0
+MSG = 1
+SEND = 2
+ERR = 3
+STATE = 4
+DIFF = 5
+END = 6
+RESET = 7
+
+# name of types in tab separated lines
+TYPE_NAMES = ('start', 'msg', 'send', 'err', 'state', 'diff', 'end')
+TYPES = { name.encode(): type for type, name in enumerate(TYPE_NAMES) }
+
+def varint(n: int):
+    if n < 0x80:
+        return bytes((n,))
+    encoded = bytearray()
+    while n >= 0x80:
+        encoded.append((n & 0x7f) | 0x80)
+        n >>= 7
+    encoded.append(n)
+    return encoded
+
+# returns (value, position after it) of varint at position, raises IndexError if data ends
+def read_varint(data: bytes, position: int):
+    byte = data[position]
+    position += 1
+    if byte < 0x80:
+        return (byte, position)
+    value = byte & 0x7f
+    shift = 7
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value, position)
+        shift += 7
+
+def zigzag(n: int):
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+def unzigzag(n: int):
+    return n >> 1 if n & 1 == 0 else -((n + 1) >> 1)
+
+"""encodes records into bytearray, keeps previous time and channel ids"""
+class Encoder:
+    def __init__(self):
+        self.time = 0
+        # map of channel name vs its encoded id
+        self.channels = dict()
+        # write reset record before the next record
+        self.marker = False
+
+    """forget previous time and channel ids, mark it in the output if marker"""
+    def reset(self, marker: bool = True):
+        self.time = 0
+        self.channels.clear()
+        self.marker = marker
+
+    def record(self, buffer: bytearray, type: int, time: int, channel: str = None, message: bytes = None):
+        if self.marker:
+            buffer.append(RESET)
+            self.marker = False
+        buffer.append(type)
+        buffer += varint(zigzag(time - self.time))
+        self.time = time
+
+        if channel is not None:
+            encoded = self.channels.get(channel)
+            if encoded is None:
+                # define channel inline
+                encoded = self.channels[channel] = varint(len(self.channels))
+                name = channel.encode()
+                buffer += encoded
+                buffer += varint(len(name))
+                buffer += name
+            else:
+                buffer += encoded
+
+        if message is not None:
+            buffer += varint(len(message))
+            buffer += message
+
+"""encode state or diff record, independent of the Encoder"""
+def snapshot_record(buffer: bytearray, type: int, time: int, channel: bytes, message: bytes):
+    buffer.append(type)
+    buffer += varint(time)
+    buffer += varint(len(channel))
+    buffer += channel
+    buffer += varint(len(message))
+    buffer += message
+
+"""returns time of the first record in data, which is the beginning of a block"""
+def first_time(data: bytes):
+    position = len(MAGIC) if data.startswith(MAGIC) else 0
+    if data[position] == RESET:
+        position += 1
+    type = data[position]
+    (time, _) = read_varint(data, position + 1)
+    if type == STATE or type == DIFF:
+        return time
+    # delta from 0
+    return unzigzag(time)
+
+# decodes a record at position, returns (type, time, channel, message, position after it)
+# raises IndexError if data ends before the record ends
+def decode_record(data: bytes, position: int, decoder: dict):
+    type = data[position]
+    position += 1
+    if type == RESET:
+        decoder['time'] = 0
+        decoder['channels'].clear()
+        return (RESET, None, None, None, position)
+
+    (time, position) = read_varint(data, position)
+    channel = None
+    if type == STATE or type == DIFF:
+        (length, position) = read_varint(data, position)
+        channel = data[position:position+length]
+        position += length
+    else:
+        time = decoder['time'] + unzigzag(time)
+        if type == MSG or type == SEND:
+            channels = decoder['channels']
+            (id, position) = read_varint(data, position)
+            if id == len(channels):
+                (length, position) = read_varint(data, position)
+                channel = data[position:position+length]
+                position += length
+            elif id > len(channels):
+                raise ValueError('undefined channel id %d' % id)
+            else:
+                channel = channels[id]
+        elif type > END:
+            raise ValueError('unknown record type %d' % type)
+
+    message = None
+    if type != END:
+        (length, position) = read_varint(data, position)
+        message = data[position:position+length]
+        position += length
+    if position > len(data):
+        raise IndexError('record continues')
+
+    # update decoder only after the whole record is decoded
+    if type != STATE and type != DIFF:
+        decoder['time'] = time
+        if channel is not None and id == len(decoder['channels']):
+            decoder['channels'].append(channel)
+    return (type, time, channel, message, position)
+
+"""iterate (type, time, channel, message) of records in stream, channel and message are bytes
+
+header tells if the stream starts with MAGIC, it is False if decoding starts from the middle of a file
+"""
+def decode(stream, header: bool = True, chunk_size: int = 1024*1024):
+    data = stream.read(chunk_size)
+    position = 0
+    if header:
+        if not data.startswith(MAGIC):
+            raise ValueError('not a binary record stream')
+        position = len(MAGIC)
+
+    decoder = { 'time': 0, 'channels': [] }
+    eof = False
+    while True:
+        try:
+            (type, time, channel, message, next_position) = decode_record(data, position, decoder)
+        except IndexError:
+            if eof:
+                if position < len(data):
+                    raise ValueError('stream ended in the middle of a record')
+                return
+            # read more and decode the record again
+            more = stream.read(chunk_size)
+            eof = len(more) == 0
+            data = data[position:] + more
+            position = 0
+            continue
+        position = next_position
+        if type != RESET:
+            yield (type, time, channel, message)
+
+"""returns True if stream starts with MAGIC, stream must support peek"""
+def is_binary(stream):
+    return stream.peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+
+# returns tab separated line of a record
+def tsv_line(type: int, time: int, channel: bytes, message: bytes):
+    if type == END:
+        return b'end\t%d\n' % time
+    elif channel is None:
+        return b'%s\t%d\t%s\n' % (TYPE_NAMES[type].encode(), time, message)
+    else:
+        return b'%s\t%d\t%s\t%s\n' % (TYPE_NAMES[type].encode(), time, channel, message)
+
+"""convert tab separated lines of input to binary records in output"""
+def to_binary(input, output):
+    encoder = Encoder()
+    buffer = bytearray(MAGIC)
+    for line in input:
+        fields = line.rstrip(b'\n').split(b'\t', 2)
+        type = TYPES[fields[0]]
+        time = int(fields[1])
+        if b'%d' % time != fields[1]:
+            # leading zeros or sign would be lost
+            raise ValueError('time is not in canonical form %s' % fields[1])
+
+        if type == END:
+            encoder.record(buffer, END, time)
+        elif type == STATE or type == DIFF:
+            (channel, message) = fields[2].split(b'\t', 1)
+            snapshot_record(buffer, type, time, channel, message)
+        elif type == MSG or type == SEND:
+            (channel, message) = fields[2].split(b'\t', 1)
+            encoder.record(buffer, type, time, channel.decode(), message)
+        else:
+            encoder.record(buffer, type, time, None, fields[2])
+
+        if len(buffer) >= 256*1024:
+            output.write(buffer)
+            buffer.clear()
+    output.write(buffer)
+
+"""convert binary records of input to tab separated lines in output"""
+def to_tsv(input, output):
+    buffer = bytearray()
+    for (type, time, channel, message) in decode(input):
+        buffer += tsv_line(type, time, channel, message)
+        if len(buffer) >= 256*1024:
+            output.write(buffer)
+            buffer.clear()
+    output.write(buffer)
+
+def main():
+    parser = argparse.ArgumentParser(description='convert dump files between tab separated lines and binary records')
+    parser.add_argument('direction', choices=['binary', 'tsv'], help='format to convert to')
+    parser.add_argument('input', help='gzip file to convert')
+    parser.add_argument('output', help='gzip file to write')
+    parser.add_argument('--compresslevel', type=int, default=9, help='gzip compression level of output')
+    args = parser.parse_args()
+
+    convert = to_binary if args.direction == 'binary' else to_tsv
+    # write to temporary file and rename it, output is never half written
+    temporary = '%s.tmp' % args.output
+    with gzip.open(args.input, 'rb') as input, gzip.open(temporary, 'wb', compresslevel=args.compresslevel) as output:
+        convert(input, output)
+    os.replace(temporary, args.output)
+
+if __name__ == '__main__':
+    main()
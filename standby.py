@@ -0,0 +1,429 @@
+import dumpv2
+import metrics
+import profiling
+
+import collections
+import logging
+import os
+import threading
+import time
+
+import websocket
+
+# hot-standby mode of WebSocketDumper, a second connection is kept open next to the active one
+# when the active connection is closed, the standby one takes over without a hole in the dump
+#
+# messages of both connections are classified into channels by a protocol of the exchange,
+# which also gives a key of each message equal on both connections
+# the standby connection keeps its recent messages, at takeover each channel is aligned by keys
+# with what the active connection received, and only the messages after that are written
+# messages written after takeover look like the ones of the first connection, protocol rewrites
+# ids of the connection into the ones in the file (chanId of Bitfinex)
+#
+# protocol is made for each connection and has
+#   classify(message) returns (channel, key), key is None for messages of the connection itself
+#     like responses to subscribe and snapshots, channel is None for messages of no channel like heartbeats
+#   send(frame) is told frames sent by subscribe
+#   channels() returns channels subscribed on the connection
+#   takeover(previous) makes rewrite write ids of the file, which previous wrote
+#   rewrite(message) returns message as written in the file
+#
+# a session ends when the active connection is closed without an open standby,
+# Reconnecter starts over as with WebSocketDumper
+
+"""one WebSocket connection of StandbyDumper, runs in its own thread"""
+class Connection:
+    def __init__(self, dumper, number: int, protocol):
+        self.dumper = dumper
+        self.number = number
+        self.protocol = protocol
+        self.ws_app = None
+        self.thread = None
+        # monotonic time when opened, None until then
+        self.opened = None
+        self.closed = False
+        # True once a close frame is sent by close_gracefully
+        self.closing = False
+        # (channel, key, message, time) of messages received in the last window, oldest first
+        self.recent = collections.deque()
+        # (channel, message, time) of every message of the connection itself
+        self.specific = []
+        # map of channel vs keys of messages the file already has, to be dropped as they come
+        # and whether they could start from any of the keys
+        self.expect = dict()
+        # map of channel vs (positions in keys of expect, messages) of loose channels,
+        # messages continuing runs of keys from the positions are held until one of the runs reaches the end
+        self.held = dict()
+
+    # called from subscribe
+    def send(self, message: str):
+        self.ws_app.send(message)
+        self.protocol.send(message)
+        self.dumper.sent(self, message, time.time_ns())
+
+    def start(self):
+        self.ws_app = websocket.WebSocketApp(self.dumper.url,
+            on_open=lambda ws: self.dumper.on_open(self),
+            on_message=lambda ws, message: self.dumper.on_message(self, message),
+            on_error=lambda ws, error: self.dumper.on_error(self, error),
+            on_close=lambda ws, *args: self.dumper.on_close(self))
+        self.thread = threading.Thread(target=self.ws_app.run_forever, name='connection-%d' % self.number, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.ws_app is not None:
+            self.ws_app.close()
+
+    # send a close frame and let the thread of the connection close it on the reply,
+    # closing the socket from another thread could leave the thread waiting on it forever
+    # closed anyway after timeout seconds
+    def close_gracefully(self, timeout: float = 10):
+        self.closing = True
+        sock = self.ws_app.sock if self.ws_app is not None else None
+        if sock is None:
+            self.close()
+            return
+        try:
+            sock.send_close()
+        except Exception:
+            self.close()
+            return
+        def close():
+            if not self.closed:
+                self.close()
+        timer = threading.Timer(timeout, close)
+        timer.daemon = True
+        timer.start()
+
+"""dump WebSocket stream with a standby connection, used in place of WebSocketDumper"""
+class StandbyDumper:
+    # seconds of messages kept by each connection to align channels at takeover
+    DEFAULT_WINDOW = 30
+    # keys at the end of a channel compared at takeover
+    TAIL = 50
+    # seconds between opening a standby connection and after it is closed
+    STANDBY_DELAY = 1
+    MAX_STANDBY_DELAY = 60
+    # seconds a standby connection has to be open before a planned rotation closes the active one
+    SETTLE_TIME = 5
+
+    # protocol is a function which returns a new protocol of the exchange
+    # if rotate_interval is given, the active connection is closed after this seconds, once the standby one is settled
+    # options are passed to Writer
+    def __init__(self, dir_dump: str, exchange: str, url: str, subscribe, state, protocol,
+            memory_limit: int = dumpv2.MultithreadedWriter.DEFAULT_MEMORY_LIMIT, prefix: str = None,
+            window: float = DEFAULT_WINDOW, rotate_interval: float = None, **options):
+        self.url = url
+        self.subscribe = subscribe
+        self.protocol = protocol
+        self.prefix = prefix or exchange
+        self.window = window
+        self.rotate_interval = rotate_interval
+        # called when the first connection is opened, set by Reconnecter
+        self.on_connect = None
+
+        self.writer = dumpv2.MultithreadedWriter(os.path.join(dir_dump, exchange), self.prefix, url, state, memory_limit, **options)
+
+        # messages of both connections are handled one at a time
+        self.lock = threading.Lock()
+        self.active = None
+        self.standby = None
+        # monotonic time the active connection became active
+        self.active_since = None
+        self.connections = 0
+        self.standby_delay = self.STANDBY_DELAY
+        # time of the last message written
+        self.last_time = 0
+        # set when the session ends
+        self.finished = threading.Event()
+        self.stopped = False
+
+        self.logger = logging.getLogger('standby')
+
+        group = metrics.REGISTRY.group(self.prefix)
+        self.received = group.counter('received')
+        self.received_bytes = group.counter('received_bytes')
+        self.takeovers = group.counter('takeovers')
+        self.duplicates = group.counter('duplicates')
+
+    def connect(self):
+        self.connections += 1
+        connection = Connection(self, self.connections, self.protocol())
+        connection.start()
+        return connection
+
+    # open a standby connection after delay seconds, unless the session ended or there is one
+    def open_standby(self, delay: float):
+        def open():
+            if self.finished.wait(delay):
+                return
+            with self.lock:
+                if self.standby is None and self.active is not None and not self.finished.is_set():
+                    self.standby = self.connect()
+        threading.Thread(target=open, name='standby-opener', daemon=True).start()
+
+    def on_open(self, connection: Connection):
+        self.logger.info('connection %d opened for [%s]' % (connection.number, self.url))
+        with self.lock:
+            connection.opened = time.monotonic()
+            first = connection is self.active and connection.number == 1
+            if first:
+                self.active_since = connection.opened
+        if first and self.on_connect is not None:
+            self.on_connect()
+        try:
+            if self.subscribe is not None:
+                self.subscribe(connection)
+        except Exception:
+            self.logger.exception('Encountered an error on subscribe')
+            connection.close()
+            return
+        if first:
+            self.open_standby(self.standby_delay)
+
+    # frames sent by the first connection are written, the rest are the same subscription again
+    def sent(self, connection: Connection, message: str, timestamp: int):
+        if connection.number != 1:
+            return
+        with self.lock:
+            try:
+                self.writer.send(message, timestamp)
+            except Exception:
+                self.logger.exception('error on send')
+                connection.close()
+
+    def on_message(self, connection: Connection, message: str):
+        timestamp = time.time_ns()
+        with self.lock:
+            # counters are shared by both connections
+            self.received.add()
+            self.received_bytes.add(len(message))
+            (channel, key) = connection.protocol.classify(message)
+            if key is not None:
+                recent = connection.recent
+                recent.append((channel, key, message, timestamp))
+                oldest = timestamp - self.window * 1_000_000_000
+                while recent[0][3] < oldest:
+                    recent.popleft()
+            elif channel is not None:
+                connection.specific.append((channel, message, timestamp))
+            if connection is not self.active:
+                return
+            if key is not None and channel in connection.expect:
+                messages = self.expected(connection, channel, key, message, timestamp)
+            else:
+                messages = [(message, timestamp)]
+            try:
+                for (message, timestamp) in messages:
+                    # held messages were received before the last written one
+                    self.last_time = max(self.last_time, timestamp)
+                    self.writer.msg(connection.protocol.rewrite(message), self.last_time)
+            except Exception:
+                self.logger.exception("writer msg returned error")
+                connection.close()
+        profiler = profiling.current
+        if profiler is not None:
+            profiler.add('on_message', (time.time_ns() - timestamp) / 1_000_000_000)
+
+    # returns (message, time) of the active connection to write, messages written by the previous one are dropped
+    def expected(self, connection: Connection, channel: str, key, message: str, timestamp: int):
+        (keys, loose) = connection.expect[channel]
+        if loose:
+            return self.expected_loose(connection, channel, key, message, timestamp)
+        if keys[0] != key:
+            self.logger.warning('%s did not continue from the previous connection, could have a gap', channel)
+            del connection.expect[channel]
+            return [(message, timestamp)]
+        if len(keys) > 1:
+            connection.expect[channel] = (keys[1:], False)
+        else:
+            del connection.expect[channel]
+        self.duplicates.add()
+        return []
+
+    # messages could start anywhere in the keys, or after all of them
+    # they are duplicates only if they run to the end of the keys, a key seen before could be of a new message
+    def expected_loose(self, connection: Connection, channel: str, key, message: str, timestamp: int):
+        (keys, _) = connection.expect[channel]
+        (positions, held) = connection.held.pop(channel, (range(len(keys)), []))
+        positions = [p for p in positions if keys[p + len(held)] == key]
+        held = held + [(message, timestamp)]
+        if len(positions) == 0:
+            del connection.expect[channel]
+            if len(held) > 1:
+                self.logger.warning('%s could overlap with the previous connection, %d messages matching its last ones are written', channel, len(held) - 1)
+            return held
+        if any(p + len(held) == len(keys) for p in positions):
+            del connection.expect[channel]
+            self.duplicates.add(len(held))
+            return []
+        connection.held[channel] = (positions, held)
+        return []
+
+    # write messages held by the connection, the file could not have them, called with lock
+    def write_held(self, connection: Connection):
+        for (channel, (_, held)) in connection.held.items():
+            self.logger.warning('%s could overlap with the previous connection, %d held messages are written', channel, len(held))
+            for (message, timestamp) in held:
+                self.last_time = max(self.last_time, timestamp)
+                self.writer.msg(connection.protocol.rewrite(message), self.last_time)
+        connection.held = dict()
+
+    def on_error(self, connection: Connection, error):
+        self.logger.error('Got WebSocket error on connection %d [%s]: %s' % (connection.number, self.url, error))
+        try:
+            connection.close()
+        except Exception:
+            self.logger.exception('ws.close() failed')
+
+    def on_close(self, connection: Connection):
+        self.logger.warning('connection %d closed for [%s]' % (connection.number, self.url))
+        with self.lock:
+            if connection.closed:
+                return
+            connection.closed = True
+            if connection is self.standby:
+                self.standby = None
+                if connection.opened is None or time.monotonic() - connection.opened < 60:
+                    # closed right away, do not try again too often
+                    self.standby_delay = min(self.standby_delay * 2, self.MAX_STANDBY_DELAY)
+                else:
+                    self.standby_delay = self.STANDBY_DELAY
+                if not self.stopped:
+                    self.open_standby(self.standby_delay)
+                return
+            if connection is not self.active:
+                return
+            standby = self.standby
+            if not self.stopped and standby is not None and standby.opened is not None and not standby.closed:
+                self.takeover(connection, standby)
+                self.open_standby(self.standby_delay)
+                return
+            # nothing to take over, the session ends
+            self.write_held(connection)
+            self.active = None
+            self.finished.set()
+            self.writer.end(time.time_ns())
+        if self.standby is not None:
+            self.standby.close()
+
+    # returns (number of buffered keys of standby already written, keys the file has after them, loose)
+    # or None if keys of standby have nothing in common with tail
+    def align(self, tail: list, keys: list):
+        if len(tail) == 0:
+            # nothing recent in the file, every message is new
+            return (0, [], False)
+        # standby is ahead or even, it has the last key of tail preceded by the rest of tail
+        for p in range(len(keys) - 1, -1, -1):
+            if keys[p] == tail[-1] and self.match(keys, p, tail, len(tail) - 1):
+                return (p + 1, [], False)
+        if len(keys) == 0:
+            # standby could still receive some of the tail
+            return (0, tail, True)
+        # standby is behind, its last key is in tail
+        for q in range(len(tail) - 2, -1, -1):
+            if tail[q] == keys[-1] and self.match(keys, len(keys) - 1, tail, q):
+                return (len(keys), tail[q + 1:], False)
+        return None
+
+    # whether keys up to p and tail up to q are the same, as far as both go
+    def match(self, keys: list, p: int, tail: list, q: int):
+        for i in range(min(p, q) + 1):
+            if keys[p - i] != tail[q - i]:
+                return False
+        return True
+
+    # write messages of standby the file does not have and make it the active connection, called with lock
+    def takeover(self, previous: Connection, standby: Connection):
+        # messages the previous connection held are in its recent, the file has to have them
+        self.write_held(previous)
+        # keys and time of the last message of each channel the file has
+        tails = collections.defaultdict(list)
+        last_times = dict()
+        for (channel, key, _, timestamp) in previous.recent:
+            tails[channel].append(key)
+            last_times[channel] = timestamp
+        keys = collections.defaultdict(list)
+        for (channel, key, _, _) in standby.recent:
+            keys[channel].append(key)
+
+        # number of keyed messages of each channel to skip
+        skips = dict()
+        standby.expect = dict()
+        for channel in set(tails) | set(keys):
+            tail = tails[channel][-self.TAIL:]
+            alignment = self.align(tail, keys[channel])
+            if alignment is None:
+                # best effort by time, the two connections did not get the same messages
+                self.logger.warning('%s of connection %d does not match the previous connection, aligned by time', channel, standby.number)
+                last_time = last_times[channel]
+                skips[channel] = sum(1 for (c, _, _, timestamp) in standby.recent if c == channel and timestamp <= last_time)
+                continue
+            (skip, expect, loose) = alignment
+            skips[channel] = skip
+            if len(expect) > 0:
+                standby.expect[channel] = (expect, loose)
+
+        standby.protocol.takeover(previous.protocol)
+        # responses and snapshots of channels the file does not have are written before their messages
+        subscribed = previous.protocol.channels()
+        messages = [(message, timestamp) for (channel, message, timestamp) in standby.specific if channel not in subscribed]
+        added = set(channel for (channel, _, _) in standby.specific if channel not in subscribed)
+        if len(added) > 0:
+            self.logger.warning('%s were not on connection %d, written from the last %ds', ', '.join(sorted(added)), previous.number, self.window)
+        for (channel, key, message, timestamp) in standby.recent:
+            if skips.get(channel, 0) > 0:
+                skips[channel] -= 1
+                continue
+            messages.append((message, timestamp))
+        for (message, timestamp) in messages:
+            # standby could have received them before the last message of the previous connection
+            self.last_time = max(self.last_time, timestamp)
+            self.writer.msg(standby.protocol.rewrite(message), self.last_time)
+
+        self.active = standby
+        self.active_since = time.monotonic()
+        self.standby = None
+        self.takeovers.add()
+        self.logger.info('connection %d took over from connection %d, %d messages written from the standby', standby.number, previous.number, len(messages))
+
+    # close the active connection once it is older than rotate_interval and the standby one is settled
+    def rotate(self):
+        while not self.finished.wait(1):
+            with self.lock:
+                active = self.active
+                standby = self.standby
+                if active is None or active.opened is None or active.closing or standby is None or standby.opened is None:
+                    continue
+                now = time.monotonic()
+                if now - self.active_since < self.rotate_interval or now - standby.opened < self.SETTLE_TIME:
+                    continue
+            self.logger.info('rotating connection %d', active.number)
+            active.close_gracefully()
+
+    def do(self):
+        self.logger.info('Connecting to [%s] with a standby connection...' % self.url)
+        self.writer.start()
+        with self.lock:
+            self.active = self.connect()
+        if self.rotate_interval is not None:
+            threading.Thread(target=self.rotate, name='standby-rotation', daemon=True).start()
+        try:
+            # wait with timeout, otherwise KeyboardInterrupt is not delivered
+            while not self.finished.wait(1):
+                pass
+        except KeyboardInterrupt as e:
+            self.logger.warn('Got kill command, ending stream')
+            self.close()
+            self.finished.wait(10)
+            raise e
+        self.writer.join()
+
+    # close both connections from the different thread, the session ends
+    def close(self):
+        with self.lock:
+            self.stopped = True
+            connections = [self.active, self.standby]
+        for connection in connections:
+            if connection is not None:
+                connection.close()
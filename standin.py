@@ -0,0 +1,303 @@
+import reader
+
+import argparse
+import asyncio
+import http.server
+import itertools
+import json
+import logging
+import os
+import threading
+
+import websockets
+
+# local stand-ins of exchange servers for tests and benchmarks
+
+"""local HTTP server which responds json of responses[path], stands in for REST APIs"""
+class RestStandIn:
+    def __init__(self, responses: dict, port: int = 0):
+        # map of path (including query) vs json serializable response
+        self.responses = responses
+        # number of requests served for each path
+        self.requests = dict()
+
+        standin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                standin.requests[self.path] = standin.requests.get(self.path, 0) + 1
+                if self.path not in standin.responses:
+                    self.send_error(404)
+                    return
+                body = json.dumps(standin.responses[self.path]).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        # port 0 picks a free port
+        self.server = http.server.ThreadingHTTPServer(('localhost', port), Handler)
+        self.thread = None
+
+    def url(self, path: str):
+        return 'http://localhost:%d%s' % (self.server.server_address[1], path)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='rest-standin', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+# answers of ReplayStandIn to subscribe frames, channel is named as the state class does,
+# the same as channels of records
+
+class BitfinexReplayProtocol:
+    # returns channel the frame of client subscribes to, None if it does not subscribe
+    def request(self, frame: str):
+        obj = json.loads(frame)
+        if obj.get('event') != 'subscribe':
+            return None
+        return '%s_%s' % (obj['channel'], obj['symbol'])
+
+    # returns channel of a recorded response to subscribe, None if the record is not
+    def response(self, record):
+        if not record.message.startswith('{'):
+            return None
+        obj = json.loads(record.message)
+        if obj.get('event') in ('subscribed', 'error') and 'channel' in obj:
+            return record.channel
+        return None
+
+    # returns recorded response for the frame of client, chanId is kept as messages of the channel have it
+    def answer(self, message: str, frame: str):
+        return message
+
+class BitflyerReplayProtocol:
+    def request(self, frame: str):
+        obj = json.loads(frame)
+        if obj.get('method') != 'subscribe':
+            return None
+        return obj['params']['channel']
+
+    def response(self, record):
+        if not record.message.startswith('{"jsonrpc":"2.0","id"'):
+            return None
+        return record.channel
+
+    # id of response has to be the one of the request
+    def answer(self, message: str, frame: str):
+        obj = json.loads(message)
+        obj['id'] = json.loads(frame)['id']
+        return json.dumps(obj, separators=(',', ':'))
+
+# bitmex subscribes in the url, its responses are replayed as they are
+REPLAY_PROTOCOLS = {
+    'bitmex': None,
+    'bitfinex': BitfinexReplayProtocol(),
+    'bitflyer': BitflyerReplayProtocol(),
+}
+
+"""local WebSocket server which replays msg records of a dump, stands in for WebSocket APIs of exchanges
+
+records is a function which returns an iterable of records, like a partial of reader.read
+records are sent with their original spacing divided by speed, as fast as possible if speed is None
+a recorded reconnection closes the connection, the next connection continues from there,
+records start over from the beginning if loop, connections are replayed one at a time
+a recorded response to subscribe is sent when the client subscribes the channel,
+channels the client does not subscribe in timeout seconds are left out
+"""
+class ReplayStandIn:
+    SUBSCRIBE_TIMEOUT = 5
+
+    def __init__(self, records, exchange: str, speed: float = 1.0, port: int = 0, loop: bool = False, timeout: float = SUBSCRIBE_TIMEOUT):
+        self.records = records
+        self.protocol = REPLAY_PROTOCOLS[exchange]
+        self.speed = speed
+        self.port = port
+        self.loop = loop
+        self.timeout = timeout
+        # iterator of records, and a record taken from it for the next connection
+        self.iterator = None
+        self.pending = None
+        # number of connections and messages sent
+        self.connections = 0
+        self.sent = 0
+
+        self.thread = None
+        self.ready = threading.Event()
+        self.logger = logging.getLogger('standin')
+
+    def url(self, path: str = '/'):
+        return 'ws://localhost:%d%s' % (self.port, path)
+
+    # returns the next record, None if there is no more
+    def next_record(self):
+        if self.pending is not None:
+            (record, self.pending) = (self.pending, None)
+            return record
+        if self.iterator is None:
+            self.iterator = iter(self.records())
+        record = next(self.iterator, None)
+        if record is None and self.loop:
+            self.iterator = iter(self.records())
+            record = next(self.iterator, None)
+        return record
+
+    # returns frame of client which subscribed channel, None if it does not in time
+    async def subscription(self, channel: str, subscribed: dict, changed: asyncio.Event):
+        deadline = asyncio.get_running_loop().time() + self.timeout
+        while channel not in subscribed:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                return None
+            changed.clear()
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+        return subscribed[channel]
+
+    async def handler(self, ws):
+        # a new connection waits until the previous one is closed
+        async with self.lock:
+            self.connections += 1
+            try:
+                await self.replay(ws)
+            except websockets.ConnectionClosed:
+                pass
+
+    async def replay(self, ws):
+        loop = asyncio.get_running_loop()
+        # map of channel vs frame the client subscribed it with
+        subscribed = dict()
+        changed = asyncio.Event()
+        async def receive():
+            async for frame in ws:
+                channel = self.protocol.request(frame) if self.protocol is not None else None
+                if channel is not None:
+                    subscribed[channel] = frame
+                    changed.set()
+        receiver = asyncio.create_task(receive())
+
+        # channels not subscribed by the client
+        dropped = set()
+        # (record time, loop time) of the first message
+        origin = None
+        first = True
+        try:
+            while True:
+                record = self.next_record()
+                if record is None:
+                    break
+                if record.type == 'start':
+                    if not first:
+                        # recorded reconnection
+                        self.pending = record
+                        break
+                    first = False
+                    continue
+                first = False
+
+                if self.speed is not None:
+                    if origin is None:
+                        origin = (record.time, loop.time())
+                    delay = origin[1] + (record.time - origin[0]) / 1_000_000_000 / self.speed - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                elif self.sent % 1000 == 0:
+                    # let the client frames in
+                    await asyncio.sleep(0)
+
+                channel = self.protocol.response(record) if self.protocol is not None else None
+                if channel is not None:
+                    began = loop.time()
+                    frame = await self.subscription(channel, subscribed, changed)
+                    if origin is not None:
+                        # time waiting for the client is not recorded
+                        origin = (origin[0], origin[1] + loop.time() - began)
+                    if frame is None:
+                        dropped.add(channel)
+                        continue
+                    dropped.discard(channel)
+                    message = self.protocol.answer(record.message, frame)
+                elif record.channel in dropped:
+                    continue
+                else:
+                    message = record.message
+                await ws.send(message)
+                self.sent += 1
+            await ws.close()
+        finally:
+            receiver.cancel()
+
+    async def serve(self):
+        self.stopped = asyncio.get_running_loop().create_future()
+        # connections are replayed one at a time
+        self.lock = asyncio.Lock()
+        # some clients do not answer closing handshake
+        async with websockets.serve(self.handler, 'localhost', self.port, max_size=None, close_timeout=1) as server:
+            self.port = server.sockets[0].getsockname()[1]
+            self.ready.set()
+            await self.stopped
+
+    def start(self):
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.serve()), name='replay-standin', daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def stop(self):
+        self.stopped.get_loop().call_soon_threadsafe(self.stopped.set_result, None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='replay a dump on a local WebSocket server')
+    parser.add_argument('directory', help='dump directory of an exchange')
+    parser.add_argument('--prefix', help='prefix of files, name of directory by default')
+    parser.add_argument('--exchange', choices=list(REPLAY_PROTOCOLS), help='exchange of dump, guessed from the prefix by default')
+    parser.add_argument('--start', type=int, help='nanoseconds to replay from, the first connection at or after it')
+    parser.add_argument('--end', type=int, help='nanoseconds to replay until')
+    parser.add_argument('--speed', type=float, default=1.0, help='times faster than recorded, 0 for as fast as possible')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('--loop', action='store_true', help='start over from the beginning at the end')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s][%(levelname)s] %(message)s', level=logging.INFO)
+
+    prefix = args.prefix or os.path.basename(os.path.normpath(args.directory))
+    exchange = args.exchange or prefix.partition('-')[0]
+    def records():
+        # records before the first connection are skipped, the client could not subscribe them
+        stream = reader.read(args.directory, prefix, args.start, args.end, types=['start', 'msg'])
+        return itertools.dropwhile(lambda record: record.type != 'start', stream)
+
+    standin = ReplayStandIn(records, exchange, args.speed or None, args.port, args.loop).start()
+    print('replaying %s on %s' % (args.directory, standin.url()))
+    try:
+        standin.thread.join()
+    except KeyboardInterrupt:
+        standin.stop()
+    print('%d messages in %d connections' % (standin.sent, standin.connections))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+import json
+import random
+
+# synthetic message generators which imitate real exchange streams
+# each generator yields (type, message) where type is 'send' or 'msg'
+# used to benchmark state analyzers and the writer without connecting to exchanges
+
+# exchanges send compact json without spaces
+def encode(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+BITMEX_SYMBOLS = ['XBTUSD', 'ETHUSD', 'XRPUSD']
+BITFINEX_SYMBOLS = ['tBTCUSD', 'tETHUSD', 'tXRPUSD']
+BITFLYER_PRODUCTS = ['BTC_JPY', 'FX_BTC_JPY', 'ETH_BTC']
+
+
+def bitmex(count: int, seed: int = 0):
+    rng = random.Random(seed)
+
+    yield ('msg', encode({'info': 'Welcome to the BitMEX Realtime API.', 'version': '2019-10-01T00:00:00.000Z'}))
+    for table in ['instrument', 'orderBookL2', 'trade']:
+        yield ('msg', encode({'success': True, 'subscribe': table}))
+
+    yield ('msg', encode({
+        'table': 'instrument',
+        'action': 'partial',
+        'data': [{ 'symbol': symbol, 'state': 'Open', 'lastPrice': 1000.0, 'fundingRate': 0.0001 } for symbol in BITMEX_SYMBOLS],
+    }))
+
+    # orders in the book, map of id vs (symbol, side, price)
+    orders = dict()
+    data = []
+    for symbol_index, symbol in enumerate(BITMEX_SYMBOLS):
+        for level in range(1, 101):
+            for side, price in (('Buy', 1000 - level*0.5), ('Sell', 1000 + level*0.5)):
+                # bitmex encodes price into id
+                id = 8800000000 * (symbol_index + 1) - int(price*100)
+                orders[id] = (symbol, side, price)
+                data.append({ 'symbol': symbol, 'id': id, 'side': side, 'size': rng.randint(1, 100000), 'price': price })
+    yield ('msg', encode({ 'table': 'orderBookL2', 'action': 'partial', 'data': data }))
+
+    ids = list(orders)
+    for _ in range(count):
+        r = rng.random()
+        if r < 0.7:
+            # burst of size updates
+            data = []
+            for id in rng.sample(ids, rng.randint(1, 10)):
+                symbol, side, _ = orders[id]
+                data.append({ 'symbol': symbol, 'id': id, 'side': side, 'size': rng.randint(1, 100000) })
+            yield ('msg', encode({ 'table': 'orderBookL2', 'action': 'update', 'data': data }))
+        elif r < 0.8:
+            # delete and insert the same level again
+            id = rng.choice(ids)
+            symbol, side, price = orders[id]
+            yield ('msg', encode({ 'table': 'orderBookL2', 'action': 'delete', 'data': [{ 'symbol': symbol, 'id': id, 'side': side }] }))
+            yield ('msg', encode({ 'table': 'orderBookL2', 'action': 'insert', 'data': [{ 'symbol': symbol, 'id': id, 'side': side, 'size': rng.randint(1, 100000), 'price': price }] }))
+        elif r < 0.95:
+            symbol = rng.choice(BITMEX_SYMBOLS)
+            yield ('msg', encode({ 'table': 'trade', 'action': 'insert', 'data': [{
+                'timestamp': '2019-10-01T00:00:00.000Z',
+                'symbol': symbol,
+                'side': rng.choice(['Buy', 'Sell']),
+                'size': rng.randint(1, 10000),
+                'price': 1000.0,
+                'tickDirection': 'ZeroPlusTick',
+                'trdMatchID': '%032x' % rng.getrandbits(128),
+                'grossValue': 1000000,
+                'homeNotional': 0.01,
+                'foreignNotional': 100,
+            }] }))
+        else:
+            symbol = rng.choice(BITMEX_SYMBOLS)
+            yield ('msg', encode({ 'table': 'instrument', 'action': 'update', 'data': [{
+                'symbol': symbol,
+                'lastPrice': 1000.0 + rng.randint(-10, 10),
+                'timestamp': '2019-10-01T00:00:00.000Z',
+            }] }))
+
+
+def bitfinex(count: int, seed: int = 0):
+    rng = random.Random(seed)
+
+    yield ('msg', encode({ 'event': 'info', 'version': 2, 'platform': { 'status': 1 } }))
+
+    # chanId of trades and book channels of each symbol
+    trades = dict()
+    books = dict()
+    chanId = 1
+    for symbol in BITFINEX_SYMBOLS:
+        yield ('send', encode({ 'event': 'subscribe', 'channel': 'trades', 'symbol': symbol }))
+        yield ('msg', encode({ 'event': 'subscribed', 'channel': 'trades', 'chanId': chanId, 'symbol': symbol, 'pair': symbol[1:] }))
+        trades[symbol] = chanId
+        chanId += 1
+    for symbol in BITFINEX_SYMBOLS:
+        yield ('send', encode({ 'event': 'subscribe', 'channel': 'book', 'symbol': symbol, 'prec': 'P0', 'freq': 'F0', 'len': '100' }))
+        yield ('msg', encode({ 'event': 'subscribed', 'channel': 'book', 'chanId': chanId, 'symbol': symbol, 'prec': 'P0', 'freq': 'F0', 'len': '100', 'pair': symbol[1:] }))
+        books[symbol] = chanId
+        chanId += 1
+
+    for symbol in BITFINEX_SYMBOLS:
+        orders = []
+        for level in range(1, 101):
+            orders.append([1000 - level, rng.randint(1, 5), rng.randint(1, 100) / 10])
+            orders.append([1000 + level, rng.randint(1, 5), -rng.randint(1, 100) / 10])
+        yield ('msg', encode([books[symbol], orders]))
+
+    for _ in range(count):
+        r = rng.random()
+        symbol = rng.choice(BITFINEX_SYMBOLS)
+        if r < 0.75:
+            level = rng.randint(1, 100)
+            if rng.random() < 0.5:
+                price, sign = 1000 - level, 1
+            else:
+                price, sign = 1000 + level, -1
+            if rng.random() < 0.2:
+                yield ('msg', encode([books[symbol], [price, 0, sign]]))
+            else:
+                yield ('msg', encode([books[symbol], [price, rng.randint(1, 5), sign * rng.randint(1, 100) / 10]]))
+        elif r < 0.95:
+            trade = [rng.randint(1, 1 << 30), 1569888000000, rng.choice([1, -1]) * rng.randint(1, 100) / 100, 1000.0]
+            yield ('msg', encode([trades[symbol], 'te', trade]))
+            yield ('msg', encode([trades[symbol], 'tu', trade]))
+        else:
+            yield ('msg', encode([rng.choice([books[symbol], trades[symbol]]), 'hb']))
+
+
+def bitflyer(count: int, seed: int = 0):
+    rng = random.Random(seed)
+
+    prefixes = ['lightning_executions_', 'lightning_board_snapshot_', 'lightning_board_', 'lightning_ticker_']
+
+    curr_id = 1
+    for product_code in BITFLYER_PRODUCTS:
+        for prefix in prefixes:
+            yield ('send', encode({ 'method': 'subscribe', 'params': { 'channel': prefix + product_code }, 'id': curr_id }))
+            yield ('msg', encode({ 'jsonrpc': '2.0', 'id': curr_id, 'result': True }))
+            curr_id += 1
+
+    def channel_message(channel, message):
+        return encode({ 'jsonrpc': '2.0', 'method': 'channelMessage', 'params': { 'channel': channel, 'message': message } })
+
+    def levels(start, step):
+        return [{ 'price': start + level*step, 'size': rng.randint(1, 1000) / 100 } for level in range(1, 101)]
+
+    for product_code in BITFLYER_PRODUCTS:
+        yield ('msg', channel_message('lightning_board_snapshot_' + product_code, {
+            'mid_price': 1000000, 'bids': levels(1000000, -1), 'asks': levels(1000000, 1),
+        }))
+
+    for _ in range(count):
+        r = rng.random()
+        product_code = rng.choice(BITFLYER_PRODUCTS)
+        if r < 0.6:
+            bids = [{ 'price': 1000000 - rng.randint(1, 100), 'size': rng.randint(0, 1000) / 100 } for _ in range(rng.randint(0, 3))]
+            asks = [{ 'price': 1000000 + rng.randint(1, 100), 'size': rng.randint(0, 1000) / 100 } for _ in range(rng.randint(0, 3))]
+            yield ('msg', channel_message('lightning_board_' + product_code, { 'mid_price': 1000000, 'bids': bids, 'asks': asks }))
+        elif r < 0.85:
+            executions = []
+            for _ in range(rng.randint(1, 5)):
+                executions.append({
+                    'id': rng.randint(1, 1 << 31),
+                    'side': rng.choice(['BUY', 'SELL']),
+                    'price': 1000000,
+                    'size': rng.randint(1, 1000) / 100,
+                    'exec_date': '2019-10-01T00:00:00.0000000Z',
+                    'buy_child_order_acceptance_id': 'JRF20191001-000000-000000',
+                    'sell_child_order_acceptance_id': 'JRF20191001-000000-000001',
+                })
+            yield ('msg', channel_message('lightning_executions_' + product_code, executions))
+        elif r < 0.99:
+            yield ('msg', channel_message('lightning_ticker_' + product_code, {
+                'product_code': product_code,
+                'timestamp': '2019-10-01T00:00:00.0000000Z',
+                'tick_id': rng.randint(1, 1 << 31),
+                'best_bid': 999999.0,
+                'best_ask': 1000001.0,
+                'best_bid_size': 0.1,
+                'best_ask_size': 0.1,
+                'ltp': 1000000.0,
+                'volume': 10000.0,
+            }))
+        else:
+            yield ('msg', channel_message('lightning_board_snapshot_' + product_code, {
+                'mid_price': 1000000, 'bids': levels(1000000, -1), 'asks': levels(1000000, 1),
+            }))
+
+
+GENERATORS = {
+    'bitmex': bitmex,
+    'bitfinex': bitfinex,
+    'bitflyer': bitflyer,
+}
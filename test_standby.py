@@ -0,0 +1,168 @@
+import dumpv2
+import standby
+
+import shutil
+import tempfile
+import unittest
+
+# alignment and takeover of standby.StandbyDumper with connections which never connect
+# messages are fed to on_message as if they were received, written ones are taken from the writer queue
+#
+# python -m unittest test_standby
+
+# messages are 'channel:key', 'sub:channel' is the response to subscribe of channel
+class FakeProtocol:
+    def __init__(self):
+        self.subscribed = set()
+
+    def send(self, frame: str):
+        pass
+
+    def classify(self, message: str):
+        (channel, key) = message.split(':')
+        if channel == 'sub':
+            self.subscribed.add(key)
+            return (key, None)
+        return (channel, key)
+
+    def channels(self):
+        return self.subscribed
+
+    def takeover(self, previous):
+        pass
+
+    def rewrite(self, message: str):
+        return message
+
+class TakeoverTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dumper = standby.StandbyDumper(self.directory, 'fake', 'ws://localhost/', None, None, FakeProtocol, prefix='test-%s' % self.id())
+        self.active = self.connection(1)
+        self.standby = self.connection(2)
+        self.dumper.active = self.active
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def connection(self, number: int):
+        connection = standby.Connection(self.dumper, number, FakeProtocol())
+        connection.opened = 0
+        return connection
+
+    def receive(self, connection: standby.Connection, *messages):
+        for message in messages:
+            self.dumper.on_message(connection, message)
+
+    def takeover(self):
+        with self.dumper.lock:
+            self.dumper.takeover(self.active, self.standby)
+
+    def written(self):
+        return [msg for (type, msg, _) in self.dumper.writer.queue if type == dumpv2.MSG]
+
+    def test_standby_ahead(self):
+        self.receive(self.active, 'sub:a', 'a:1', 'a:2', 'a:3', 'a:4')
+        self.receive(self.standby, 'sub:a', 'a:2', 'a:3', 'a:4', 'a:5', 'a:6')
+        self.takeover()
+        self.receive(self.standby, 'a:7')
+        self.assertEqual(self.written(), ['sub:a', 'a:1', 'a:2', 'a:3', 'a:4', 'a:5', 'a:6', 'a:7'])
+        self.assertIs(self.dumper.active, self.standby)
+
+    def test_standby_behind(self):
+        self.receive(self.active, 'sub:a', 'a:1', 'a:2', 'a:3', 'a:4', 'a:5')
+        self.receive(self.standby, 'sub:a', 'a:2', 'a:3')
+        self.takeover()
+        # a:4 and a:5 are in flight on the standby connection
+        self.receive(self.standby, 'a:4', 'a:5', 'a:6')
+        self.assertEqual(self.written(), ['sub:a', 'a:1', 'a:2', 'a:3', 'a:4', 'a:5', 'a:6'])
+        self.assertEqual(self.dumper.duplicates.value, 2)
+
+    def test_standby_without_messages(self):
+        self.receive(self.active, 'sub:a', 'a:1', 'a:2', 'a:3')
+        self.receive(self.standby, 'sub:a')
+        self.takeover()
+        # standby could start anywhere in what the file has
+        self.receive(self.standby, 'a:3', 'a:4')
+        self.assertEqual(self.written(), ['sub:a', 'a:1', 'a:2', 'a:3', 'a:4'])
+
+    def test_old_key_repeated(self):
+        self.receive(self.active, 'sub:a', 'a:1', 'a:2', 'a:3')
+        self.receive(self.standby, 'sub:a')
+        self.takeover()
+        # a:1 is in the tail but not followed by the rest of it, it is a new message
+        with self.assertLogs('standby', 'WARNING') as logs:
+            self.receive(self.standby, 'a:1', 'a:9')
+        self.assertIn('could overlap', logs.output[0])
+        self.assertEqual(self.written(), ['sub:a', 'a:1', 'a:2', 'a:3', 'a:1', 'a:9'])
+        self.assertEqual(self.dumper.duplicates.value, 0)
+
+    def test_standby_without_messages_run_to_end(self):
+        self.receive(self.active, 'sub:a', 'a:1', 'a:2', 'a:3')
+        self.receive(self.standby, 'sub:a')
+        self.takeover()
+        # held until they reach the end of the tail
+        self.receive(self.standby, 'a:2')
+        self.assertEqual(self.written(), ['sub:a', 'a:1', 'a:2', 'a:3'])
+        self.receive(self.standby, 'a:3', 'a:4')
+        self.assertEqual(self.written(), ['sub:a', 'a:1', 'a:2', 'a:3', 'a:4'])
+        self.assertEqual(self.dumper.duplicates.value, 2)
+
+    def test_held_written_on_close(self):
+        self.receive(self.active, 'sub:a', 'a:1', 'a:2', 'a:3')
+        self.receive(self.standby, 'sub:a')
+        self.takeover()
+        self.receive(self.standby, 'a:1')
+        with self.assertLogs('standby', 'WARNING'):
+            self.dumper.on_close(self.standby)
+        self.assertEqual(self.written(), ['sub:a', 'a:1', 'a:2', 'a:3', 'a:1'])
+
+    def test_repeated_keys(self):
+        # the same key twice in a row, only the consistent match counts
+        self.receive(self.active, 'sub:a', 'a:1', 'a:2', 'a:2', 'a:3')
+        self.receive(self.standby, 'sub:a', 'a:2', 'a:2', 'a:3', 'a:2', 'a:4')
+        self.takeover()
+        self.assertEqual(self.written(), ['sub:a', 'a:1', 'a:2', 'a:2', 'a:3', 'a:2', 'a:4'])
+
+    def test_unaligned(self):
+        self.receive(self.active, 'sub:a', 'a:1')
+        self.receive(self.standby, 'sub:a', 'a:x')
+        self.receive(self.active, 'a:2')
+        self.receive(self.standby, 'a:y', 'a:z')
+        with self.assertLogs('standby', 'WARNING') as logs:
+            self.takeover()
+        self.assertIn('aligned by time', logs.output[0])
+        # only messages received after the last one of the previous connection
+        self.assertEqual(self.written(), ['sub:a', 'a:1', 'a:2', 'a:y', 'a:z'])
+
+    def test_channels_aligned_separately(self):
+        self.receive(self.active, 'sub:a', 'sub:b', 'a:1', 'b:1', 'a:2', 'b:2')
+        self.receive(self.standby, 'sub:a', 'sub:b', 'b:2', 'b:3', 'a:1')
+        self.takeover()
+        self.receive(self.standby, 'a:2', 'a:3')
+        self.assertEqual(self.written(), ['sub:a', 'sub:b', 'a:1', 'b:1', 'a:2', 'b:2', 'b:3', 'a:3'])
+
+    def test_channel_only_on_standby(self):
+        self.receive(self.active, 'sub:a', 'a:1')
+        self.receive(self.standby, 'sub:a', 'sub:c', 'a:1', 'c:1')
+        with self.assertLogs('standby', 'WARNING'):
+            self.takeover()
+        self.assertEqual(self.written(), ['sub:a', 'a:1', 'sub:c', 'c:1'])
+
+    def test_gap(self):
+        self.receive(self.active, 'sub:a', 'a:1', 'a:2', 'a:3')
+        self.receive(self.standby, 'sub:a', 'a:1')
+        self.takeover()
+        # a:2 and a:3 are expected, a:5 means the standby missed them
+        with self.assertLogs('standby', 'WARNING') as logs:
+            self.receive(self.standby, 'a:5')
+        self.assertIn('could have a gap', logs.output[0])
+        self.assertEqual(self.written(), ['sub:a', 'a:1', 'a:2', 'a:3', 'a:5'])
+
+    def test_standby_not_written_before_takeover(self):
+        self.receive(self.active, 'sub:a', 'a:1')
+        self.receive(self.standby, 'sub:a', 'a:1', 'a:2')
+        self.assertEqual(self.written(), ['sub:a', 'a:1'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import compression
+import reader
+from common import DIR_DICTIONARY
+
+import argparse
+import collections
+import os
+import re
+import time
+
+# trains dictionaries of compression from previous dumps, and compares them
+#
+# train: python traindict.py train dump/bitmex --backend zlib --activate
+# compare: python traindict.py compare dump/bitmex
+
+# constant head of a message until the first number, like {"table":"orderBookL2","action":"update","data":[{"symbol":"XBTUSD","id":
+MESSAGE_HEAD = re.compile(rb'[^0-9]*')
+# key and string value in json, like ,"side":"Buy"
+KEY_VALUE = re.compile(rb'[{\[,]"[^"]*":(?:"[^"]*")?')
+
+# returns messages of files, up to count
+def samples(files: list, count: int):
+    messages = []
+    for (_, path) in files:
+        for record in reader.read_file(path, types=['msg']):
+            messages.append(record.message.encode())
+            if len(messages) >= count:
+                return messages
+    return messages
+
+"""returns zlib dictionary made of substrings common in samples
+
+zlib has no trainer, substrings saving the most bytes are put at the end of dictionary
+where they are the nearest to data
+"""
+def train_zlib(samples: list, size: int):
+    scores = collections.Counter()
+    for sample in samples:
+        pieces = KEY_VALUE.findall(sample)
+        head = MESSAGE_HEAD.match(sample).group()
+        if len(head) > 0:
+            pieces.append(head)
+        for piece in pieces:
+            scores[piece] += len(piece)
+
+    pieces = []
+    total = 0
+    for piece, score in scores.most_common():
+        if score < 2*len(piece):
+            # appeared only once, a shorter piece after it could still have appeared more
+            continue
+        if total + len(piece) > size:
+            continue
+        pieces.append(piece)
+        total += len(piece)
+    # the most saving one comes last
+    return b''.join(reversed(pieces))
+
+def train_zstd(samples: list, size: int):
+    if compression.zstandard is None:
+        raise ValueError('zstandard is not installed')
+    return compression.zstandard.train_dictionary(size, samples).as_bytes()
+
+TRAINERS = {
+    'zlib': (train_zlib, compression.ZLIB_DICTIONARY_SIZE),
+    'zstd': (train_zstd, 112*1024),
+}
+
+# write dictionary into directory, returns its id
+def save(directory: str, dictionary: bytes, activate: bool):
+    os.makedirs(directory, exist_ok=True)
+    id = compression.dictionary_id(dictionary)
+    with open(os.path.join(directory, '%s.dict' % id), 'wb') as file:
+        file.write(dictionary)
+    if activate:
+        temporary = os.path.join(directory, 'current.tmp')
+        with open(temporary, 'w') as file:
+            file.write(id)
+        os.replace(temporary, os.path.join(directory, 'current'))
+    return id
+
+# returns compressors of gzip and every dictionary in directory
+def compressors(directory: str, level: int):
+    options = dict() if level is None else { 'level': level }
+    result = [compression.GzipCompressor(**options)]
+    if not os.path.isdir(directory):
+        return result
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.dict'):
+            continue
+        with open(os.path.join(directory, name), 'rb') as file:
+            dictionary = file.read()
+        result.append(compression.ZlibCompressor(dictionary, **options))
+        if compression.zstandard is not None:
+            result.append(compression.ZstdCompressor(dictionary, **options))
+    return result
+
+# returns decompressed content of files
+def contents(files: list):
+    result = []
+    for (_, path) in files:
+        with open(path, 'rb') as file, compression.open_reader(file) as stream:
+            result.append(stream.read())
+    return result
+
+def compare(directory: str, files: list, level: int, block_size: int):
+    data = contents(files)
+    size = sum(len(content) for content in data)
+
+    print('%-6s %-16s %10s %10s %10s %10s' % ('codec', 'dictionary', 'file', 'MB/s', 'block', 'MB/s'))
+    for compressor in compressors(directory, level):
+        # whole file as one stream
+        start = time.perf_counter()
+        compressed = 0
+        for content in data:
+            stream = compressor.compressobj() if compressor.dictionary_id is not None else None
+            if stream is None:
+                compressed += len(compressor.compress(content))
+            else:
+                compressed += len(stream.compress(content)) + len(stream.flush())
+        file_duration = time.perf_counter() - start
+        file_ratio = size / compressed
+
+        # blocks of Writer in blocks mode
+        start = time.perf_counter()
+        compressed = 0
+        for content in data:
+            for i in range(0, len(content), block_size):
+                compressed += len(compressor.compress(content[i:i+block_size]))
+        block_duration = time.perf_counter() - start
+        block_ratio = size / compressed
+
+        print('%-6s %-16s %10.2f %10.1f %10.2f %10.1f' % (compressor.name, compressor.dictionary_id or '-',
+            file_ratio, size / 1_000_000 / file_duration, block_ratio, size / 1_000_000 / block_duration))
+
+def main():
+    parser = argparse.ArgumentParser(description='train and compare dictionaries of compression')
+    parser.add_argument('command', choices=['train', 'compare'])
+    parser.add_argument('directory', help='dump directory of an exchange')
+    parser.add_argument('--prefix', help='prefix of files, name of directory by default')
+    parser.add_argument('--exchange', help='exchange of dictionaries, name of directory by default')
+    parser.add_argument('--dictionaries', default=DIR_DICTIONARY, help='directory of dictionaries of every exchange')
+    parser.add_argument('--backend', choices=list(TRAINERS), default='zlib', help='backend to train a dictionary for')
+    parser.add_argument('--size', type=int, help='size of dictionary in bytes')
+    parser.add_argument('--samples', type=int, default=100000, help='number of messages to train with')
+    parser.add_argument('--files', type=int, default=10, help='number of files to compare with, the newest ones')
+    parser.add_argument('--level', type=int, help='compression level to compare with')
+    parser.add_argument('--block-size', type=int, default=256*1024, help='size of blocks to compare with')
+    parser.add_argument('--activate', action='store_true', help='use the trained dictionary from the next connection')
+    args = parser.parse_args()
+
+    exchange = args.exchange or os.path.basename(os.path.normpath(args.directory))
+    directory = os.path.join(args.dictionaries, exchange)
+    files = reader.list_files(args.directory, args.prefix)
+
+    if args.command == 'train':
+        # the newest files are left for compare
+        training = files[:-args.files] if len(files) > args.files else files
+        messages = samples(training, args.samples)
+        (train, size) = TRAINERS[args.backend]
+        dictionary = train(messages, args.size or size)
+        id = save(directory, dictionary, args.activate)
+        print('trained %s with %d messages, %d bytes' % (id, len(messages), len(dictionary)))
+    else:
+        compare(directory, files[-args.files:], args.level, args.block_size)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 #!/bin/sh
 mkdir dumperv2
-if cp common.py dumpv2.py bitfinex.py bitmex.py bitflyer.py dumperv2 ; then
+if cp common.py dumpv2.py recordfmt.py compression.py recompress.py reader.py compact.py asyncdump.py metadata.py metrics.py profiling.py standby.py bitfinex.py bitmex.py bitflyer.py dumperv2 ; then
   rm dumperv2.zip
   zip dumperv2.zip -r dumperv2
   rm -r dumperv2